@@ -5,14 +5,21 @@
 
 
 import argparse
+from functools import partial
 from glob import glob
 import os
 from os.path import join
 import sys
-from nistats.first_level_model import FirstLevelModel
+import time
 import warnings
+from utils.bids_index import get_bids_index
 from utils.firstlevel_utils import get_first_level_objs,\
-    make_first_level_obj, save_first_level_obj
+    make_first_level_obj, fit_first_level_obj, get_func_file,\
+    get_events_file, get_confounds_file, compare_serial_to_parallel
+from utils.manifest_utils import FirstLevelManifest, get_code_hash,\
+    get_unit_fingerprint
+from utils.utils import get_flags
+from utils.utils import run_jobs, split_n_procs
 
 
 # In[2]:
@@ -23,12 +30,37 @@ parser.add_argument('-data_dir', default='/data')
 parser.add_argument('-derivatives_dir', default=None)
 parser.add_argument('-fmriprep_dir', default=None)
 parser.add_argument('-working_dir', default=None)
+parser.add_argument('-design_cache_dir', default=None)
+parser.add_argument('-bold_cache_dir', default=None,
+                    help='fit from float32 copies of the BOLD runs in this '
+                         'directory (see build_bold_cache.py)')
+parser.add_argument('-index_snapshot_dir', default=None,
+                    help='save/reuse snapshots of the fmriprep and data dir '
+                         'file indexes in this directory')
+parser.add_argument('--refresh_index', action='store_true',
+                    help='rescan the fmriprep and data dirs even if index '
+                         'snapshots exist')
+parser.add_argument('--glm_solver', default='nistats', choices=['nistats', 'ar1'],
+                    help='fit the AR(1) task model with nistats '
+                         'FirstLevelModel or with the float32 '
+                         'utils.ar1_solver (experimental until checked '
+                         'against nistats with ar1_solver.compare_to_nistats)')
 parser.add_argument('--subject_ids', nargs="+")
 parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, DPX, motorSelectiveStop, stopSignal, stroop, surveyMedley, twoByTwo, WATT3")
 parser.add_argument('--rt', action='store_true')
-parser.add_argument('--beta', action='store_true')
+parser.add_argument('--beta', action='store_true',
+                    help='estimate single trial betas instead of the task '
+                         'model')
+parser.add_argument('--beta_method', default='lss', choices=['lsa', 'lss'],
+                    help='single trial estimator used with --beta')
 parser.add_argument('--n_procs', default=16, type=int)
 parser.add_argument('--overwrite', action='store_true')
+parser.add_argument('--dry_run', action='store_true',
+                    help='list the units whose inputs changed and exit')
+parser.add_argument('--check_parallel', action='store_true',
+                    help='fit the stale units serially and over --n_procs '
+                         'into the working dir, list the outputs that '
+                         'differ and exit')
 parser.add_argument('--quiet', '-q', action='store_true')
 parser.add_argument('--design_matrix_only', '-dm', action='store_true')
 parser.add_argument('--a_comp_cor', action='store_true')
@@ -80,6 +112,18 @@ if args.working_dir is None:
     working_dir = join(derivatives_dir, '1stlevel_workingdir')
 else:
     working_dir = join(args.working_dir, '1stlevel_workingdir')
+if args.design_cache_dir is None:
+    design_cache_dir = join(first_level_dir, 'design_cache')
+else:
+    design_cache_dir = args.design_cache_dir
+
+# index fmriprep and data dirs once; all file getters resolve against these
+for index_dir, name in [(fmriprep_dir, 'fmriprep'), (data_dir, 'data')]:
+    snapshot = None
+    if args.index_snapshot_dir is not None:
+        os.makedirs(args.index_snapshot_dir, exist_ok=True)
+        snapshot = join(args.index_snapshot_dir, '%s_index.json' % name)
+    get_bids_index(index_dir, snapshot=snapshot, refresh=args.refresh_index)
 
 # set tasks
 if args.tasks is not None:
@@ -119,46 +163,117 @@ verboseprint('*'*79)
 
 # In[6]:
 
-to_run = []
+# units are rerun when the fingerprint of their inputs differs from the one
+# recorded in the manifest. Existing outputs without a manifest entry (from
+# before the manifest) are adopted as they are
+manifest = FirstLevelManifest(first_level_dir)
+code_hash = get_code_hash()
+flags = '%s_%s' % get_flags(regress_rt, beta_series)
+settings = {'TR': TR, 'regress_rt': regress_rt, 'beta': beta_series,
+            'beta_method': args.beta_method if beta_series else None,
+            'glm_solver': None if beta_series else args.glm_solver,
+            'a_comp_cor': a_comp_cor, 'use_aroma': use_aroma,
+            'design_matrix_only': args.design_matrix_only}
+# stale units are always listed on a dry run
+report = print if args.dry_run else verboseprint
+stale_units = []
+fingerprints = {}
 for subject_id in subjects:
     for task in tasks:
-        verboseprint('Setting up %s, %s' % (subject_id, task))
-        files = get_first_level_objs(
-            subject_id, task, first_level_dir, regress_rt=regress_rt)
-        if len(files) == 0 or args.overwrite:
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=DeprecationWarning)
-                warnings.filterwarnings("ignore", category=UserWarning)
-                subjinfo = make_first_level_obj(subject_id, task, fmriprep_dir,
-                                                data_dir, first_level_dir, TR,
-                                                regress_rt=regress_rt,
-                                                a_comp_cor=a_comp_cor,
-                                                use_aroma=use_aroma)
-            if subjinfo is not None:
-                to_run.append(subjinfo)
+        func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task,
+                                             use_aroma=use_aroma)
+        events_file = get_events_file(data_dir, subject_id, task)
+        if None in (func_file, mask_file, events_file):
+            # make_first_level_obj reports the missing files
+            report('Stale %s_%s (missing inputs)' % (subject_id, task))
+            stale_units.append((subject_id, task))
+            continue
+        key = manifest.get_key(subject_id, task, flags)
+        fingerprint = get_unit_fingerprint(
+            func_file, mask_file, events_file,
+            get_confounds_file(fmriprep_dir, subject_id, task),
+            settings, code_hash=code_hash)
+        changes = manifest.get_changes(key, fingerprint)
+        if args.overwrite:
+            reason = 'overwrite'
+        elif changes is None:
+            files = get_first_level_objs(subject_id, task, first_level_dir,
+                                         regress_rt=regress_rt,
+                                         beta=beta_series)
+            if len(files) > 0:
+                verboseprint('Adopting existing outputs for %s' % key)
+                if not args.dry_run:
+                    manifest.update(key, fingerprint)
+                continue
+            reason = 'new'
+        elif changes:
+            reason = 'changed: %s' % ', '.join(changes)
+        else:
+            continue
+        report('Stale %s (%s)' % (key, reason))
+        stale_units.append((subject_id, task))
+        fingerprints['%s_%s' % (subject_id, task)] = (key, fingerprint)
+
+if args.dry_run:
+    print('%s stale units' % len(stale_units))
+    sys.exit()
+manifest.save()
+
+# design phase: build (or read from the design cache) the design for every
+# stale unit. With --design_matrix_only the pipeline stops after exporting these
+to_run = []
+for subject_id, task in stale_units:
+    verboseprint('Setting up %s, %s' % (subject_id, task))
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        warnings.filterwarnings("ignore", category=UserWarning)
+        subjinfo = make_first_level_obj(subject_id, task, fmriprep_dir,
+                                        data_dir, first_level_dir, TR,
+                                        regress_rt=regress_rt,
+                                        beta=beta_series,
+                                        a_comp_cor=a_comp_cor,
+                                        use_aroma=use_aroma,
+                                        design_cache_dir=design_cache_dir,
+                                        code_hash=code_hash)
+    if subjinfo is not None:
+        to_run.append(subjinfo)
 
 # In[7]:
 
-for subjinfo in to_run:
-    verboseprint(subjinfo.ID)
-    verboseprint('** fitting model')
-    fmri_glm = FirstLevelModel(TR,
-                               subject_label=subjinfo.ID,
-                               mask=subjinfo.mask,
-                               noise_model='ar1',
-                               standardize=False,
-                               hrf_model='spm',
-                               drift_model='cosine',
-                               period_cut=80,
-                               n_jobs=1
-                               )
-
-    verboseprint('** saving')
-    if not args.design_matrix_only:
-        out = fmri_glm.fit(subjinfo.func, design_matrices=subjinfo.design)
-        subjinfo.fit_model = out
-    subjinfo.export_design(first_level_dir)
-    subjinfo.export_events(first_level_dir)
-    subjinfo.export_2ndlvl_meta(first_level_dir)
-    save_first_level_obj(subjinfo, first_level_dir,
-                         save_maps=(not args.design_matrix_only))
\ No newline at end of file
+fit_kwargs = {'design_matrix_only': args.design_matrix_only,
+              'bold_cache_dir': args.bold_cache_dir,
+              'beta_method': args.beta_method,
+              'glm_solver': args.glm_solver}
+if args.check_parallel:
+    check_dir = join(working_dir, 'parallel_check')
+    differing = compare_serial_to_parallel(to_run, check_dir, TR, n_procs,
+                                           **fit_kwargs)
+    for f in differing:
+        print('Differs: %s' % f)
+    print('%s outputs differ between serial and parallel fits (see %s)'
+          % (len(differing), check_dir))
+    sys.exit(len(differing) > 0)
+
+# fitting phase: fan (subject, task) units out over the procs. Pool workers
+# are daemonic, so joblib would run any parallelism over AR(1) bins within
+# them serially: with fewer units than procs the units are fit one at a time
+# here with n_jobs=n_procs instead (see utils.utils.split_n_procs). Workers
+# are replaced after every unit so each holds at most one BOLD series in memory
+n_workers, n_jobs = split_n_procs(n_procs, len(to_run))
+verboseprint('** fitting %s models, %s workers with n_jobs=%s' %
+             (len(to_run), n_workers, n_jobs))
+fit_unit = partial(fit_first_level_obj,
+                   output_dir=first_level_dir,
+                   TR=TR,
+                   n_jobs=n_jobs,
+                   **fit_kwargs)
+start = time.time()
+for ID, elapsed in run_jobs(fit_unit, to_run, n_workers, maxtasksperchild=1):
+    verboseprint('** saved %s (%.1fs)' % (ID, elapsed))
+    # only the main process writes the manifest, once per finished unit.
+    # Other jobs writing to first_level_dir keep their entries (see
+    # manifest_utils.Manifest.save)
+    manifest.update(*fingerprints[ID])
+    manifest.save()
+verboseprint('** done with %s models in %.1fs' % (len(to_run),
+                                                  time.time() - start))
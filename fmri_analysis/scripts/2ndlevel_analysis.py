@@ -4,14 +4,15 @@
 # In[ ]:
 import argparse
 from os import makedirs, path
-import pandas as pd
-import numpy as np
 import sys
-import json
 
-from nistats.second_level_model import SecondLevelModel
-from utils.firstlevel_utils import get_first_level_maps, get_first_level_metas
-from utils.secondlevel_utils import create_group_mask, randomise
+from nilearn import masking
+from utils.covariates_table import get_covariates
+from utils.firstlevel_utils import get_first_level_maps
+from utils.group_mask import update_group_masks
+from utils.group_ols import compute_group_maps
+from utils.secondlevel_utils import get_randomise_dir, run_randomise_jobs
+from utils.subject_stack import build_subject_stack, get_stack_dir
 from utils.utils import get_contrasts, get_flags
 
 # In[ ]:
@@ -23,9 +24,19 @@ def get_args():
     parser.add_argument('--rt', action='store_true')
     parser.add_argument('--beta', action='store_true')
     parser.add_argument('--n_perms', default=10000, type=int)
+    parser.add_argument('--n_procs', default=1, type=int,
+                        help='number of processes running the randomise '
+                             'jobs of every (task, contrast, scnd_lvl)')
+    parser.add_argument('--randomise', default='fsl', choices=['fsl', 'python'],
+                        help='run permutations with FSL randomise or in '
+                             'process with utils.permutation_utils '
+                             '(experimental until checked against FSL with '
+                             'secondlevel_utils.compare_to_randomise_fsl)')
     parser.add_argument('--mask_thresh', default=.95, type=float)
     parser.add_argument('--smoothing_fwhm', default=6)
-    parser.add_argument('--scnd_lvl', default='NONE')
+    parser.add_argument('--scnd_lvl', nargs='+', default=['intercept'],
+                        help="second level effects: intercept, RT columns, "
+                             "or 'all' for the intercept and every RT column")
     parser.add_argument('--quiet', '-q', action='store_true')
     parser.add_argument('--aim', default='NONE', help='Choose from aim1, aim2')
     parser.add_argument('--group', default='NONE')
@@ -36,29 +47,11 @@ def get_args():
         args = parser.parse_args([])
         args.derivatives_dir = '/data/derivatives/'
         args.tasks = ['stroop']
-        args.scnd_lvl = 'intercept'
+        args.scnd_lvl = ['intercept']
         args.rt = True
         args.n_perms = 10
     return args
 
-def extend_confounds_df(indiv_meta_files):
-    aim1_2ndlevel_confounds_path = "/scripts/aim1_2ndlevel_regressors/" +\
-                               "aim1_2ndlevel_confounds_matrix.csv"
-    full_confounds_df = pd.read_csv(aim1_2ndlevel_confounds_path,
-                                index_col='index')
-    meta_dict = {}
-    for meta_file in indiv_meta_files:
-        sub_id = meta_file.replace(first_level_dir+'/', '').split('/%s' % task)[0]
-        with open(meta_file, 'r') as f:
-            meta_dict[sub_id] = json.load(f)
-    meta_df = pd.DataFrame(meta_dict).T
-
-    extended_confounds_df = pd.concat([meta_df, full_confounds_df], axis=1, sort=True).copy()
-    # substitute in old mriqc if new is not available
-    extended_confounds_df['FD_mean'] =  extended_confounds_df['FD_mean'].combine_first(extended_confounds_df['%s_meanFD' % task])
-    return extended_confounds_df
-
-
 def get_2ndlevel_desMat(maps, task, extended_confounds_df):
     subjects = [m.split('1stlevel/')[-1].split('/')[0] for m in maps]
     rt_cols = extended_confounds_df.filter(regex='RT').columns
@@ -86,12 +79,10 @@ def filter_maps_and_DM(maps, des_mat):
     assert(len(des_mat) == len(maps))
     return maps, des_mat
 
-def get_2ndlevel_contrast(des_mat, scnd_lvl):
-    ncols = des_mat.shape[1]
-    contrast = np.zeros(ncols)
-    contrast[des_mat.columns.get_loc(scnd_lvl)] = 1
-    contrast = [int(i) for i in contrast]
-    return contrast
+def get_scnd_lvls(scnd_lvl, des_mat):
+    if 'all' in scnd_lvl:
+        return ['intercept'] + list(des_mat.filter(regex='RT').columns)
+    return scnd_lvl
 
 if __name__=='__main__':
     args = get_args()
@@ -123,16 +114,13 @@ if __name__=='__main__':
     n_perms = args.n_perms
     group = args.group
 
-    # Create Mask
-    mask_loc = path.join(second_level_dir,
-                        'group_mask_thresh-%s.nii.gz' % str(args.mask_thresh))
-    if (not path.exists(mask_loc)) or args.rerun:
-        verboseprint('Making group mask at %s' % mask_loc)
-        group_mask = create_group_mask(fmriprep_dir, args.mask_thresh)
-        makedirs(path.dirname(mask_loc), exist_ok=True)
-        group_mask.to_filename(mask_loc)
+    # Create Mask (masks of new subjects are added to the saved counts)
+    mask_loc, = update_group_masks(fmriprep_dir, second_level_dir,
+                                   [args.mask_thresh], rebuild=args.rerun,
+                                   verbose=not args.quiet)
 
     rt_flag, beta_flag = get_flags(regress_rt, beta_series)
+    randomise_jobs = []
     for task in tasks:
         verboseprint('Running 2nd level for %s' % task)
 
@@ -143,18 +131,28 @@ if __name__=='__main__':
                             'secondlevel-%s_%s_maps' % (rt_flag, beta_flag))
         makedirs(maps_dir, exist_ok=True)
 
-        indiv_meta_files = get_first_level_metas('*', task,
-                                                first_level_dir,
-                                                regress_rt,
-                                                beta_series)
-        extended_confounds_df = extend_confounds_df(indiv_meta_files)
-
-        # run through each contrast for all participants
+        # subject covariates, updated with new first level metas
+        extended_confounds_df = get_covariates(first_level_dir,
+                                               second_level_dir, task,
+                                               regress_rt, beta_series,
+                                               rebuild=args.rerun)
+
+        # masked, smoothed maps of every contrast, shared by the models
+        # and randomise
+        verboseprint('*** Stacking maps')
+        stack = build_subject_stack(first_level_dir, task,
+                                    [name for name, _ in task_contrasts],
+                                    mask_loc,
+                                    get_stack_dir(second_level_dir, task,
+                                                  regress_rt, beta_series,
+                                                  args.smoothing_fwhm),
+                                    fwhm=args.smoothing_fwhm,
+                                    regress_rt=regress_rt, beta=beta_series,
+                                    rebuild=args.rerun)
+
+        # design of each contrast, for all participants
+        designs, contrast_maps = {}, {}
         for name, contrast in task_contrasts:
-            second_level_model = SecondLevelModel(
-                mask=mask_loc,
-                smoothing_fwhm=args.smoothing_fwhm
-                )
             maps = get_first_level_maps('*', task,
                                         first_level_dir,
                                         name,
@@ -165,41 +163,62 @@ if __name__=='__main__':
             if len(maps) <= 1:
                 verboseprint('****** No Maps')
                 continue
-
-            # run 2ndlevels
             des_mat = get_2ndlevel_desMat(maps,
                                         task,
                                         extended_confounds_df)
             maps, des_mat = filter_maps_and_DM(maps, des_mat)
-            second_level_model.fit(maps, design_matrix=des_mat)
-            second_level_contrast = get_2ndlevel_contrast(des_mat, args.scnd_lvl)
-            contrast_map = second_level_model.compute_contrast(
-                second_level_contrast=second_level_contrast
-                )
-            # save
-            contrast_file = path.join(maps_dir, 'contrast-%s_2ndlevel-%s.nii.gz' % (name, args.scnd_lvl))
-            contrast_map.to_filename(contrast_file)
+            designs[name] = des_mat
+            contrast_maps[name] = maps
+
+        # run 2ndlevels: one fit per contrast, one pseudo-inverse per set
+        # of subjects, every second level effect from each fit
+        # (maps are smoothed in the stack)
+        scnd_lvls = get_scnd_lvls(args.scnd_lvl, extended_confounds_df)
+        for name, _, effect_maps in compute_group_maps(designs, stack.get,
+                                                       scnd_lvls):
+            maps, des_mat = contrast_maps[name], designs[name]
             # write metadata
             N = str(len(maps)).zfill(2)
             with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
-                f.write('Contrast-%s: %s maps\n' % (contrast, N))
-            # save corrected maps if need be
-            if n_perms > 0:
-                rand_out_dir = path.join(maps_dir, 'contrast-%s_2ndlevel-%s_Randomise' % (name, args.scnd_lvl))
-                if (not path.exists(rand_out_dir)) or args.rerun:
-                    verboseprint('*** Running Randomise')
-                    randomise(maps, maps_dir, mask_loc, des_mat, args.scnd_lvl,
-                            fwhm=args.smoothing_fwhm,
-                            n_perms=n_perms)
-                    # write metadata
-                    with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
-                        f.write(
-                            'Contrast-%s: Randomise run with %s permutations\n' %
-                            (name, str(n_perms)))
-                else:
-                    with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
-                        f.write(
-                            'Contrast-%s: Randomise results already found, not rerun.\n' %
-                            name)
+                f.write('Contrast-%s: %s maps\n' % (name, N))
+            for scnd_lvl, effect_map in effect_maps.items():
+                # save
+                contrast_file = path.join(maps_dir, 'contrast-%s_2ndlevel-%s.nii.gz' % (name, scnd_lvl))
+                masking.unmask(effect_map, mask_loc).to_filename(contrast_file)
+                # queue corrected maps if need be
+                if n_perms > 0:
+                    rand_out_dir = get_randomise_dir(maps_dir, name, scnd_lvl)
+                    if (not path.exists(rand_out_dir)) or args.rerun:
+                        randomise_jobs.append({
+                            'id': '%s/%s/%s' % (task, name, scnd_lvl),
+                            'contrast': name,
+                            'scnd_lvl': scnd_lvl,
+                            'maps': maps,
+                            'maps_dir': maps_dir,
+                            'mask_loc': mask_loc,
+                            'des_mat': des_mat,
+                            'stack_dir': stack.stack_dir,
+                            'fwhm': args.smoothing_fwhm,
+                            'n_perms': n_perms,
+                            'fsl': args.randomise == 'fsl'})
+                    else:
+                        with open(path.join(maps_dir, 'metadata.txt'), 'a') as f:
+                            f.write(
+                                'Contrast-%s: Randomise results already found, not rerun.\n' %
+                                (name + '_' + scnd_lvl))
 
         verboseprint('Done with %s' % task)
+
+    # permutations of the whole (task, contrast, scnd_lvl) grid, heaviest
+    # first. Only this process writes metadata, as each job finishes
+    verboseprint('*** Running Randomise: %s jobs over %s processes'
+                 % (len(randomise_jobs), args.n_procs))
+    jobs_by_id = {job['id']: job for job in randomise_jobs}
+    for job_id, n_run, elapsed in run_randomise_jobs(randomise_jobs,
+                                                     args.n_procs):
+        job = jobs_by_id[job_id]
+        verboseprint('****** %s done (%.1fs)' % (job_id, elapsed))
+        with open(path.join(job['maps_dir'], 'metadata.txt'), 'a') as f:
+            f.write(
+                'Contrast-%s: Randomise run with %s permutations\n' %
+                (job['contrast'] + '_' + job['scnd_lvl'], str(n_run)))
@@ -4,16 +4,16 @@
 # In[ ]:
 import argparse
 from os import makedirs, path
-import pandas as pd
-import numpy as np
 import sys
-import json
 
-from nilearn import image
 from nistats.second_level_model import SecondLevelModel
-from utils.firstlevel_utils import get_first_level_maps, get_first_level_metas
-from utils.secondlevel_utils import create_group_mask, randomise
-from utils.utils import get_contrasts, get_flags
+from utils.covariates_table import get_covariates
+from utils.firstlevel_utils import get_first_level_maps
+from utils.group_mask import update_group_masks
+from utils.secondlevel_utils import randomise
+from utils.subject_stack import (build_subject_stack, get_stack_dir,
+                                 get_subject, write_stack_img)
+from utils.utils import get_contrasts, get_flags, run_jobs
 
 # In[ ]:
 def get_args():
@@ -25,6 +25,8 @@ def get_args():
     parser.add_argument('--rt', action='store_true')
     parser.add_argument('--beta', action='store_true')
     parser.add_argument('--n_perms', default=10000, type=int)
+    parser.add_argument('--n_procs', default=1, type=int,
+                        help='number of processes writing the 4D images')
     parser.add_argument('--mask_thresh', default=.95, type=float)
     parser.add_argument('--smoothing_fwhm', default=6)
     parser.add_argument('--quiet', '-q', action='store_true')
@@ -40,24 +42,6 @@ def get_args():
         args.n_perms = 10
     return args
 
-def extend_confounds_df(indiv_meta_files):
-    aim1_2ndlevel_confounds_path = "/scripts/aim1_2ndlevel_regressors/" +\
-                               "aim1_2ndlevel_confounds_matrix.csv"
-    full_confounds_df = pd.read_csv(aim1_2ndlevel_confounds_path,
-                                index_col='index')
-    meta_dict = {}
-    for meta_file in indiv_meta_files:
-        sub_id = meta_file.replace(first_level_dir+'/', '').split('/%s' % task)[0]
-        with open(meta_file, 'r') as f:
-            meta_dict[sub_id] = json.load(f)
-    meta_df = pd.DataFrame(meta_dict).T
-
-    extended_confounds_df = pd.concat([meta_df, full_confounds_df], axis=1, sort=True).copy()
-    # substitute in old mriqc if new is not available
-    extended_confounds_df['FD_mean'] =  extended_confounds_df['FD_mean'].combine_first(extended_confounds_df['%s_meanFD' % task])
-    return extended_confounds_df
-
-
 def get_2ndlevel_desMat(maps, task, extended_confounds_df):
     subjects = [m.split('1stlevel/')[-1].split('/')[0] for m in maps]
     rt_cols = extended_confounds_df.filter(regex='RT').columns
@@ -114,16 +98,13 @@ if __name__=='__main__':
     beta_series = args.beta
     n_perms = args.n_perms
 
-    # Create Mask
-    mask_loc = path.join(second_level_dir,
-                        'group_mask_thresh-%s.nii.gz' % str(args.mask_thresh))
-    if (not path.exists(mask_loc)) or args.rerun:
-        verboseprint('Making group mask at %s' % mask_loc)
-        group_mask = create_group_mask(fmriprep_dir, args.mask_thresh)
-        makedirs(path.dirname(mask_loc), exist_ok=True)
-        group_mask.to_filename(mask_loc)
+    # Create Mask (masks of new subjects are added to the saved counts)
+    mask_loc, = update_group_masks(fmriprep_dir, second_level_dir,
+                                   [args.mask_thresh], rebuild=args.rerun,
+                                   verbose=not args.quiet)
 
     rt_flag, beta_flag = get_flags(regress_rt, beta_series)
+    export_jobs = []
     for task in tasks:
         verboseprint('Running 2nd level for %s' % task)
 
@@ -134,11 +115,21 @@ if __name__=='__main__':
                             'secondlevel-%s_%s_maps' % (rt_flag, beta_flag))
         makedirs(maps_dir, exist_ok=True)
 
-        indiv_meta_files = get_first_level_metas('*', task,
-                                                first_level_dir,
-                                                regress_rt,
-                                                beta_series)
-        extended_confounds_df = extend_confounds_df(indiv_meta_files)
+        # subject covariates, updated with new first level metas
+        extended_confounds_df = get_covariates(first_level_dir,
+                                               second_level_dir, task,
+                                               regress_rt, beta_series,
+                                               rebuild=args.rerun)
+
+        # unsmoothed maps of every contrast, masked with the group mask
+        verboseprint('*** Stacking maps')
+        stack = build_subject_stack(first_level_dir, task,
+                                    [name for name, _ in task_contrasts],
+                                    mask_loc,
+                                    get_stack_dir(second_level_dir, task,
+                                                  regress_rt, beta_series),
+                                    regress_rt=regress_rt, beta=beta_series,
+                                    rebuild=args.rerun)
 
         # run through each contrast for all participants
         for name, contrast in task_contrasts:
@@ -163,11 +154,17 @@ if __name__=='__main__':
                                         extended_confounds_df)
             maps, _ = filter_maps_and_DM(maps, des_mat) #want to filter because that's what's going into 2ndlevels
 
-            concat_images = image.concat_imgs(maps)
-            kept_subs =  [m.split('1stlevel/')[-1].split('/')[0] for m in maps]
-            concat_images.header['descrip'] = (
-                'subjects (in order):' + ', '.join(kept_subs)
-                )
-
+            kept_subs =  [get_subject(m, first_level_dir) for m in maps]
             concat_loc = path.join(maps_dir, 'contrast-%s_concat4D-1stlevels.nii.gz' % name)
-            concat_images.to_filename(concat_loc)
+            export_jobs.append((stack.stack_dir, name, kept_subs, concat_loc))
+
+        verboseprint('Done with %s' % task)
+
+    # the 4D images of every (task, contrast), written (and compressed)
+    # over n_procs processes. They are written from the stacks, so unlike
+    # the concatenated first level maps they were before, they are float32
+    # and zero outside of the group mask
+    verboseprint('*** Writing %s 4D images over %s processes'
+                 % (len(export_jobs), args.n_procs))
+    for concat_loc in run_jobs(write_stack_img, export_jobs, args.n_procs):
+        verboseprint('****** saved %s' % concat_loc)
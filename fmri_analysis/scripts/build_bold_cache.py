@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+import argparse
+from functools import partial
+import sys
+import time
+
+from utils.bids_index import get_bids_index
+from utils.bold_cache import cache_bold
+from utils.utils import run_jobs
+
+# In[ ]:
+def get_args():
+    parser = argparse.ArgumentParser(description='Converts fmriprep BOLD runs into the float32 BOLD cache')
+    parser.add_argument('-fmriprep_dir', default=None)
+    parser.add_argument('-bold_cache_dir', default=None)
+    parser.add_argument('--subject_ids', nargs="+")
+    parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, DPX, motorSelectiveStop, rest, stopSignal, stroop, surveyMedley, twoByTwo, WATT3")
+    parser.add_argument('--space', default='MNI*')
+    parser.add_argument('--use_aroma', action='store_true')
+    parser.add_argument('--n_procs', default=16, type=int)
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--quiet', '-q', action='store_true')
+
+    if '-fmriprep_dir' in sys.argv or '-h' in sys.argv:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args([])
+        args.fmriprep_dir = '/data/derivatives/fmriprep'
+        args.bold_cache_dir = '/data/derivatives/bold_cache'
+        args.tasks = ['stroop']
+        args.use_aroma = True
+        args.n_procs = 1
+    return args
+
+def get_runs(index, subjects, tasks, space, desc):
+    """ returns the func_file of every matching run """
+    runs = []
+    for subject_id in subjects:
+        for task in tasks:
+            runs += index.get(sub=subject_id, task=task,
+                              datatype='func', space=space,
+                              desc=desc, suffix='bold',
+                              extension='.nii.gz')
+    return runs
+
+def cache_run(func_file, bold_cache_dir, overwrite=False):
+    start = time.time()
+    cache_bold(func_file, bold_cache_dir, overwrite=overwrite)
+    return func_file, time.time() - start
+
+if __name__=='__main__':
+    args = get_args()
+
+    if not args.quiet:
+        def verboseprint(*args, **kwargs):
+            print(*args, **kwargs)
+    else:
+        def verboseprint(*args, **kwards):  # do-nothing function
+            pass
+
+    index = get_bids_index(args.fmriprep_dir)
+    if args.subject_ids:
+        subjects = [s.replace('sub-', '') for s in args.subject_ids]
+    else:
+        subjects = sorted({r['sub'] for r in index.records})
+    if args.tasks is not None:
+        tasks = args.tasks
+    else:
+        tasks = ['ANT', 'CCTHot', 'discountFix',
+                 'DPX', 'motorSelectiveStop',
+                 'stopSignal', 'stroop',
+                 'twoByTwo', 'WATT3']
+    desc = 'smoothAROMAnonaggr' if args.use_aroma else 'preproc'
+
+    runs = get_runs(index, subjects, tasks, args.space, desc)
+    verboseprint('Caching %s runs in %s' % (len(runs), args.bold_cache_dir))
+    cache_unit = partial(cache_run, bold_cache_dir=args.bold_cache_dir,
+                         overwrite=args.overwrite)
+    for func_file, elapsed in run_jobs(cache_unit, runs, args.n_procs,
+                                       maxtasksperchild=1):
+        verboseprint('** cached %s (%.1fs)' % (func_file, elapsed))
@@ -0,0 +1,161 @@
+"""
+voxelwise AR(1) GLM solver
+
+Computes the same model as nistats' run_glm(noise_model='ar1'):
+
+    1. an OLS fit, whose residuals give each voxel's lag-1 autocorrelation
+    2. the autocorrelations are truncated into bins (rho = floor(bins * r)
+       / bins), as nistats does
+    3. every bin is refit on data whitened with that bin's AR(1) factor
+
+nistats builds a separate ARModel per bin through its generic regression
+classes, working in float64 throughout. Here the whitening factor of a bin
+is bidiagonal (x_t - rho * x_(t-1)), so it is applied to the data in place
+rather than as a matrix. The pseudoinverse of each bin's whitened design is
+computed once, in float64, and all of the bin's voxels go through a single
+matrix product with it. The data, and those products, are float32 by
+default. Sums of squares are accumulated in float64.
+
+The result is the dict of model statistics described in
+utils.firstlevel_store, so contrasts and stores are computed from it the
+same way as from a fitted FirstLevelModel. compare_to_nistats reports how
+far it is from run_glm on real data. Run
+
+    python -m utils.ar1_solver <bold> <mask> <design csv>
+
+from scripts/ to benchmark one run.
+"""
+import numpy as np
+import scipy.linalg as spl
+import time
+
+from utils.contrast_utils import compute_contrasts
+from utils.firstlevel_store import get_results_stats
+
+GLM_SOLVERS = ['ar1', 'nistats']
+
+
+def whiten(A, rho):
+    """ applies the AR(1) whitening factor of rho to the rows of A """
+    wA = np.array(A)
+    wA[1:] -= rho * A[:-1]
+    return wA
+
+
+def _column_ss(A, B):
+    """ column-wise sums of A * B, accumulated in float64 """
+    return np.einsum('ij,ij->j', A, B, dtype=np.float64)
+
+
+def fit_ar1(Y, X, bins=100, dtype=np.float32):
+    """
+    fits an AR(1) GLM to every voxel
+
+    Args:
+        Y: (n_scans, n_voxels) data, already mean scaled
+        X: (n_scans, n_params) design matrix
+        bins: number of autocorrelation bins, as in run_glm
+        dtype: dtype of the data products. np.float64 reproduces run_glm up
+            to rounding
+
+    Returns:
+        dict of model statistics (see utils.firstlevel_store.MODEL_ARRAYS)
+    """
+    Y = np.asarray(Y, dtype=dtype)
+    X = np.asarray(X, dtype=np.float64)
+    n_scans, n_params = X.shape
+    eps = np.abs(X).sum() * np.finfo(float).eps
+    df_resid = float(n_scans - np.linalg.matrix_rank(X, eps))
+
+    # OLS fit, kept only for the autocorrelation of its residuals
+    resid = Y - X.astype(dtype).dot(spl.pinv(X).astype(dtype).dot(Y))
+    ar1 = _column_ss(resid[1:], resid[:-1]) / _column_ss(resid, resid)
+    del resid
+    ar1 = (ar1 * bins).astype(int) * 1. / bins
+    label_values, labels = np.unique(ar1, return_inverse=True)
+
+    # sort the voxels by bin once, so each bin is a contiguous slice
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.searchsorted(labels[order], np.arange(label_values.size + 1))
+    Y = Y[:, order]
+    theta = np.zeros((n_params, Y.shape[1]))
+    dispersion = np.zeros(Y.shape[1])
+    cov = np.zeros((label_values.size, n_params, n_params))
+    for i, rho in enumerate(label_values):
+        voxels = slice(bounds[i], bounds[i + 1])
+        wX = whiten(X, rho)
+        calc_beta = spl.pinv(wX)
+        cov[i] = calc_beta.dot(calc_beta.T)
+        wY = whiten(Y[:, voxels], rho)
+        beta = calc_beta.astype(dtype).dot(wY)
+        wY -= wX.astype(dtype).dot(beta)
+        theta[:, voxels] = beta
+        dispersion[voxels] = _column_ss(wY, wY) / (n_scans - n_params)
+    # back to mask order
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(order.size)
+    return {'label_values': label_values,
+            'labels': labels,
+            'theta': theta[:, inverse],
+            'dispersion': dispersion[inverse],
+            'cov': cov,
+            'df_resid': df_resid}
+
+
+def compare_to_nistats(Y, X, bins=100, dtype=np.float32):
+    """
+    fits Y with both fit_ar1 and nistats' run_glm and returns the wall
+    time of each along with the differences between their fits: the
+    fraction of voxels put in a different bin, and the largest differences
+    in parameter estimates, residual variance and parameter z scores
+    """
+    from nistats.first_level_model import run_glm
+    start = time.time()
+    labels, results = run_glm(np.asarray(Y, dtype=np.float64), X,
+                              noise_model='ar1', bins=bins)
+    nistats_seconds = time.time() - start
+    reference = get_results_stats(labels, results)
+    start = time.time()
+    stats = fit_ar1(Y, X, bins=bins, dtype=dtype)
+    solver_seconds = time.time() - start
+
+    same_bin = (reference['label_values'][reference['labels']] ==
+                stats['label_values'][stats['labels']])
+    con_vals = np.eye(X.shape[1])
+    z_diff = np.abs(compute_contrasts(stats, con_vals) -
+                    compute_contrasts(reference, con_vals))
+    dispersion_diff = (np.abs(stats['dispersion'] - reference['dispersion'])
+                       / np.maximum(reference['dispersion'], 1e-12))
+    return {'nistats_seconds': nistats_seconds,
+            'solver_seconds': solver_seconds,
+            'speedup': nistats_seconds / solver_seconds,
+            'voxels_rebinned': 1 - same_bin.mean(),
+            'theta_max_abs_diff': np.abs(stats['theta'] -
+                                         reference['theta']).max(),
+            'dispersion_max_rel_diff': dispersion_diff.max(),
+            'z_max_abs_diff': z_diff.max(),
+            'z_max_abs_diff_same_bin': z_diff[:, same_bin].max()}
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    from utils.bold_cache import load_masked_bold
+    from utils.utils import mean_scale
+    parser = argparse.ArgumentParser(
+        description='Compare the AR(1) solver to nistats on one run. '
+                    'Run as "python -m utils.ar1_solver" from scripts/')
+    parser.add_argument('bold_file')
+    parser.add_argument('mask_file')
+    parser.add_argument('design_file', help='design csv, as exported by '
+                                            '1stlevel_analysis')
+    parser.add_argument('--bins', default=100, type=int)
+    args = parser.parse_args()
+    Y = mean_scale(load_masked_bold(args.bold_file, args.mask_file))
+    X = pd.read_csv(args.design_file, index_col=0).values
+    print('%s scans, %s voxels, %s regressors' % (Y.shape + X.shape[1:]))
+    for dtype in [np.float32, np.float64]:
+        comparison = compare_to_nistats(Y, X, bins=args.bins, dtype=dtype)
+        print('** %s' % np.dtype(dtype).name)
+        for key, value in comparison.items():
+            print('    %s: %.4g' % (key, value))
@@ -0,0 +1,171 @@
+"""
+single trial (beta series) estimation
+
+Designs built with beta=True (see firstlevel_utils.create_design) hold one
+regressor per trial. Two estimators are supported:
+
+    lsa   least squares - all: every trial is estimated in one GLM
+    lss   least squares - separate: each trial is estimated in its own GLM
+          holding that trial, the sum of all other trials and the nuisance
+          regressors
+
+LSS does not fit one GLM per trial. The nuisance regressors are projected
+out of the trial regressors once (Frisch-Waugh-Lovell), after which every
+trial's GLM reduces to a 2x2 system built from the Gram matrix of the
+projected trials and one product of the projected trials with the data.
+
+Both estimators are ordinary least squares on the mean scaled data, as in
+FirstLevelModel's signal_scaling. compare_to_ols checks them against one
+least squares fit per GLM; run
+
+    python -m utils.beta_series_utils
+
+from scripts/ to check them on a synthetic design.
+"""
+from nilearn import masking
+import numpy as np
+import pandas as pd
+import warnings
+
+from utils.bold_cache import load_masked_bold
+from utils.utils import mean_scale
+
+BETA_METHODS = ['lsa', 'lss']
+
+
+def get_trial_columns(design):
+    """ names of the single trial regressors of a design """
+    return [c for c in design.columns if c.startswith('trial_')]
+
+
+def fit_lsa(Y, design, trial_columns):
+    """
+    returns (n_trials, n_voxels) estimates of the trial regressors from a
+    single GLM of Y (n_scans, n_voxels) on the full design
+    """
+    trial_idx = [design.columns.get_loc(c) for c in trial_columns]
+    pinv_X = np.linalg.pinv(design.values)[trial_idx]
+    return pinv_X.astype(Y.dtype).dot(Y)
+
+
+def get_column_basis(N):
+    """
+    orthonormal basis of the column space of N, from its singular vectors
+    above the rank cutoff of np.linalg.matrix_rank. Unlike a QR
+    decomposition, it does not grow past col(N) when N is rank deficient
+    (e.g. duplicated or all-zero nuisance regressors)
+    """
+    if N.shape[1] == 0:
+        return np.zeros((N.shape[0], 0))
+    U, sv, _ = np.linalg.svd(N, full_matrices=False)
+    tol = sv.max() * max(N.shape) * np.finfo(sv.dtype).eps
+    return U[:, sv > tol]
+
+
+def fit_lss(Y, design, trial_columns):
+    """
+    returns (n_trials, n_voxels) LSS estimates of the trial regressors
+
+    Trial i's GLM has the regressors [x_i, s - x_i, N] where s is the sum
+    of all trials and N the nuisance regressors. With the columns of N
+    projected out, the estimate of x_i is the first element of the 2x2
+    solve of the Gram matrix of [x_i, s - x_i] against their products with
+    Y. Products with Y need no projection, since the projected regressors
+    are orthogonal to N.
+    """
+    X = design.loc[:, trial_columns].values
+    N = design.drop(columns=trial_columns).values
+    Q = get_column_basis(N)
+    X_res = X - Q.dot(Q.T.dot(X))
+    s_res = X_res.sum(axis=1)
+    # Gram matrix entries of [x_i, s - x_i] for every trial
+    xx = (X_res ** 2).sum(axis=0)
+    xs = X_res.T.dot(s_res)
+    ss = s_res.dot(s_res)
+    a = xx
+    b = xs - xx
+    c = ss - 2 * xs + xx
+    det = a * c - b ** 2
+    singular = det <= np.finfo(float).eps * np.maximum(a * c, 1)
+    if singular.any():
+        warnings.warn('%s trial regressors are collinear with the other '
+                      'trials, their estimates are set to nan'
+                      % singular.sum())
+        det[singular] = np.nan
+    # x_i'Y for every trial in one product, s'Y is their sum
+    XY = X_res.T.astype(Y.dtype).dot(Y)
+    sY = XY.sum(axis=0)
+    return (c[:, None] * XY - b[:, None] * (sY - XY)) / det[:, None]
+
+
+def estimate_beta_series(bold_file, mask_file, design, method='lss'):
+    """
+    estimates the single trial betas of one run
+
+    Returns:
+        trial_columns: names of the trial regressors
+        betas: (n_trials, n_voxels) array over the in-mask voxels
+    """
+    assert method in BETA_METHODS, \
+        'method must be one of %s' % BETA_METHODS
+    trial_columns = get_trial_columns(design)
+    Y = mean_scale(load_masked_bold(bold_file, mask_file))
+    fit = fit_lsa if method == 'lsa' else fit_lss
+    return trial_columns, fit(Y, design, trial_columns)
+
+
+def save_beta_series(betas, trial_columns, events, mask_file, filename):
+    """
+    writes the betas as a 4D image with one volume per trial, and a csv
+    alongside it listing each volume's trial, onset and duration
+    """
+    masking.unmask(betas, mask_file).to_filename(filename)
+    # trial_<n> is the events row labelled n - 1 (see
+    # events_utils.get_beta_series), wherever it is in the frame
+    labels = [int(c.split('_')[-1]) - 1 for c in trial_columns]
+    trials = pd.DataFrame({'trial': trial_columns,
+                           'onset': events.onset.loc[labels].values,
+                           'duration': events.duration.loc[labels].values})
+    trials.to_csv(filename.replace('.nii.gz', '_trials.csv'), index=False)
+
+
+def compare_to_ols(Y, design, trial_columns):
+    """
+    fits every GLM of fit_lsa and fit_lss with least squares on the
+    regressors themselves (one GLM per trial for LSS) and returns the
+    largest differences of their estimates, relative to the largest
+    least squares estimate
+    """
+    X = design.values
+    lsa = np.linalg.lstsq(X, Y, rcond=None)[0][
+        [design.columns.get_loc(c) for c in trial_columns]]
+    N = design.drop(columns=trial_columns).values
+    trials = design.loc[:, trial_columns].values
+    lss = np.array([
+        np.linalg.lstsq(np.column_stack([x, trials.sum(axis=1) - x, N]), Y,
+                        rcond=None)[0][0]
+        for x in trials.T])
+    return {'lsa_max_rel_diff': np.abs(fit_lsa(Y, design, trial_columns)
+                                       - lsa).max() / np.abs(lsa).max(),
+            'lss_max_rel_diff': np.abs(fit_lss(Y, design, trial_columns)
+                                       - lss).max() / np.abs(lss).max()}
+
+
+if __name__ == '__main__':
+    from utils.design_utils import make_first_level_design
+    random_state = np.random.RandomState(0)
+    TR, n_scans, n_trials = .68, 400, 30
+    onsets = np.sort(random_state.choice(np.arange(10, 250, 4), n_trials,
+                                         replace=False)).astype(float)
+    paradigm = pd.DataFrame({'onset': onsets, 'duration': 1.,
+                             'trial_type': ['trial_%03d' % (i + 1)
+                                            for i in range(n_trials)]})
+    confounds = pd.DataFrame(random_state.randn(n_scans, 4),
+                             columns=['c%s' % i for i in range(4)])
+    design = make_first_level_design(n_scans, TR, paradigm,
+                                     add_regs=confounds.values,
+                                     add_reg_names=list(confounds.columns))
+    trial_columns = get_trial_columns(design)
+    Y = design.values.dot(random_state.randn(design.shape[1], 200)) + \
+        random_state.randn(n_scans, 200)
+    print(compare_to_ols(Y, design, trial_columns))
@@ -0,0 +1,178 @@
+"""
+in-memory indexes of BIDS/fmriprep and first level directories
+
+Each directory is walked once, and every file's BIDS entities are parsed
+into a record. Getters then resolve files with dict lookups instead of
+running recursive globs per subject and task, which is slow on networked
+storage. The index of a BIDS directory can be snapshotted to a json file
+and reloaded in later runs.
+"""
+from collections import defaultdict
+import json
+import os
+from os import path
+
+_INDEXES = {}
+
+
+def parse_bids_filename(filename):
+    """
+    parses a BIDS filename into a dict of its entities (e.g. sub, ses, task,
+    run, space, desc) plus its suffix and extension
+    """
+    name = path.basename(filename)
+    stem, dot, extension = name.partition('.')
+    parts = stem.split('_')
+    record = {}
+    for part in parts[:-1]:
+        key, _, value = part.partition('-')
+        record[key] = value
+    if '-' in parts[-1]:
+        key, _, value = parts[-1].partition('-')
+        record[key] = value
+        record['suffix'] = None
+    else:
+        record['suffix'] = parts[-1]
+    record['extension'] = dot + extension
+    return record
+
+
+def _matches(record, key, value):
+    """ values ending in '*' match as prefixes, others must be equal """
+    found = record.get(key)
+    if value is None:
+        return True
+    if found is None:
+        return False
+    if value.endswith('*'):
+        return found.startswith(value[:-1])
+    return found == value
+
+
+class BIDSIndex():
+    """
+    index of the subject files in a BIDS (or BIDS derivatives) directory
+
+    Records hold the parsed entities of each file, its path and its
+    datatype (the name of the folder it is in, e.g. func or anat).
+    """
+    def __init__(self, root, records=None):
+        self.root = root
+        if records is None:
+            records = self._scan(root)
+        self.records = records
+        self._by_subject_task = defaultdict(list)
+        for record in records:
+            key = (record.get('sub'), record.get('task'))
+            self._by_subject_task[key].append(record)
+
+    @staticmethod
+    def _scan(root):
+        records = []
+        for entry in sorted(os.listdir(root)):
+            subject_dir = path.join(root, entry)
+            if not entry.startswith('sub-') or not path.isdir(subject_dir):
+                continue
+            for dirpath, _, filenames in os.walk(subject_dir):
+                datatype = path.basename(dirpath)
+                for filename in filenames:
+                    if not filename.startswith('sub-'):
+                        continue
+                    record = parse_bids_filename(filename)
+                    record['datatype'] = datatype
+                    record['path'] = path.join(dirpath, filename)
+                    records.append(record)
+        return records
+
+    def get(self, sub=None, task=None, **filters):
+        """
+        returns the sorted paths of files matching all of the given
+        entities. Values ending in '*' are matched as prefixes.
+        """
+        if sub is not None and task is not None:
+            candidates = self._by_subject_task[(sub, task)]
+        else:
+            candidates = [r for r in self.records
+                          if _matches(r, 'sub', sub)
+                          and _matches(r, 'task', task)]
+        return sorted(r['path'] for r in candidates
+                      if all(_matches(r, key, value)
+                             for key, value in filters.items()))
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'root': self.root, 'records': self.records}, f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            snapshot = json.load(f)
+        return cls(snapshot['root'], records=snapshot['records'])
+
+
+def get_bids_index(root, snapshot=None, refresh=False):
+    """
+    returns the (cached) index of a BIDS directory
+
+    Args:
+        root: BIDS or fmriprep directory
+        snapshot: optional json file. If it exists (and refresh is False)
+            the index is loaded from it, otherwise it is written there
+            after scanning root
+        refresh: rescan root even if an index is cached or snapshotted
+    """
+    key = path.abspath(root)
+    if key not in _INDEXES or refresh:
+        if snapshot is not None and path.exists(snapshot) and not refresh:
+            index = BIDSIndex.load(snapshot)
+        else:
+            index = BIDSIndex(root)
+            if snapshot is not None:
+                index.save(snapshot)
+        _INDEXES[key] = index
+    return _INDEXES[key]
+
+
+class FirstLevelIndex():
+    """
+    index of the outputs in a first level directory
+
+    Files directly in <subject>/<task>/ and in its maps_* directories are
+    keyed on (task, path below the task directory), so the same output can
+    be looked up for one or all subjects at once.
+    """
+    def __init__(self, first_level_dir):
+        self.root = first_level_dir
+        self._files = defaultdict(dict)
+        for subject in sorted(os.listdir(first_level_dir)):
+            subject_dir = path.join(first_level_dir, subject)
+            if not path.isdir(subject_dir):
+                continue
+            for task in os.listdir(subject_dir):
+                task_dir = path.join(subject_dir, task)
+                if not path.isdir(task_dir):
+                    continue
+                for entry in os.listdir(task_dir):
+                    entry_path = path.join(task_dir, entry)
+                    if entry.startswith('maps_') and path.isdir(entry_path):
+                        for filename in os.listdir(entry_path):
+                            key = (task, path.join(entry, filename))
+                            self._files[key][subject] = path.join(
+                                entry_path, filename)
+                    else:
+                        self._files[(task, entry)][subject] = entry_path
+
+    def get(self, subject_id, task, relpath):
+        """ sorted paths of task/relpath for one subject, or all if '*' """
+        files = self._files.get((task, relpath), {})
+        if subject_id == '*':
+            return sorted(files.values())
+        return [files[subject_id]] if subject_id in files else []
+
+
+def get_first_level_index(first_level_dir, refresh=False):
+    """ returns the (cached) index of a first level directory """
+    key = ('1stlevel', path.abspath(first_level_dir))
+    if key not in _INDEXES or refresh:
+        _INDEXES[key] = FirstLevelIndex(first_level_dir)
+    return _INDEXES[key]
@@ -0,0 +1,69 @@
+"""
+float32 cache of BOLD runs
+
+fmriprep's BOLD outputs are gzipped, so every reader decompresses the whole
+run, usually into float64. The cache holds each run once as an uncompressed
+float32 NIfTI, every voxel included, so that readers that do not mask the
+run (parcellations, physio regression) see the same data as in the gzipped
+run. nibabel memory-maps uncompressed NIfTIs, so masking or slicing a
+cached run only reads the voxels that are used.
+
+Scripts outside fmri_analysis/scripts (e.g. fmri_data_prep's) should find
+cached runs with resolve_bold, which ignores entries older than their run.
+"""
+import nibabel as nib
+import numpy as np
+import os
+from os import makedirs, path
+
+
+def get_cached_bold_file(func_file, cache_dir):
+    """ path of func_file in the cache: same name, as .float32.nii """
+    return path.join(cache_dir,
+                     path.basename(func_file).replace('.nii.gz',
+                                                      '.float32.nii'))
+
+
+def is_cached(func_file, cache_dir):
+    """ True if func_file has been cached since it was last modified """
+    cached_file = get_cached_bold_file(func_file, cache_dir)
+    return (path.exists(cached_file) and
+            path.getmtime(cached_file) >= path.getmtime(func_file))
+
+
+def cache_bold(func_file, cache_dir, overwrite=False):
+    """ writes func_file to the cache as float32. Returns the cached file """
+    cached_file = get_cached_bold_file(func_file, cache_dir)
+    if is_cached(func_file, cache_dir) and not overwrite:
+        return cached_file
+    makedirs(cache_dir, exist_ok=True)
+    img = nib.load(func_file)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    # write under a temporary name so readers never see a partial file
+    tmp_file = cached_file.replace('.nii', '.tmp.nii')
+    nib.save(nib.Nifti1Image(data, img.affine, header), tmp_file)
+    os.replace(tmp_file, cached_file)
+    return cached_file
+
+
+def resolve_bold(func_file, cache_dir=None):
+    """
+    returns the cached version of func_file when there is an up to date one
+    in cache_dir, and func_file otherwise
+    """
+    if cache_dir is not None and is_cached(func_file, cache_dir):
+        return get_cached_bold_file(func_file, cache_dir)
+    return func_file
+
+
+def load_masked_bold(bold_file, mask_file):
+    """
+    returns the (n_timepoints, n_voxels) float32 array of in-mask voxels,
+    reading only those voxels when bold_file is a cached run
+    """
+    data = np.asanyarray(nib.load(bold_file).dataobj)
+    mask = np.asarray(nib.load(mask_file).dataobj) > 0
+    return np.asarray(data[mask], dtype=np.float32).T
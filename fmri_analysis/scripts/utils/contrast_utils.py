@@ -0,0 +1,80 @@
+"""
+batched contrast computation
+
+All of a task's contrasts are evaluated together from the statistics of
+one GLM fit (see utils.firstlevel_store.get_model_stats), rather than by
+one nistats compute_contrast call per contrast.
+"""
+import numpy as np
+import patsy
+from scipy.stats import norm, t as t_dist
+
+# same numerical guards as nistats.contrasts
+DEF_TINY = 1e-50
+DEF_DOFMAX = 1e10
+
+
+def get_contrast_matrix(contrasts, design_columns):
+    """
+    parses contrast definitions into a single contrast matrix
+
+    Args:
+        contrasts: list of (name, definition) tuples, as from get_contrasts
+        design_columns: the columns of the design matrix
+
+    Returns:
+        names: names of the contrasts that could be parsed
+        con_vals: (n_contrasts, n_columns) array, one row per name
+        failed: names of contrasts that could not be parsed against the
+            design (e.g. a regressor missing for this subject)
+    """
+    design_info = patsy.DesignInfo(list(design_columns))
+    names, rows, failed = [], [], []
+    for name, contrast in contrasts:
+        try:
+            coefs = design_info.linear_constraint(contrast).coefs
+        except patsy.PatsyError:
+            failed.append(name)
+            continue
+        assert coefs.shape[0] == 1, \
+            'Contrast %s is not a t contrast' % name
+        names.append(name)
+        rows.append(coefs[0])
+    con_vals = np.array(rows).reshape(len(rows), len(design_columns))
+    return names, con_vals, failed
+
+
+def compute_contrasts(model_stats, con_vals, output_type='z_score'):
+    """
+    computes t contrasts for every row of con_vals in one pass
+
+    Args:
+        model_stats: dict of GLM statistics as from get_model_stats
+        con_vals: (n_contrasts, n_params) contrast matrix
+        output_type: 'z_score', 'stat', 'p_value', 'effect_size' or
+            'effect_variance', as in nistats
+
+    Returns:
+        (n_contrasts, n_voxels) array
+    """
+    labels = model_stats['labels']
+    theta = model_stats['theta']
+    dispersion = model_stats['dispersion']
+    cov = model_stats['cov']
+    effect = con_vals.dot(theta)
+    if output_type == 'effect_size':
+        return effect
+    # c cov c' for every contrast and AR(1) label, scaled by the residual
+    # variance of each voxel with that label
+    con_var = np.einsum('ij,ljk,ik->li', con_vals, cov, con_vals)
+    variance = con_var[labels].T * dispersion
+    if output_type == 'effect_variance':
+        return variance
+    stat = effect / np.sqrt(np.maximum(variance, DEF_TINY))
+    if output_type == 'stat':
+        return stat
+    p_value = t_dist.sf(stat, np.minimum(model_stats['df_resid'], DEF_DOFMAX))
+    if output_type == 'p_value':
+        return p_value
+    p_value = np.minimum(np.maximum(p_value, 1.e-300), 1. - 1.e-16)
+    return norm.isf(p_value)
@@ -0,0 +1,149 @@
+"""
+second level covariates table
+
+Second level designs are drawn from one table per (task, flags) of subject
+covariates: the demographics and mriqc FD of the aim1 confounds matrix,
+merged with every subject's first level 2ndlevel_meta json (RTs and
+fmriprep FD, falling back to the mriqc FD where it is missing). It is
+saved in the task's second level directory as
+
+    covariates_<rt>_<beta>.csv    the table, indexed by subject
+    covariates_<rt>_<beta>.json   fingerprint (path, size and mtime) of
+                                  the confounds matrix and of each meta
+                                  json, along with the json's contents
+
+so updating it only reads the meta jsons that are new or changed since it
+was last saved.
+"""
+import json
+import os
+from os import makedirs, path
+import pandas as pd
+import uuid
+
+from utils.firstlevel_utils import get_first_level_metas
+from utils.manifest_utils import stat_file
+from utils.subject_stack import get_subject
+from utils.utils import get_flags
+
+CONFOUNDS_FILE = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                           'aim1_2ndlevel_regressors',
+                           'aim1_2ndlevel_confounds_matrix.csv')
+
+
+def get_covariates_file(second_level_dir, task, regress_rt=False, beta=False):
+    rt_flag, beta_flag = get_flags(regress_rt, beta)
+    return path.join(second_level_dir, task,
+                     'covariates_%s_%s.csv' % (rt_flag, beta_flag))
+
+
+def merge_covariates(metas, confounds_file, task):
+    """ table of the confounds matrix merged with {subject: meta dict} """
+    full_confounds_df = pd.read_csv(confounds_file, index_col='index')
+    meta_df = pd.DataFrame(metas).T
+    covariates = pd.concat([meta_df, full_confounds_df], axis=1, sort=True)
+    # substitute in old mriqc if new is not available
+    if 'FD_mean' not in covariates:
+        covariates['FD_mean'] = float('nan')
+    covariates['FD_mean'] = covariates['FD_mean'].astype(float)\
+        .combine_first(covariates['%s_meanFD' % task])
+    return covariates
+
+
+class CovariatesTable():
+    """
+    Attributes:
+        table: DataFrame of covariates indexed by subject (None until built)
+        confounds: fingerprint of the confounds matrix the table holds
+        metas: {subject: {'fingerprint': ..., 'meta': meta dict}}
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache_file = filename.replace('.csv', '.json')
+        self.table = None
+        self.confounds = None
+        self.metas = {}
+        if path.exists(filename) and path.exists(self.cache_file):
+            self.table = pd.read_csv(filename, index_col=0)
+            self.table.index.name = None
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            self.confounds = cache['confounds']
+            self.metas = cache['metas']
+
+    def update(self, meta_files, first_level_dir, task,
+               confounds_file=CONFOUNDS_FILE, rebuild=False):
+        """
+        reads the meta jsons that are new or changed and re-merges the
+        table if anything changed. Returns the number of inputs (metas and
+        the confounds matrix) that were added, changed or removed
+        """
+        meta_files = {get_subject(f, first_level_dir): f for f in meta_files}
+        fingerprints = {subject: stat_file(f)
+                        for subject, f in meta_files.items()}
+        if rebuild:
+            self.metas = {}
+        stale = {subject: f for subject, f in meta_files.items()
+                 if self.metas.get(subject, {}).get('fingerprint')
+                 != fingerprints[subject]}
+        removed = set(self.metas) - set(meta_files)
+        confounds = stat_file(confounds_file)
+        n_changed = len(stale) + len(removed) + \
+            int(confounds != self.confounds)
+        if not n_changed and self.table is not None:
+            return 0
+        for subject, meta_file in stale.items():
+            with open(meta_file, 'r') as f:
+                self.metas[subject] = {'fingerprint': fingerprints[subject],
+                                       'meta': json.load(f)}
+        for subject in removed:
+            del self.metas[subject]
+        self.table = merge_covariates(
+            {subject: entry['meta'] for subject, entry in self.metas.items()},
+            confounds_file, task)
+        self.confounds = confounds
+        return n_changed
+
+    def save(self):
+        """ writes the table and its cache under temporary names of this
+        save (jobs of the same task may save at once) and swaps them in """
+        makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+        suffix = '.%s.tmp' % uuid.uuid4().hex
+        self.table.to_csv(self.filename + suffix)
+        with open(self.cache_file + suffix, 'w') as f:
+            json.dump({'confounds': self.confounds, 'metas': self.metas}, f)
+        os.replace(self.filename + suffix, self.filename)
+        os.replace(self.cache_file + suffix, self.cache_file)
+
+def get_covariates(first_level_dir, second_level_dir, task, regress_rt=False,
+                   beta=False, confounds_file=CONFOUNDS_FILE, rebuild=False):
+    """
+    brings the task's covariates table up to date with its first level
+    metas and returns it
+    """
+    covariates = CovariatesTable(get_covariates_file(second_level_dir, task,
+                                                     regress_rt, beta))
+    meta_files = get_first_level_metas('*', task, first_level_dir,
+                                       regress_rt, beta)
+    if covariates.update(meta_files, first_level_dir, task, confounds_file,
+                         rebuild):
+        covariates.save()
+    return covariates.table
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Update the second level covariates tables. '
+                    'Run as "python -m utils.covariates_table" from scripts/')
+    parser.add_argument('derivatives_dir')
+    parser.add_argument('--tasks', nargs='+', required=True)
+    parser.add_argument('--rt', action='store_true')
+    parser.add_argument('--beta', action='store_true')
+    parser.add_argument('--confounds_file', default=CONFOUNDS_FILE)
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+    for task in args.tasks:
+        get_covariates(path.join(args.derivatives_dir, '1stlevel'),
+                       path.join(args.derivatives_dir, '2ndlevel'), task,
+                       args.rt, args.beta, args.confounds_file, args.rebuild)
@@ -0,0 +1,174 @@
+"""
+cached design matrix construction
+
+Builds the same first level design matrices as nistats'
+make_first_level_design_matrix with a cosine drift, for frame times
+np.arange(n_scans) * TR + TR / 2 (as used by create_design). Everything
+that only depends on the run's length and the model settings is computed
+once per process and reused across subjects and tasks:
+
+    get_hrf_kernels       oversampled hrf kernels, per (hrf model, tr)
+    get_drift             cosine drift basis, per (n_scans, TR, period cut)
+    get_sampling_grid     the oversampled time grid of a run and the linear
+                          interpolation weights from it to the frame times
+
+Every condition of a paradigm is then sampled onto the grid in one array,
+convolved with each kernel by a single FFT convolution, and resampled to
+the frame times with one gather.
+"""
+from functools import lru_cache
+from nistats.design_matrix import _make_drift
+from nistats.hemodynamic_models import _hrf_kernel, _orthogonalize,\
+    _regressor_names
+from nistats.utils import full_rank
+import numpy as np
+import pandas as pd
+from scipy.signal import fftconvolve
+import warnings
+
+# number of conditions convolved together
+CONVOLUTION_BLOCK = 64
+
+
+def get_frame_times(n_scans, TR):
+    return np.arange(n_scans) * TR + TR / 2
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+@lru_cache(maxsize=None)
+def get_hrf_kernels(hrf_model, tr, oversampling=50):
+    """ the oversampled kernels of an hrf model, as nistats' _hrf_kernel """
+    return tuple(_read_only(np.asarray(h, dtype=float))
+                 for h in _hrf_kernel(hrf_model, tr, oversampling))
+
+
+@lru_cache(maxsize=None)
+def get_drift(n_scans, TR, period_cut):
+    """ cosine drift basis and its column names, as nistats' _make_drift """
+    drift, names = _make_drift('cosine', get_frame_times(n_scans, TR),
+                               period_cut=period_cut)
+    return _read_only(drift), tuple(names)
+
+
+@lru_cache(maxsize=None)
+def get_sampling_grid(n_scans, TR, oversampling=50, min_onset=-24):
+    """
+    returns the oversampled time grid of a run (as nistats'
+    _sample_condition), followed by what scipy's interp1d needs to
+    linearly interpolate from it to the frame times: the grid indices below
+    and above each frame time, the distance to the one below, and the
+    spacing between them
+    """
+    frame_times = get_frame_times(n_scans, TR)
+    n = frame_times.size
+    min_onset = float(min_onset)
+    n_hr = ((n - 1) * 1. / (frame_times.max() - frame_times.min()) *
+            (frame_times.max() * (1 + 1. / (n - 1)) - frame_times.min() -
+             min_onset) * oversampling) + 1
+    hr_frame_times = np.linspace(frame_times.min() + min_onset,
+                                 frame_times.max() * (1 + 1. / (n - 1)),
+                                 int(n_hr))
+    hi = np.clip(np.searchsorted(hr_frame_times, frame_times), 1,
+                 hr_frame_times.size - 1)
+    lo = hi - 1
+    interp = (lo, hi, frame_times - hr_frame_times[lo],
+              hr_frame_times[hi] - hr_frame_times[lo])
+    return (_read_only(hr_frame_times),) + tuple(_read_only(a)
+                                                 for a in interp)
+
+
+def sample_conditions(codes, onsets, durations, values, n_conditions,
+                      hr_frame_times):
+    """
+    oversampled boxcar regressors of every condition, as nistats'
+    _sample_condition applied to each condition
+
+    Returns:
+        (n_conditions, n_hr) array
+    """
+    tmax = hr_frame_times.size
+    t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), tmax - 1)
+    t_offset = np.minimum(np.searchsorted(hr_frame_times, onsets + durations),
+                          tmax - 1)
+    # zero durations are offset at t + 1
+    t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
+    regressors = np.zeros((n_conditions, tmax))
+    # buffered (not accumulating) updates, as in nistats
+    regressors[codes, t_onset] += values
+    regressors[codes, t_offset] -= values
+    return np.cumsum(regressors, axis=1)
+
+
+def make_first_level_design(n_scans, TR, paradigm, add_regs=None,
+                            add_reg_names=None, hrf_model='spm',
+                            period_cut=80, oversampling=50, min_onset=-24):
+    """
+    design matrix of a run, equivalent to
+
+        make_first_level_design_matrix(get_frame_times(n_scans, TR),
+                                       paradigm, hrf_model=hrf_model,
+                                       drift_model='cosine',
+                                       period_cut=period_cut,
+                                       add_regs=add_regs,
+                                       add_reg_names=add_reg_names)
+
+    Args:
+        paradigm: DataFrame with trial_type, onset, duration and (optional)
+            modulation columns, as from get_paradigm
+    """
+    frame_times = get_frame_times(n_scans, TR)
+    # nistats uses the average spacing of the frame times as the tr
+    tr = float(frame_times.max()) / (n_scans - 1)
+    hr_frame_times, lo, hi, dx, spacing = get_sampling_grid(
+        n_scans, TR, oversampling, min_onset)
+
+    conditions, codes = np.unique(np.asarray(paradigm['trial_type']),
+                                  return_inverse=True)
+    onsets = np.asarray(paradigm['onset'], dtype=float)
+    durations = np.asarray(paradigm['duration'], dtype=float)
+    if 'modulation' in paradigm.columns:
+        values = np.asarray(paradigm['modulation'], dtype=float)
+    else:
+        values = np.ones(len(onsets))
+    if (onsets < frame_times[0] + min_onset).any():
+        warnings.warn(('Some stimulus onsets are earlier than %s in the'
+                       ' experiment and are thus not considered in the model'
+                       % (frame_times[0] + min_onset)), UserWarning)
+    hr_regressors = sample_conditions(codes, onsets, durations, values,
+                                      len(conditions), hr_frame_times)
+
+    # convolve and resample to (n_kernels, n_conditions, n_scans), a block
+    # of conditions at a time to bound the size of the FFTs
+    kernels = get_hrf_kernels(hrf_model, tr, oversampling)
+    n_hr = hr_frame_times.size
+    resampled = np.zeros((len(kernels), len(conditions), n_scans))
+    for start in range(0, len(conditions), CONVOLUTION_BLOCK):
+        block = hr_regressors[start:start + CONVOLUTION_BLOCK]
+        for k, h in enumerate(kernels):
+            convolved = fftconvolve(block, h[None, :])[:, :n_hr]
+            y_lo = convolved[:, lo]
+            resampled[k, start:start + len(block)] = \
+                (convolved[:, hi] - y_lo) / spacing * dx + y_lo
+
+    columns, names = [], []
+    for i, condition in enumerate(conditions):
+        regressors = resampled[:, i, :].T
+        if len(kernels) > 1:
+            regressors = _orthogonalize(regressors)
+        columns.append(regressors)
+        names += _regressor_names(condition, hrf_model)
+    if add_regs is not None:
+        columns.append(np.asarray(add_regs, dtype=float))
+        names += list(add_reg_names)
+    drift, drift_names = get_drift(n_scans, TR, period_cut)
+    columns.append(drift)
+    names += list(drift_names)
+    if len(np.unique(names)) != len(names):
+        raise ValueError('Design matrix columns do not have unique names')
+
+    matrix, _ = full_rank(np.hstack(columns))
+    return pd.DataFrame(matrix, columns=names, index=frame_times)
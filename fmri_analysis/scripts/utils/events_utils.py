@@ -38,18 +38,24 @@ def get_ev_vars(output_dict, events_df, condition_spec,
     durations = output_dict['durations']
     onsets = output_dict['onsets']
 
-    demean = lambda x: x  # if not demeaning, just return the list
+    demean = lambda x: x  # if not demeaning, just return the array
     if demean_amp:
         demean = lambda x: x - np.mean(x)  # otherwise, actually demean
 
+    def as_column(values, df, demean_values=lambda x: x):
+        # constants are broadcast to one value per onset; columns, series
+        # and lists are read as float arrays
+        if np.issubdtype(type(values), np.number):
+            return np.full(len(df), values, dtype=float)
+        if type(values) == str:
+            values = df.loc[:, values]
+        elif type(values) == pd.core.series.Series:
+            values = values[df.index]
+        return demean_values(np.asarray(values, dtype=float))
+
     # if subset is specified as a string, use to query
     if subset is not None:
         events_df = events_df.query(subset)
-    # if given a series, subset and convert to list
-    if type(duration) == pd.core.series.Series:
-        duration = duration[events_df.index].tolist()
-    if type(amplitude) == pd.core.series.Series:
-        amplitude = amplitude[events_df.index].tolist()
 
     # if a column is specified, group by the values in that column
     if type(condition_spec) == list:
@@ -64,31 +70,15 @@ def get_ev_vars(output_dict, events_df, condition_spec,
             if len(c_dfs) != 0:
                 c_df = pd.concat(c_dfs)
                 conditions.append(condition_name)
-                onsets.append(c_df.loc[:, onset_column].tolist())
-                if np.issubdtype(type(amplitude), np.number):  # don't demean a constant
-                    amplitudes.append([amplitude]*len(onsets[-1]))
-                elif type(amplitude) == str:
-                    amplitudes.append(demean(c_df.loc[:, amplitude]).tolist())
-                if np.issubdtype(type(duration), np.number):
-                    durations.append([duration]*len(onsets[-1]))
-                elif type(duration) == str:
-                    durations.append(c_df.loc[:, duration].tolist())
+                onsets.append(c_df.loc[:, onset_column].values.astype(float))
+                amplitudes.append(as_column(amplitude, c_df, demean))
+                durations.append(as_column(duration, c_df))
     elif type(condition_spec) == str:
         group_df = events_df
         conditions.append(condition_spec)
-        onsets.append(group_df.loc[:, onset_column].tolist())
-        if np.issubdtype(type(amplitude), np.number):  # don't to demean a constant
-            amplitudes.append([amplitude]*len(onsets[-1]))
-        elif type(amplitude) == str:
-            amplitudes.append(demean(group_df.loc[:, amplitude]).tolist())
-        elif type(amplitude) == list:
-            amplitudes.append(demean(amplitude).tolist())
-        if np.issubdtype(type(duration), np.number):
-            durations.append([duration]*len(onsets[-1]))
-        elif type(duration) == str:
-            durations.append(group_df.loc[:, duration].tolist())
-        elif type(duration) == list:
-            durations.append(duration)
+        onsets.append(group_df.loc[:, onset_column].values.astype(float))
+        amplitudes.append(as_column(amplitude, group_df, demean))
+        durations.append(as_column(duration, group_df))
 
     # ensure that each column added is all numeric
     for attr in [durations, amplitudes, onsets]:
@@ -96,6 +86,32 @@ def get_ev_vars(output_dict, events_df, condition_spec,
         assert pd.isnull(attr[-1]).sum() == 0
 
 
+def get_ev_columns(EV_dict):
+    """ flattens an EV_dict into columnar arrays
+
+    Returns:
+        conditions: the condition names of EV_dict
+        codes: index into conditions of each event
+        onsets, durations, amplitudes: float arrays with one value per event.
+            Durations and amplitudes given as a single value for a condition
+            are repeated for each of its onsets
+    """
+    conditions = list(EV_dict['conditions'])
+    counts = np.array([len(o) for o in EV_dict['onsets']], dtype=int)
+
+    def flatten(values):
+        values = [np.asarray(v, dtype=float) for v in values]
+        values = [np.repeat(v, n) if v.size == 1 and n > 1 else v
+                  for v, n in zip(values, counts)]
+        if len(values) == 0:
+            return np.zeros(0)
+        return np.concatenate(values)
+
+    codes = np.repeat(np.arange(len(conditions)), counts)
+    return (conditions, codes, flatten(EV_dict['onsets']),
+            flatten(EV_dict['durations']), flatten(EV_dict['amplitudes']))
+
+
 # specific task functions
 def get_ANT_EVs(events_df, regress_rt=True, return_metadict=False):
     output_dict = {
@@ -782,20 +798,23 @@ def get_WATT3_EVs(events_df, regress_rt=True, return_metadict=False):
         return output_dict
 
 
-# DEPRECATED
 def get_beta_series(events_df, regress_rt=True, return_metadict=False):
+    """ one regressor per non-junk trial, named trial_<events row, from 1>,
+    plus the junk and (optionally) response time nuisance regressors
+    """
     output_dict = {
         'conditions': [],
         'onsets': [],
         'durations': [],
         'amplitudes': []
         }
-    for i, row in events_df.iterrows():
-        if row.junk is False:
-            output_dict['conditions'].append('trial_%s' % str(i+1).zfill(3))
-            output_dict['onsets'].append([row.onset])
-            output_dict['durations'].append([row.duration])
-            output_dict['amplitudes'].append([1])
+    trials = events_df.loc[events_df.junk == False]
+    output_dict['conditions'] = ['trial_%s' % str(i+1).zfill(3)
+                                 for i in trials.index]
+    output_dict['onsets'] = list(trials.onset.values.astype(float)[:, None])
+    output_dict['durations'] = list(
+        trials.duration.values.astype(float)[:, None])
+    output_dict['amplitudes'] = list(np.ones((len(trials), 1)))
     # nuisance regressors
     get_ev_vars(output_dict, events_df,
                 condition_spec=[(True, 'junk')],
@@ -807,7 +826,10 @@ def get_beta_series(events_df, regress_rt=True, return_metadict=False):
                     duration='duration',
                     amplitude='response_time',
                     subset='junk==False')
-    return output_dict
+    if return_metadict:
+        return(output_dict, {})
+    else:
+        return output_dict
 
 
 # How to model RT
@@ -828,7 +850,7 @@ def parse_EVs(events_df, task, regress_rt=True, return_metadict=False):
         'stroop': get_stroop_EVs,
         'twoByTwo': get_twoByTwo_EVs,
         'WATT3': get_WATT3_EVs,
-        # DEPRECATED 'beta' covers generic conversion of events_df into trial design file
+        # 'beta' covers generic conversion of events_df into trial design file
         'beta': get_beta_series,
     }
     return func_map[task](events_df,
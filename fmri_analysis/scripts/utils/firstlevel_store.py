@@ -0,0 +1,206 @@
+"""
+on-disk store for first level objects
+
+A first level object is saved as a directory holding separate artifacts,
+so that reading one part of it never touches the others:
+
+    metadata.json   ID, func/mask files, contrasts, model settings, meta
+    design.csv      design matrix
+    events.csv      parsed events
+    model/          statistics of the fitted GLM, as memory-mappable .npy
+        label_values.npy  AR(1) label of each model fit      (K,)
+        labels.npy        index into label_values per voxel  (V,)
+        theta.npy         parameter estimates                (P, V)
+        dispersion.npy    residual variance                  (V,)
+        cov.npy           normalized covariance per label    (K, P, P)
+
+Only the statistics needed to compute contrasts are kept; the residuals
+and whitened data held by nistats' results are dropped.
+"""
+from glob import glob
+import json
+import numpy as np
+import os
+from os import makedirs, path
+import pandas as pd
+import pickle
+import shutil
+
+from utils.utils import get_flags
+
+MODEL_ARRAYS = ['label_values', 'labels', 'theta', 'dispersion', 'cov']
+
+
+def get_model_stats(fit_model):
+    """
+    collects the statistics of a fitted nistats FirstLevelModel into a dict
+    of arrays (see MODEL_ARRAYS) plus the residual degrees of freedom
+    """
+    return get_results_stats(fit_model.labels_[0], fit_model.results_[0])
+
+
+def get_results_stats(labels, results):
+    """ as get_model_stats, from the labels and results of nistats run_glm """
+    label_values = np.array(sorted(results.keys()))
+    n_params = results[label_values[0]].theta.shape[0]
+    theta = np.zeros((n_params, labels.size))
+    dispersion = np.zeros(labels.size)
+    cov = np.zeros((label_values.size, n_params, n_params))
+    for i, label in enumerate(label_values):
+        label_mask = labels == label
+        theta[:, label_mask] = results[label].theta
+        dispersion[label_mask] = results[label].dispersion
+        cov[i] = results[label].cov
+    return {'label_values': label_values,
+            'labels': np.searchsorted(label_values, labels),
+            'theta': theta,
+            'dispersion': dispersion,
+            'cov': cov,
+            'df_resid': float(results[label_values[0]].df_resid)}
+
+
+def write_first_level_store(subjinfo, directory, model_stats=None):
+    """
+    writes subjinfo to a store directory. If model_stats is not given they
+    are collected from subjinfo.fit_model, when it has been fit.
+    """
+    if model_stats is None and subjinfo.fit_model is not None:
+        model_stats = get_model_stats(subjinfo.fit_model)
+    # write into a temporary directory and swap it in, so an interrupted
+    # save never leaves a partial store behind
+    tmp_directory = directory + '.tmp'
+    if path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    makedirs(tmp_directory)
+    subjinfo.design.to_csv(path.join(tmp_directory, 'design.csv'))
+    subjinfo.events.to_csv(path.join(tmp_directory, 'events.csv'))
+    metadata = {'ID': subjinfo.ID,
+                'func': subjinfo.func,
+                'mask': subjinfo.mask,
+                'contrasts': subjinfo.contrasts,
+                'model_settings': subjinfo.model_settings,
+                'meta': getattr(subjinfo, 'meta', {}),
+                'df_resid': None}
+    if model_stats is not None:
+        model_dir = path.join(tmp_directory, 'model')
+        makedirs(model_dir)
+        for key in MODEL_ARRAYS:
+            np.save(path.join(model_dir, '%s.npy' % key), model_stats[key])
+        metadata['df_resid'] = model_stats['df_resid']
+    with open(path.join(tmp_directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    if path.exists(directory):
+        shutil.rmtree(directory)
+    shutil.move(tmp_directory, directory)
+
+
+class FirstLevelStore():
+    """
+    lazily loaded first level object
+
+    Exposes the same attributes as FirstLevel. Only metadata.json is read
+    on construction; the design, events and model statistics are read the
+    first time they are accessed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(path.join(directory, 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+        self.ID = metadata['ID']
+        self.func = metadata['func']
+        self.mask = metadata['mask']
+        self.contrasts = [tuple(c) for c in metadata['contrasts']]
+        self.model_settings = metadata['model_settings']
+        self.meta = metadata['meta']
+        self.df_resid = metadata['df_resid']
+        self.fit_model = None
+        self._design = None
+        self._events = None
+        self._model_stats = None
+
+    @property
+    def design(self):
+        if self._design is None:
+            self._design = pd.read_csv(path.join(self.directory,
+                                                 'design.csv'),
+                                       index_col=0,
+                                       float_precision='round_trip')
+        return self._design
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = pd.read_csv(path.join(self.directory,
+                                                 'events.csv'),
+                                       index_col=0)
+        return self._events
+
+    def has_model(self):
+        return self.df_resid is not None
+
+    @property
+    def model_stats(self):
+        """ model statistics, memory-mapped from the store """
+        if self._model_stats is None:
+            if not self.has_model():
+                raise ValueError('%s was saved without a fitted model'
+                                 % self.ID)
+            model_dir = path.join(self.directory, 'model')
+            self._model_stats = {
+                key: np.load(path.join(model_dir, '%s.npy' % key),
+                             mmap_mode='r')
+                for key in MODEL_ARRAYS}
+            self._model_stats['df_resid'] = self.df_resid
+        return self._model_stats
+
+    def get_flags(self):
+        rt_flag, beta_flag = get_flags(self.model_settings['regress_rt'],
+                                       self.model_settings['beta'])
+        return '%s_%s' % (rt_flag, beta_flag)
+
+    def __str__(self):
+        return """
+            ** %s **
+                * Func File: %s
+                * Mask File: %s
+                * Model Settings: %s
+            """ % (self.ID, self.func, self.mask, self.model_settings)
+
+
+def get_store_dir(pkl_file):
+    """ store directory corresponding to a legacy firstlevel pickle """
+    return pkl_file[:-len('.pkl')]
+
+
+def convert_pickle(pkl_file, remove=False):
+    """ converts a legacy pickled FirstLevel object into a store """
+    with open(pkl_file, 'rb') as f:
+        subjinfo = pickle.load(f)
+    directory = get_store_dir(pkl_file)
+    write_first_level_store(subjinfo, directory)
+    if remove:
+        os.remove(pkl_file)
+    return directory
+
+
+def convert_pickles(first_level_dir, remove=False, verbose=True):
+    """ converts every firstlevel pickle found in first_level_dir """
+    pkl_files = sorted(glob(path.join(first_level_dir, '*', '*',
+                                      'firstlevel_*.pkl')))
+    for pkl_file in pkl_files:
+        if verbose:
+            print('converting %s' % pkl_file)
+        convert_pickle(pkl_file, remove=remove)
+    return pkl_files
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert pickled first level objects into stores. '
+                    'Run as "python -m utils.firstlevel_store" from scripts/')
+    parser.add_argument('first_level_dir')
+    parser.add_argument('--remove', action='store_true',
+                        help='delete each pickle after converting it')
+    args = parser.parse_args()
+    convert_pickles(args.first_level_dir, remove=args.remove)
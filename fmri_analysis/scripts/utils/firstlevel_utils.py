@@ -1,16 +1,32 @@
 from collections import namedtuple
+from copy import deepcopy
+from functools import partial
 from glob import glob
-from nistats.design_matrix import make_first_level_design_matrix
+import gzip
+from nilearn import image, masking
+from nistats.first_level_model import FirstLevelModel
 import numpy as np
-import os
 import json
-from os import makedirs, path
+from os import makedirs, path, walk
 import pandas as pd
-import patsy
 import pickle
+import re
+import shutil
+import time
 import warnings
-from utils.events_utils import get_beta_series, parse_EVs
-from utils.utils import get_contrasts, get_flags
+from utils.ar1_solver import fit_ar1
+from utils.beta_series_utils import estimate_beta_series, save_beta_series
+from utils.bids_index import get_bids_index, get_first_level_index,\
+    parse_bids_filename
+from utils.bold_cache import cache_bold, load_masked_bold
+from utils.contrast_utils import compute_contrasts, get_contrast_matrix
+from utils.design_utils import make_first_level_design
+from utils.events_utils import get_beta_series, get_ev_columns, parse_EVs
+from utils.firstlevel_store import FirstLevelStore, get_model_stats,\
+    get_store_dir, write_first_level_store
+from utils.manifest_utils import get_code_hash
+from utils.utils import get_contrasts, get_flags, hash_file, hash_strings,\
+    mean_scale, run_jobs, split_n_procs
 
 # ********************************************************
 # helper functions
@@ -35,24 +51,23 @@ def save_new_EVs(events, subjinfo, output_dir, beta=True, regress_rt=False):
     flags = subjinfo.get_flags()
     filename = path.join(directory, 'simplified_events_%s.csv' % flags)
     makedirs(directory, exist_ok=True)
+    write_new_EVs(events, task, filename, beta=beta, regress_rt=regress_rt)
 
+
+def write_new_EVs(events, task, filename, beta=True, regress_rt=False):
     if beta:
         EV_dict = get_beta_series(events, regress_rt=regress_rt)
     else:
         EV_dict = parse_EVs(events, task, regress_rt=regress_rt)
 
-    event_df = pd.DataFrame.from_dict(EV_dict)  # change to dataframe
-
-    s = event_df.iloc[0, :]  # convert first regressor into data frame
-    out_event_df = pd.DataFrame.from_dict(dict(zip(s.index, s.values)))
-
-    # append remaining regressor df's to first regressor's df
-    for ridx in range(1, len(event_df)):
-        s = event_df.iloc[ridx, :]
-        tmp_df = pd.DataFrame.from_dict(dict(zip(s.index, s.values)))
-        out_event_df = pd.concat([out_event_df, tmp_df])
-
-    out_event_df = out_event_df.sort_values(by=['onsets', 'conditions'])
+    conditions, codes, onsets, durations, amplitudes = get_ev_columns(EV_dict)
+    out_event_df = pd.DataFrame({'conditions': np.array(conditions,
+                                                        dtype=object)[codes],
+                                 'onsets': onsets,
+                                 'durations': durations,
+                                 'amplitudes': amplitudes})
+    out_event_df = out_event_df.sort_values(by=['onsets', 'conditions'],
+                                            kind='mergesort')
     out_event_df.to_csv(filename, index=False)
 
 
@@ -61,8 +76,15 @@ def create_design(events, confounds, task, TR, subject_id,
     """
     takes event file and confounds, and creates EV_dict, which is passed
     to make_first_level_design to create a the design matrix.
+
+    With beta, each non-junk trial gets its own regressor (see
+    get_beta_series) and the meta_dict comes from the task's own EVs.
     """
     if beta:
+        # parsing the task EVs modifies the events, so use a copy
+        _, meta_dict = parse_EVs(events.copy(), task,
+                                 regress_rt=regress_rt,
+                                 return_metadict=True)
         EV_dict = get_beta_series(events, regress_rt=regress_rt)
     else:
         EV_dict, meta_dict = parse_EVs(events, task,
@@ -72,16 +94,17 @@ def create_design(events, confounds, task, TR, subject_id,
     paradigm = get_paradigm(EV_dict)
     # make design
     n_scans = int(confounds.shape[0])
-    design = make_first_level_design_matrix(
-        np.arange(n_scans)*TR+TR/2,
+    design = make_first_level_design(
+        n_scans, TR,
         paradigm,
         hrf_model='spm',
         period_cut=80,
-        drift_model='cosine',
         add_regs=confounds.values,
         add_reg_names=list(confounds.columns))
-    # add temporal derivative to task columns
-    task_cols = [i for i in paradigm.trial_type.unique() if i != 'junk']
+    # add temporal derivative to task columns. Single trial regressors get
+    # none, which would double the number of trial parameters
+    task_cols = [i for i in paradigm.trial_type.unique()
+                 if i != 'junk' and not i.startswith('trial_')]
     temp_deriv(design, task_cols)
     return (design, meta_dict)
 
@@ -101,38 +124,125 @@ def add_FD_meta(meta_dict, subject_id, task, mriqc_dir):
     return meta_dict
 
 
+def get_design_key(events_file, confounds_file, task, TR, code_hash=None,
+                   **flags):
+    """
+    content address of a design: changes whenever the events or confounds
+    files, the TR, any of the flags used to build the design or the code
+    that builds it (see utils.manifest_utils.get_code_hash) change
+    """
+    if code_hash is None:
+        code_hash = get_code_hash()
+    settings = json.dumps(dict(task=task, TR=TR, **flags), sort_keys=True)
+    return hash_strings(hash_file(events_file),
+                        hash_file(confounds_file),
+                        settings,
+                        code_hash)
+
+
+def get_design_cache_dir(cache_dir, key):
+    return path.join(cache_dir, key[:2], key)
+
+
+def load_cached_design(cache_dir, key):
+    """
+    returns (design, events, meta_dict, simplified events file) from the
+    design cache, or None if the design has not been cached
+    """
+    directory = get_design_cache_dir(cache_dir, key)
+    meta_file = path.join(directory, 'meta.json')
+    if not path.exists(meta_file):
+        return None
+    design = pd.read_csv(path.join(directory, 'design.csv'), index_col=0,
+                         float_precision='round_trip')
+    events = pd.read_csv(path.join(directory, 'events.csv'), index_col=0)
+    with open(meta_file, 'r') as f:
+        meta_dict = json.load(f)
+    return (design, events, meta_dict,
+            path.join(directory, 'simplified_events.csv'))
+
+
+def cache_design(cache_dir, key, design, events, meta_dict, raw_events,
+                 task, beta=False, regress_rt=False):
+    """
+    writes the outputs of the design phase to the design cache and returns
+    the cached simplified events file. meta.json is written last, marking
+    the entry as complete.
+    """
+    directory = get_design_cache_dir(cache_dir, key)
+    makedirs(directory, exist_ok=True)
+    design.to_csv(path.join(directory, 'design.csv'))
+    events.to_csv(path.join(directory, 'events.csv'))
+    simplified_events_file = path.join(directory, 'simplified_events.csv')
+    write_new_EVs(raw_events, task, simplified_events_file,
+                  beta=beta, regress_rt=regress_rt)
+    with open(path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta_dict, f)
+    return simplified_events_file
+
+
 def make_first_level_obj(subject_id, task,
                          fmriprep_dir, data_dir, output_dir,
                          TR,
                          regress_rt=False,
                          beta=False,
                          a_comp_cor=True,
-                         use_aroma=False):
+                         use_aroma=False,
+                         design_cache_dir=None,
+                         code_hash=None):
     """
     retrieves and passes func_file, mask_file, events, confounds, design,
     and contrasts to FirstLevel class and returns subjinfo object,
     prints error if no func or mask file
+
+    This is the design phase of the first level pipeline. Designs are
+    cached in design_cache_dir (default: output_dir/design_cache) keyed on
+    the contents of the events and confounds files, the TR, the flags and
+    the design code, so rebuilding a subjinfo whose inputs have not changed
+    only reads the cached design. The mriqc FD metadata is not cached, it
+    is read again for every subjinfo.
     """
     func_file, mask_file = get_func_file(fmriprep_dir, subject_id, task,
                                          use_aroma=use_aroma)
     if func_file is None or mask_file is None:
         print("Missing MRI files for %s: %s" % (subject_id, task))
         return None
-    events = get_events(data_dir, subject_id, task)
-    if events is None:
+    events_file = get_events_file(data_dir, subject_id, task)
+    if events_file is None:
         print("Missing event files for %s: %s" % (subject_id, task))
         return None
-    confounds = get_confounds(fmriprep_dir, subject_id, task,
-                              a_comp_cor=a_comp_cor,
-                              use_aroma=use_aroma)
+    confounds_file = get_confounds_file(fmriprep_dir, subject_id, task)
     contrasts = get_contrasts(task, regress_rt)
-    design, meta_des_dict = create_design(events, confounds, task, TR, subject_id,
-                                          beta=beta, regress_rt=regress_rt)
+
+    if design_cache_dir is None:
+        design_cache_dir = path.join(output_dir, 'design_cache')
+    key = get_design_key(events_file, confounds_file, task, TR,
+                         regress_rt=regress_rt, beta=beta,
+                         code_hash=code_hash, a_comp_cor=a_comp_cor,
+                         use_aroma=use_aroma)
+    cached = load_cached_design(design_cache_dir, key)
+    if cached is not None:
+        design, events, meta_dict, simplified_events_file = cached
+    else:
+        events = pd.read_csv(events_file, sep='\t')
+        # parsing the EVs modifies the events, keep a copy for the
+        # simplified events
+        raw_events = events.copy()
+        confounds = get_confounds(fmriprep_dir, subject_id, task,
+                                  a_comp_cor=a_comp_cor,
+                                  use_aroma=use_aroma)
+        design, meta_dict = create_design(events, confounds, task, TR,
+                                          subject_id, beta=beta,
+                                          regress_rt=regress_rt)
+        simplified_events_file = cache_design(design_cache_dir, key, design,
+                                              events, meta_dict, raw_events,
+                                              task, beta=beta,
+                                              regress_rt=regress_rt)
     # add on FD info to meta_dict
     assert fmriprep_dir[-1] != '/'
     deriv_base = path.dirname(fmriprep_dir)
     assert 'fmriprep' not in deriv_base
-    meta_dict = add_FD_meta(meta_des_dict,
+    meta_dict = add_FD_meta(meta_dict,
                             subject_id,
                             task,
                             path.join(deriv_base, 'mriqc'))
@@ -144,74 +254,209 @@ def make_first_level_obj(subject_id, task,
     subjinfo.model_settings['beta'] = beta
     subjinfo.model_settings['regress_rt'] = regress_rt
 
-    events = get_events(data_dir, subject_id, task)
-    save_new_EVs(events, subjinfo, output_dir,
-                 beta=beta, regress_rt=regress_rt)
+    directory = subjinfo._get_export_dir(output_dir)
+    shutil.copyfile(simplified_events_file,
+                    path.join(directory, 'simplified_events_%s.csv'
+                              % subjinfo.get_flags()))
     return subjinfo
 
 
-def save_first_level_obj(subjinfo, output_dir, save_maps=False):
+def save_first_level_obj(subjinfo, output_dir, save_maps=False,
+                         model_stats=None):
     """
     Gets or Creates a directory for saving the first level analyses,
     will also save contrast maps if flagged to do so.
+
+    model_stats are taken from subjinfo.fit_model unless given (e.g. from
+    utils.ar1_solver.fit_ar1)
     """
     subj, task = subjinfo.ID.split('_')
     directory = path.join(output_dir, subj, task)
     flags = subjinfo.get_flags()
-    filename = path.join(directory, 'firstlevel_%s.pkl' % flags)
     makedirs(directory, exist_ok=True)
-    with open(filename, 'wb') as f:
-        pickle.dump(subjinfo, f)
+    if model_stats is None and subjinfo.fit_model is not None:
+        model_stats = get_model_stats(subjinfo.fit_model)
+    write_first_level_store(subjinfo,
+                            path.join(directory, 'firstlevel_%s' % flags),
+                            model_stats=model_stats)
     if save_maps:
         maps_dir = path.join(directory, 'maps_%s' % flags)
         makedirs(maps_dir, exist_ok=True)
-        for name, contrast in subjinfo.contrasts:
-            try:
-                contrast_map = subjinfo.fit_model.compute_contrast(contrast)
-                contrast_file = path.join(maps_dir,
-                                          'contrast-%s.nii.gz' % name)
-                contrast_map.to_filename(contrast_file)
-            except patsy.PatsyError:
-                warnings.warn('Contrast: %s failed for %s, %s' %
-                              (name, subj, task))
+        # evaluate all contrasts in one pass and write maps from the stack
+        names, con_vals, failed = get_contrast_matrix(subjinfo.contrasts,
+                                                      subjinfo.design.columns)
+        for name in failed:
+            warnings.warn('Contrast: %s failed for %s, %s' %
+                          (name, subj, task))
+        if len(names) == 0:
+            return
+        z_maps = compute_contrasts(model_stats, con_vals)
+        if subjinfo.fit_model is not None:
+            contrast_maps = subjinfo.fit_model.masker_.inverse_transform(
+                z_maps)
+        else:
+            contrast_maps = masking.unmask(z_maps, subjinfo.mask)
+        for i, name in enumerate(names):
+            contrast_file = path.join(maps_dir, 'contrast-%s.nii.gz' % name)
+            image.index_img(contrast_maps, i).to_filename(contrast_file)
+
+
+def fit_first_level_obj(subjinfo, output_dir, TR,
+                        design_matrix_only=False, n_jobs=1,
+                        bold_cache_dir=None, beta_method='lss',
+                        glm_solver='nistats'):
+    """
+    Fits the GLM for one subjinfo and saves all of its outputs.
+
+    Runs in a worker process when 1stlevel_analysis is given more than one
+    proc, so the fitted model is saved here rather than returned. Returns
+    the subjinfo ID and the wall time of the fit and save in seconds.
+
+    If bold_cache_dir is given, the BOLD run is fit from the float32 cache
+    (see utils.bold_cache), converting it first if needed.
+
+    Beta series subjinfos (model_settings['beta']) are not fit with
+    FirstLevelModel. Their single trial betas are estimated with
+    beta_method ('lsa' or 'lss', see utils.beta_series_utils) and saved as
+    a 4D image, betaseries_<method>_<flags>.nii.gz.
+
+    glm_solver selects how the task model is fit: 'nistats' uses
+    FirstLevelModel, 'ar1' the float32 solver in utils.ar1_solver, which
+    fits the same AR(1) model.
+    """
+    start = time.time()
+    beta = subjinfo.model_settings['beta']
+    model_stats = None
+    if not design_matrix_only:
+        func = subjinfo.func
+        if bold_cache_dir is not None:
+            func = cache_bold(func, bold_cache_dir)
+        if beta:
+            trial_columns, betas = estimate_beta_series(func, subjinfo.mask,
+                                                        subjinfo.design,
+                                                        method=beta_method)
+            directory = subjinfo._get_export_dir(output_dir)
+            save_beta_series(betas, trial_columns, subjinfo.events,
+                             subjinfo.mask,
+                             path.join(directory, 'betaseries_%s_%s.nii.gz'
+                                       % (beta_method, subjinfo.get_flags())))
+        elif glm_solver == 'ar1':
+            Y = mean_scale(load_masked_bold(func, subjinfo.mask))
+            model_stats = fit_ar1(Y, subjinfo.design.values)
+        else:
+            fmri_glm = FirstLevelModel(TR,
+                                       subject_label=subjinfo.ID,
+                                       mask=subjinfo.mask,
+                                       noise_model='ar1',
+                                       standardize=False,
+                                       hrf_model='spm',
+                                       drift_model='cosine',
+                                       period_cut=80,
+                                       n_jobs=n_jobs
+                                       )
+            out = fmri_glm.fit(func, design_matrices=subjinfo.design)
+            subjinfo.fit_model = out
+    subjinfo.export_design(output_dir)
+    subjinfo.export_events(output_dir)
+    subjinfo.export_2ndlvl_meta(output_dir)
+    save_first_level_obj(subjinfo, output_dir,
+                         save_maps=(not design_matrix_only and not beta),
+                         model_stats=model_stats)
+    return subjinfo.ID, time.time() - start
+
+
+def _read_output(filename):
+    """ contents of an output file, uncompressed if it is gzipped """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        return f.read()
+
+
+def compare_serial_to_parallel(subjinfos, output_dir, TR, n_procs,
+                               **fit_kwargs):
+    """
+    fits subjinfos with fit_first_level_obj twice, one at a time in this
+    process into output_dir/serial and scheduled over n_procs as in
+    1stlevel_analysis into output_dir/parallel, and returns the outputs
+    (relative paths) that are missing from either or differ between them.
+
+    Gzipped outputs are compared uncompressed, as their headers hold the
+    time they were written
+    """
+    serial_dir = path.join(output_dir, 'serial')
+    parallel_dir = path.join(output_dir, 'parallel')
+    for directory in [serial_dir, parallel_dir]:
+        if path.exists(directory):
+            shutil.rmtree(directory)
+    for subjinfo in deepcopy(subjinfos):
+        fit_first_level_obj(subjinfo, serial_dir, TR, n_jobs=1, **fit_kwargs)
+    n_workers, n_jobs = split_n_procs(n_procs, len(subjinfos))
+    fit_unit = partial(fit_first_level_obj, output_dir=parallel_dir, TR=TR,
+                       n_jobs=n_jobs, **fit_kwargs)
+    for _ in run_jobs(fit_unit, deepcopy(subjinfos), n_workers,
+                      maxtasksperchild=1):
+        pass
+
+    outputs = {}
+    for directory in [serial_dir, parallel_dir]:
+        outputs[directory] = set(
+            path.relpath(path.join(root, f), directory)
+            for root, _, files in walk(directory) for f in files)
+    differing = outputs[serial_dir] ^ outputs[parallel_dir]
+    for f in outputs[serial_dir] & outputs[parallel_dir]:
+        if (_read_output(path.join(serial_dir, f)) !=
+                _read_output(path.join(parallel_dir, f))):
+            differing.add(f)
+    return sorted(differing)
 
 
 def get_first_level_objs(subject_id, task, first_level_dir,
                          regress_rt=False, beta=False):
-    """ gets and returns filepath to first level objects if they exist"""
+    """
+    gets and returns filepath to first level objects if they exist
+
+    Stores are returned, along with legacy pickles that have no store
+    (see utils.firstlevel_store.convert_pickles)
+    """
 
     rt_flag, beta_flag = get_flags(regress_rt, beta)
-    files = path.join(first_level_dir, subject_id, task,
-                      'firstlevel*%s_%s*pkl' % (rt_flag, beta_flag))
-    return glob(files)
+    files = glob(path.join(first_level_dir, subject_id, task,
+                           'firstlevel_%s_%s' % (rt_flag, beta_flag)))
+    pkl_files = glob(path.join(first_level_dir, subject_id, task,
+                               'firstlevel*%s_%s*pkl' % (rt_flag, beta_flag)))
+    files += [f for f in pkl_files if not path.isdir(get_store_dir(f))]
+    return files
+
+
+def load_first_level_obj(filename):
+    """ lazily loads a first level store, or unpickles a legacy pickle """
+    if filename.endswith('.pkl'):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    return FirstLevelStore(filename)
 
 
 def load_first_level_objs(task, first_level_dir,
                           regress_rt=False, beta=False):
-    subjinfos = []
     files = get_first_level_objs('*', task, first_level_dir,
                                  regress_rt=regress_rt, beta=beta)
-    for filey in files:
-        with open(filey, 'rb') as f:
-            subjinfos.append(pickle.load(f))
-    return subjinfos
+    return [load_first_level_obj(filey) for filey in files]
 
 
 def get_first_level_maps(subject_id, task, first_level_dir, contrast,
                          regress_rt=False, beta=False):
     rt_flag, beta_flag = get_flags(regress_rt, beta)
-    files = path.join(
-        first_level_dir, subject_id, task,
-        'maps_%s_%s/contrast-%s.nii.gz' % (rt_flag, beta_flag, contrast))
-    return sorted(glob(files))
+    return get_first_level_index(first_level_dir).get(
+        subject_id, task,
+        path.join('maps_%s_%s' % (rt_flag, beta_flag),
+                  'contrast-%s.nii.gz' % contrast))
 
 def get_first_level_metas(subject_id, task, first_level_dir,
                          regress_rt=False, beta=False):
     rt_flag, beta_flag = get_flags(regress_rt, beta)
-    files = path.join(
-        first_level_dir, subject_id, task,
+    return get_first_level_index(first_level_dir).get(
+        subject_id, task,
         '2ndlevel_meta_%s_%s.json' % (rt_flag, beta_flag))
-    return sorted(glob(files))
 
 # ********************************************************
 # helper classes
@@ -290,40 +535,47 @@ def process_confounds(confounds_file, a_comp_cor=True, use_aroma=False):
     regressors to use
     ['X','Y','Z','RotX','RotY','RotY','<-firsttemporalderivative','stdDVARs','FD']
     junk regressor: errors, ommissions, maybe very fast RTs (less than 50 ms)
-    """
-    confounds_df = pd.read_csv(confounds_file, sep='\t',
-                               na_values=['n/a']).fillna(0)
-    # excessive movement regressors
-    excessive_movement = (confounds_df.framewise_displacement > .5) | \
-                         (confounds_df.std_dvars > 1.2)
-    excessive_movement_TRs = excessive_movement[excessive_movement].index
-    excessive_movement_regressors = np.zeros([confounds_df.shape[0],
-                                             np.sum(excessive_movement)])
-    for i, TR in enumerate(excessive_movement_TRs):
-        excessive_movement_regressors[TR, i] = 1
-    excessive_movement_regressor_names = ['rejectTR_%d' % TR for TR in
-                                          excessive_movement_TRs]
 
+    Only the columns used below are read from the (wide) fmriprep confounds
+    file. Returns a float64 (n_TRs, n_regressors) array and its names.
+    """
     # base regressors - csf/white matter if aroma, trans/rot otherwise
+    base_regex = re.compile('csf|white_matter' if use_aroma else 'trans|rot')
+
+    def use_column(column):
+        return (column in ('framewise_displacement', 'std_dvars') or
+                base_regex.search(column) is not None or
+                (a_comp_cor and 'a_comp_cor' in column))
+    confounds_df = pd.read_csv(confounds_file, sep='\t',
+                               na_values=['n/a'],
+                               usecols=use_column).fillna(0)
+    base_regressor_names = [i for i in confounds_df.columns
+                            if base_regex.search(i) is not None]
     if use_aroma:
-        base_regressor_df = confounds_df.filter(regex='csf|white_matter').copy()
-        del base_regressor_df['csf_wm']
-        base_regressor_names = list(base_regressor_df.columns)
-        base_regressors = base_regressor_df.values
-    else:
-        base_regressor_df = confounds_df.filter(regex='trans|rot').copy()
-        base_regressor_names = list(base_regressor_df.columns)
-        base_regressors = base_regressor_df.values
+        base_regressor_names.remove('csf_wm')
 
     # add additional relevant regressors
     add_regressor_names = []  # ['framewise_displacement']
     if a_comp_cor:
         add_regressor_names += [i for i in confounds_df.columns if
                                 'a_comp_cor' in i][:8]
-    additional_regressors = confounds_df.loc[:, add_regressor_names].values
-    regressors = np.hstack((base_regressors,
-                            additional_regressors,
-                            excessive_movement_regressors))
+
+    # excessive movement regressors, one spike column per flagged TR
+    excessive_movement = (confounds_df.framewise_displacement > .5) | \
+                         (confounds_df.std_dvars > 1.2)
+    excessive_movement_TRs = np.flatnonzero(excessive_movement.values)
+    excessive_movement_regressor_names = ['rejectTR_%d' % TR for TR in
+                                          excessive_movement_TRs]
+
+    # fill one preallocated block: base, additional, then spike regressors
+    n_columns = len(base_regressor_names) + len(add_regressor_names)
+    regressors = np.zeros((confounds_df.shape[0],
+                           n_columns + len(excessive_movement_TRs)),
+                          dtype=np.float64)
+    regressors[:, :n_columns] = confounds_df.loc[
+        :, base_regressor_names + add_regressor_names].values
+    regressors[excessive_movement_TRs,
+               n_columns + np.arange(len(excessive_movement_TRs))] = 1
     # concatenate regressor names
     regressor_names = base_regressor_names +\
         add_regressor_names +\
@@ -346,127 +598,75 @@ def get_func_file(fmriprep_dir, subject_id, task, use_aroma=False):
     """
     # strip "sub" from beginning of subject_id if provided
     subject_id = subject_id.replace('sub-', '')
+    index = get_bids_index(fmriprep_dir)
 
-    if use_aroma:
-        func_regex = '*%s*MNI*smoothAROMAnonaggr_bold.nii.gz' % task
-    else:
-        func_regex = '*%s*MNI*preproc_bold.nii.gz' % task
-
-    # check if there's a session folder
-    if os.path.exists(path.join(fmriprep_dir,
-                                'sub-%s' % subject_id,
-                                'func')):
-        func_file = glob(path.join(fmriprep_dir,
-                                   'sub-%s' % subject_id,
-                                   'func',
-                                   func_regex))
-        mask_file = glob(path.join(fmriprep_dir,
-                                   'sub-%s' % subject_id,
-                                   'func',
-                                   '*%s*MNI*brain_mask.nii.gz' % task))
-    else:
-        func_file = glob(path.join(fmriprep_dir,
-                                   'sub-%s' % subject_id,
-                                   '*',
-                                   'func',
-                                   func_regex))
-        mask_file = glob(path.join(fmriprep_dir,
-                                   'sub-%s' % subject_id,
-                                   '*', 'func',
-                                   '*%s*MNI*brain_mask.nii.gz' % task))
+    desc = 'smoothAROMAnonaggr' if use_aroma else 'preproc'
+    func_file = index.get(sub=subject_id, task=task, datatype='func',
+                          space='MNI*', desc=desc, suffix='bold',
+                          extension='.nii.gz')
+    mask_file = []
     if func_file:
         print(func_file)
+        # prefer the mask in the same space as the func file
+        space = parse_bids_filename(func_file[0])['space']
+        mask_file = index.get(sub=subject_id, task=task, datatype='func',
+                              space=space, desc='brain', suffix='mask',
+                              extension='.nii.gz')
+    if not mask_file:
+        mask_file = index.get(sub=subject_id, task=task, datatype='func',
+                              space='MNI*', desc='brain', suffix='mask',
+                              extension='.nii.gz')
 
     if not func_file or not mask_file:
         return None, None
     return func_file[0], mask_file[0]
 
 
-def get_confounds(fmriprep_dir, subject_id, task, **process_kwargs):
+def get_confounds_file(fmriprep_dir, subject_id, task):
     # strip "sub" from beginning of subject_id if provided
     subject_id = subject_id.replace('sub-', '')
 
     # Get the Confounds File (output of fmriprep)
-    # Read the TSV file and convert to pandas dataframe
+    confounds_file = get_bids_index(fmriprep_dir).get(
+        sub=subject_id, task=task, datatype='func',
+        desc='confounds', suffix='timeseries', extension='.tsv')
+    return confounds_file[0]
 
-    # check if there's a session folder
-    if os.path.exists(path.join(fmriprep_dir,
-                                'sub-%s' % subject_id,
-                                'func')):
-        # gets confounds_file
-        confounds_file = glob(path.join(fmriprep_dir,
-                                        'sub-%s' % subject_id,
-                                        'func',
-                                        '*%s*confounds_timeseries.tsv' % task
-                                        )
-                              )[0]
-    else:
-        confounds_file = glob(path.join(fmriprep_dir,
-                                        'sub-%s' % subject_id,
-                                        '*',
-                                        'func',
-                                        '*%s*confounds_timeseries.tsv' % task
-                                        )
-                              )[0]
 
+def get_confounds(fmriprep_dir, subject_id, task, **process_kwargs):
+    # Read the TSV file and convert to pandas dataframe
+    confounds_file = get_confounds_file(fmriprep_dir, subject_id, task)
     regressors, regressor_names = process_confounds(confounds_file,
                                                     **process_kwargs)
     confounds = pd.DataFrame(regressors, columns=regressor_names)
     return confounds
 
 
-def get_events(data_dir, subject_id, task):
+def get_events_file(data_dir, subject_id, task):
     # Get the Events File if it exists
-    # Read the TSV file and convert to pandas dataframe
+    event_file = get_bids_index(data_dir).get(
+        sub=subject_id, task=task, datatype='func',
+        suffix='events', extension='.tsv')
+    if not event_file:
+        return None
+    return event_file[0]
 
-    # check if there's a ses-* folder
-    try:
-        if os.path.exists(path.join(data_dir,
-                                    'sub-%s' % subject_id,
-                                    'func')):
-
-            # returns event_file
-            event_file = glob(path.join(data_dir,
-                                        'sub-%s' % subject_id,
-                                        'func',
-                                        'sub-*%s*events.tsv' % task))[0]
-        else:
-            event_file = glob(path.join(data_dir,
-                                        'sub-%s' % subject_id,
-                                        '*',
-                                        'func',
-                                        'sub-*%s*events.tsv' % task))[0]
-        events_df = pd.read_csv(event_file, sep='\t')
-        return events_df
-    except IndexError:
+
+def get_events(data_dir, subject_id, task):
+    # Read the TSV file and convert to pandas dataframe
+    event_file = get_events_file(data_dir, subject_id, task)
+    if event_file is None:
         return None
+    return pd.read_csv(event_file, sep='\t')
 
 
 def get_paradigm(EV_dict):
     # convert nipype format to nistats paradigm
-    conditions = []
-    onsets = []
-    amplitudes = []
-    durations = []
-    for i in range(len(EV_dict['conditions'])):
-        onset = EV_dict['onsets'][i]
-        onsets += onset
-        # add on conditions
-        conditions += [EV_dict['conditions'][i]]*len(onset)
-        duration = EV_dict['durations'][i]
-        # add on duration, and extend if the array has a length of one
-        if len(duration) == 1 and len(onset) > 1:
-            duration *= len(onset)
-        durations += duration
-        # add on amplitude, and extend if the array has a length of one
-        amplitude = EV_dict['amplitudes'][i]
-        if len(amplitude) == 1 and len(onset) > 1:
-            amplitude *= len(onset)
-        amplitudes += amplitude
-    paradigm = {'trial_type': conditions,
+    conditions, codes, onsets, durations, amplitudes = get_ev_columns(EV_dict)
+    paradigm = {'trial_type': np.array(conditions, dtype=object)[codes],
                 'onset': onsets,
                 'modulation': amplitudes,
                 'duration': durations}
     paradigm = pd.DataFrame(paradigm).sort_values(
-        by='onset').reset_index(drop=True)
+        by='onset', kind='mergesort').reset_index(drop=True)
     return paradigm
@@ -0,0 +1,198 @@
+"""
+incremental group brain mask
+
+The group mask keeps the voxels that are in at least a given fraction of
+the fmriprep brain masks. Rather than averaging every mask into a float64
+image, MaskCounts keeps a uint16 count of the masks each voxel is in,
+along with the masks that were counted (path, size and mtime). The counts
+are saved to an .npz file, so adding subjects only reads their new masks,
+and masks at any number of thresholds are cut from the same counts.
+
+Masks are read by a pool of threads (reading is mostly gzip and disk),
+a bounded number at a time, and summed in the calling thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import nibabel as nib
+import numpy as np
+import os
+from os import makedirs, path
+import uuid
+
+from utils.bids_index import get_bids_index
+from utils.manifest_utils import stat_file
+
+COUNTS_NAME = 'group_mask_counts.npz'
+MAX_COUNT = np.iinfo(np.uint16).max
+
+
+def get_brainmasks(fmriprep_dir):
+    """ fmriprep's MNI brain masks of every run """
+    return get_bids_index(fmriprep_dir).get(
+        datatype='func', space='MNI152NLin2009cAsym', desc='brain',
+        suffix='mask', extension='.nii.gz')
+
+
+def get_group_mask_file(second_level_dir, threshold):
+    return path.join(second_level_dir,
+                     'group_mask_thresh-%s.nii.gz' % str(threshold))
+
+
+def _get_tmp_file(filename):
+    """
+    a name no other job will write to, next to filename and with its
+    extension, to write filename under before it is swapped in
+    """
+    directory, name = path.split(filename)
+    return path.join(directory, 'tmp-%s-%s' % (uuid.uuid4().hex, name))
+
+
+def _read_mask(mask_file):
+    img = nib.load(mask_file)
+    return np.asanyarray(img.dataobj) > 0, img.affine
+
+
+class MaskCounts():
+    """
+    number of brain masks each voxel is in
+
+    Attributes:
+        counts: uint16 array in the masks' voxel grid (None until a mask is
+            added)
+        affine: affine of the masks
+        masks: dict of counted mask file -> stat_file fingerprint
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.counts = None
+        self.affine = None
+        self.masks = {}
+        if filename is not None and path.exists(filename):
+            with np.load(filename) as saved:
+                self.counts = saved['counts']
+                self.affine = saved['affine']
+                self.masks = json.loads(str(saved['masks']))
+
+    @property
+    def n_masks(self):
+        return len(self.masks)
+
+    def reset(self):
+        self.counts, self.affine, self.masks = None, None, {}
+
+    def get_stale(self, mask_files):
+        """
+        returns the masks in mask_files that are not counted yet, and
+        whether any counted mask has changed or is no longer in mask_files
+        (its contribution can not be taken back out of the counts)
+        """
+        fingerprints = {f: stat_file(f) for f in mask_files}
+        changed = any(fingerprints.get(f) != fingerprint
+                      for f, fingerprint in self.masks.items())
+        new = [f for f in mask_files if f not in self.masks]
+        return new, changed
+
+    def add(self, mask_files, n_threads=8):
+        """ counts each of mask_files, reading n_threads at a time """
+        if self.n_masks + len(mask_files) > MAX_COUNT:
+            raise ValueError('more than %s masks can not be counted in '
+                             'uint16' % MAX_COUNT)
+        chunk_size = 2 * n_threads
+        with ThreadPoolExecutor(n_threads) as executor:
+            for start in range(0, len(mask_files), chunk_size):
+                chunk = mask_files[start:start + chunk_size]
+                for mask_file, (data, affine) in zip(
+                        chunk, executor.map(_read_mask, chunk)):
+                    if self.counts is None:
+                        self.counts = np.zeros(data.shape, dtype=np.uint16)
+                        self.affine = affine
+                    if data.shape != self.counts.shape or \
+                            not np.allclose(affine, self.affine):
+                        raise ValueError('%s is not in the voxel grid of '
+                                         'the other masks' % mask_file)
+                    self.counts += data
+                    self.masks[mask_file] = stat_file(mask_file)
+
+    def update(self, mask_files, n_threads=8, rebuild=False):
+        """
+        brings the counts up to date with mask_files: new masks are added,
+        and the counts are rebuilt if a counted mask changed or was removed.
+        Returns the number of masks read
+        """
+        new, changed = self.get_stale(mask_files)
+        if rebuild or changed:
+            self.reset()
+            new = list(mask_files)
+        self.add(new, n_threads)
+        return len(new)
+
+    def get_mask(self, threshold):
+        """ mask of the voxels in at least a threshold fraction of masks """
+        if self.counts is None:
+            raise ValueError('no masks have been counted')
+        mean = self.counts / self.n_masks
+        return nib.Nifti1Image((mean >= threshold).astype(np.uint8),
+                               self.affine)
+
+    def save(self, filename=None):
+        """
+        writes the counts under a temporary name of their own and swaps them
+        in, so jobs saving the same counts at once never mix their writes
+        """
+        filename = self.filename if filename is None else filename
+        makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+        tmp_filename = _get_tmp_file(filename)
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, counts=self.counts, affine=self.affine,
+                     masks=json.dumps(self.masks, sort_keys=True))
+        os.replace(tmp_filename, filename)
+
+
+def update_group_masks(fmriprep_dir, second_level_dir, thresholds,
+                       n_threads=8, rebuild=False, verbose=True):
+    """
+    updates the mask counts in second_level_dir with fmriprep_dir's brain
+    masks and writes a group mask per threshold (see get_group_mask_file).
+    Masks are only rewritten when the counts change or they do not exist.
+
+    Returns:
+        list of the group mask files, in the order of thresholds
+    """
+    mask_counts = MaskCounts(path.join(second_level_dir, COUNTS_NAME))
+    brainmasks = get_brainmasks(fmriprep_dir)
+    if verbose:
+        print("%s maps found at %s, %s already counted"
+              % (len(brainmasks), fmriprep_dir, mask_counts.n_masks))
+    n_read = mask_counts.update(brainmasks, n_threads, rebuild)
+    if n_read:
+        if verbose:
+            print('Counted %s masks' % n_read)
+        mask_counts.save()
+    mask_files = []
+    for threshold in thresholds:
+        mask_file = get_group_mask_file(second_level_dir, threshold)
+        if n_read or not path.exists(mask_file):
+            if verbose:
+                print('Writing group mask at %s' % mask_file)
+            # swapped in, as other jobs may be reading or writing it
+            tmp_file = _get_tmp_file(mask_file)
+            mask_counts.get_mask(threshold).to_filename(tmp_file)
+            os.replace(tmp_file, mask_file)
+        mask_files.append(mask_file)
+    return mask_files
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Count fmriprep brain masks and write group masks. '
+                    'Run as "python -m utils.group_mask" from scripts/')
+    parser.add_argument('fmriprep_dir')
+    parser.add_argument('second_level_dir')
+    parser.add_argument('--thresholds', nargs='+', default=[.95], type=float)
+    parser.add_argument('--n_threads', default=8, type=int)
+    parser.add_argument('--rebuild', action='store_true',
+                        help='recount every mask')
+    args = parser.parse_args()
+    update_group_masks(args.fmriprep_dir, args.second_level_dir,
+                       args.thresholds, args.n_threads, args.rebuild)
@@ -0,0 +1,93 @@
+"""
+batched second level OLS
+
+The second level fits the same OLS model as SecondLevelModel (nistats'
+run_glm with noise_model='ols') to every first level contrast of a task.
+The group design only depends on which subjects have a map of the
+contrast, so contrasts are grouped by their subjects. Each group's design
+is pseudo-inverted once. Every second level effect (the intercept and the
+RT covariates) of a contrast is then computed from one fit, with
+utils.contrast_utils.compute_contrasts, rather than one SecondLevelModel
+fit per contrast and effect.
+"""
+from collections import OrderedDict
+import numpy as np
+import scipy.linalg as spl
+
+from utils.contrast_utils import compute_contrasts
+
+
+class GroupOLS():
+    """ OLS fits of data sharing a design matrix X (n_maps, n_params) """
+    def __init__(self, X):
+        self.X = np.asarray(X, dtype=np.float64)
+        n, p = self.X.shape
+        self.pinv_X = spl.pinv(self.X)
+        eps = np.abs(self.X).sum() * np.finfo(float).eps
+        self.df_resid = float(n - np.linalg.matrix_rank(self.X, eps))
+        self.cov = self.pinv_X.dot(self.pinv_X.T)
+
+    def fit(self, Y):
+        """
+        returns the model statistics (see utils.firstlevel_store) of the
+        fit of Y (n_maps, n_voxels)
+        """
+        Y = np.asarray(Y, dtype=np.float64)
+        n, p = self.X.shape
+        theta = self.pinv_X.dot(Y)
+        resid = Y - self.X.dot(theta)
+        return {'label_values': np.zeros(1),
+                'labels': np.zeros(Y.shape[1], dtype=int),
+                'theta': theta,
+                'dispersion': np.einsum('ij,ij->j', resid, resid) / (n - p),
+                'cov': self.cov[None],
+                'df_resid': self.df_resid}
+
+
+def get_effect_matrix(design_columns, effects):
+    """
+    returns the effects that are columns of the design, and the contrast
+    matrix selecting each of them
+    """
+    columns = list(design_columns)
+    found = [e for e in effects if e in columns]
+    con_vals = np.zeros((len(found), len(columns)))
+    for i, effect in enumerate(found):
+        con_vals[i, columns.index(effect)] = 1
+    return found, con_vals
+
+
+def compute_group_maps(designs, get_data, effects, output_type='z_score'):
+    """
+    fits every contrast's second level and computes each of its effects
+
+    Args:
+        designs: {contrast: second level design (DataFrame indexed by
+            subject)}
+        get_data: function of (contrast, subjects) returning the
+            (n_subjects, n_voxels) maps, e.g. SubjectStack.get
+        effects: design columns to compute, e.g. ['intercept']
+        output_type: as in compute_contrasts
+
+    Yields:
+        (contrast, data, {effect: (n_voxels,) map}) for every contrast.
+        Effects missing from a design are skipped; an effect missing from
+        every design raises a ValueError
+    """
+    columns = set(c for des_mat in designs.values() for c in des_mat.columns)
+    missing = [e for e in effects if e not in columns]
+    if len(designs) > 0 and len(missing) > 0:
+        raise ValueError('effects %s are not in any second level design'
+                         % missing)
+    groups = OrderedDict()
+    for contrast, des_mat in designs.items():
+        key = (tuple(des_mat.index), tuple(des_mat.columns))
+        groups.setdefault(key, []).append(contrast)
+    for (subjects, columns), contrasts in groups.items():
+        des_mat = designs[contrasts[0]]
+        model = GroupOLS(des_mat.values)
+        found, con_vals = get_effect_matrix(columns, effects)
+        for contrast in contrasts:
+            data = get_data(contrast, list(subjects))
+            maps = compute_contrasts(model.fit(data), con_vals, output_type)
+            yield contrast, data, OrderedDict(zip(found, maps))
@@ -0,0 +1,155 @@
+"""
+manifest of first level outputs and the inputs they were computed from
+
+Every (subject, task, flags) unit written by 1stlevel_analysis has an entry
+in <first level dir>/firstlevel_manifest_<task>_<flags>.json holding the
+fingerprint of its inputs:
+
+    events, confounds   sha1 of the file contents
+    func, mask          path, size and mtime (BOLD runs are too large to
+                        hash on every run)
+    settings            the settings the outputs depend on
+    code                sha1 of the modules that build and fit the model
+
+A unit is recomputed when any part of its fingerprint changes, e.g. after
+transfer_events.py regenerates an events file.
+"""
+import json
+import os
+from os import path
+import uuid
+
+from utils.utils import hash_file, hash_strings
+
+MANIFEST_NAME = 'firstlevel_manifest.json'
+# modules whose changes alter first level outputs
+CODE_FILES = ['ar1_solver.py', 'beta_series_utils.py', 'contrast_utils.py',
+              'design_utils.py', 'events_utils.py', 'firstlevel_store.py',
+              'firstlevel_utils.py', 'utils.py']
+
+
+def get_code_hash(code_files=CODE_FILES):
+    """ sha1 over the contents of code_files, modules of utils """
+    utils_dir = path.dirname(path.abspath(__file__))
+    return hash_strings(*[hash_file(path.join(utils_dir, f))
+                          for f in code_files])
+
+
+def stat_file(filename):
+    """ cheap fingerprint of a large file: its path, size and mtime """
+    stat = os.stat(filename)
+    return '%s:%d:%d' % (filename, stat.st_size, int(stat.st_mtime))
+
+
+def get_unit_fingerprint(func_file, mask_file, events_file, confounds_file,
+                         settings, code_hash=None):
+    """
+    returns the fingerprint of one unit's inputs
+
+    Args:
+        settings: dict of json serializable settings (TR, flags, ...)
+        code_hash: result of get_code_hash, computed if not given
+    """
+    if code_hash is None:
+        code_hash = get_code_hash()
+    return {'events': hash_file(events_file),
+            'confounds': hash_file(confounds_file),
+            'func': stat_file(func_file),
+            'mask': stat_file(mask_file),
+            'settings': json.loads(json.dumps(settings, sort_keys=True)),
+            'code': code_hash}
+
+
+class Manifest():
+    """
+    fingerprints of outputs keyed on unit names, stored in one json file.
+
+    Several processes may share a manifest. save() re-reads the file and
+    merges in only the entries this process updated, so it never drops
+    entries that other processes wrote since this one loaded it. It writes
+    under a temporary name of its own and swaps that in
+    """
+    def __init__(self, filename, fallback_entries=None):
+        self.filename = filename
+        self.entries = self._read() if path.exists(filename) \
+            else dict(fallback_entries or {})
+        self.updated = {}
+
+    def _read(self):
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+
+    def get_changes(self, key, fingerprint):
+        """
+        returns the names of the fingerprint fields that differ from the
+        manifest entry, or None if the unit has no entry
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return sorted(field for field in fingerprint
+                      if entry.get(field) != fingerprint[field])
+
+    def update(self, key, fingerprint):
+        self.entries[key] = fingerprint
+        self.updated[key] = fingerprint
+
+    def save(self):
+        if not self.updated and path.exists(self.filename):
+            return
+        os.makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+        if path.exists(self.filename):
+            self.entries = dict(self._read(), **self.updated)
+        tmp_filename = '%s.%s.tmp' % (self.filename, uuid.uuid4().hex)
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+
+
+class FirstLevelManifest():
+    """
+    fingerprints of the first level outputs in a directory, keyed on
+    "<subject>/<task>/<flags>". Entries are kept in one manifest per task
+    and flags, firstlevel_manifest_<task>_<flags>.json, matching the jobs
+    run_1stlevel_analysis.sh submits at once. Entries of the earlier single
+    firstlevel_manifest.json seed a manifest that does not exist yet
+    """
+    def __init__(self, first_level_dir):
+        self.first_level_dir = first_level_dir
+        self.manifests = {}
+        self._legacy_entries = None
+
+    @staticmethod
+    def get_key(subject_id, task, flags):
+        return '%s/%s/%s' % (subject_id, task, flags)
+
+    def get_manifest(self, key):
+        """ the Manifest holding key's task and flags """
+        _, task, flags = key.split('/')
+        if (task, flags) not in self.manifests:
+            filename = path.join(self.first_level_dir,
+                                 MANIFEST_NAME.replace('.json', '_%s_%s.json'
+                                                       % (task, flags)))
+            self.manifests[(task, flags)] = Manifest(
+                filename, {k: v for k, v in self.get_legacy_entries().items()
+                           if k.split('/')[1:] == [task, flags]})
+        return self.manifests[(task, flags)]
+
+    def get_legacy_entries(self):
+        if self._legacy_entries is None:
+            legacy_file = path.join(self.first_level_dir, MANIFEST_NAME)
+            self._legacy_entries = {}
+            if path.exists(legacy_file):
+                with open(legacy_file, 'r') as f:
+                    self._legacy_entries = json.load(f)
+        return self._legacy_entries
+
+    def get_changes(self, key, fingerprint):
+        return self.get_manifest(key).get_changes(key, fingerprint)
+
+    def update(self, key, fingerprint):
+        self.get_manifest(key).update(key, fingerprint)
+
+    def save(self):
+        for manifest in self.manifests.values():
+            manifest.save()
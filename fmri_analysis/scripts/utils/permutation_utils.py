@@ -0,0 +1,480 @@
+"""
+in-process permutation inference with TFCE
+
+Replaces the FSL randomise call of the second level for the models it is
+run with here:
+
+    intercept     one sample test of the group mean: F test of the mean,
+                  inference by sign flipping the maps (randomise -1)
+    covariates    T contrasts of one regressor of the group design, with
+                  the other regressors as nuisance: Freedman-Lane
+                  permutation of the residuals of the nuisance model
+                  (randomise's default for such designs)
+
+Statistics use variance smoothing as randomise -v: the residual variance
+is smoothed within the mask with a gaussian of the given sigma (mm) before
+it divides the effect.
+
+Every permutation (or sign flip) of the data is a left multiplication of
+the data by a matrix, so the effects and residual sums of squares of a
+batch of permutations are one matrix product of the stacked permuted
+projection rows with the data, rather than a refit per permutation.
+
+TFCE follows Smith & Nichols (2009) with randomise's defaults: E = 0.5,
+H = 2, 26-connectivity and 100 steps of the unpermuted statistic's
+maximum. Clusters are not relabelled from scratch at every height; the
+voxels above a height are added in decreasing order, and only the new
+voxels and the clusters they touch are merged, on the graph of in-mask
+neighbours. The family-wise corrected p values come from the maximum TFCE
+of every permutation, the unpermuted data included.
+
+Permutations are split into chunks run by worker processes, which inherit
+the data of the test from the parent process.
+
+compare_to_reference checks the statistics against least squares refits
+of the permuted data and tfce against a relabelling of the clusters with
+scipy.ndimage.label at every height. Run
+
+    python -m utils.permutation_utils
+
+from scripts/ to check them on synthetic data (and see
+secondlevel_utils.compare_to_randomise_fsl).
+"""
+from itertools import permutations, product
+from math import factorial
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import gaussian_filter, label
+from scipy.sparse.csgraph import connected_components
+
+from utils.utils import run_jobs
+
+TFCE_E = .5
+TFCE_H = 2
+TFCE_STEPS = 100
+# permutations per job sent to a worker
+CHUNK_SIZE = 100
+# bound on the size of a batch's permuted products, in bytes
+BATCH_BYTES = 2**28
+
+# test run by the workers, set before they are forked
+_TEST = None
+
+
+# ********************************************************
+# TFCE
+# ********************************************************
+
+def get_neighbors(mask):
+    """
+    returns, for every in-mask voxel (in mask order), the mask indices of
+    its 26 neighbors, -1 where a neighbor is outside of the mask
+    """
+    index = -np.ones(np.array(mask.shape) + 2, dtype=np.int64)
+    coords = np.nonzero(mask)
+    index[tuple(c + 1 for c in coords)] = np.arange(coords[0].size)
+    offsets = [o for o in product((-1, 0, 1), repeat=3) if o != (0, 0, 0)]
+    neighbors = np.empty((coords[0].size, len(offsets)), dtype=np.int64)
+    for k, offset in enumerate(offsets):
+        neighbors[:, k] = index[tuple(c + 1 + o
+                                      for c, o in zip(coords, offset))]
+    return neighbors
+
+
+def tfce(stat, neighbors, dh, E=TFCE_E, H=TFCE_H):
+    """
+    threshold free cluster enhancement of the positive part of stat
+
+    Args:
+        stat: (n_voxels,) statistic over the in-mask voxels
+        neighbors: result of get_neighbors for the mask
+        dh: height step. Heights dh, 2 * dh, ... up to the maximum of stat
+            are integrated
+
+    Returns:
+        (n_voxels,) sum over heights h <= stat of cluster size ** E *
+        h ** H * dh, where clusters are the 26-connected components of the
+        voxels with stat >= h
+    """
+    steps = np.floor(stat / dh).astype(np.int64)
+    enhanced = np.zeros(stat.size)
+    n_steps = steps.max() if stat.size else 0
+    if n_steps < 1:
+        return enhanced
+    # active voxels ordered by the height they leave the clusters at, so
+    # the voxels above any height are a prefix of the order
+    n_active = np.count_nonzero(steps >= 1)
+    order = np.argsort(-steps, kind='mergesort')[:n_active]
+    position = -np.ones(stat.size + 1, dtype=np.int64)
+    position[order] = np.arange(n_active)
+    sorted_neighbors = position[neighbors[order]]
+    ends = np.searchsorted(-steps[order], -np.arange(n_steps, 0, -1),
+                           side='right')
+
+    comp = np.empty(n_active, dtype=np.int32)
+    sizes = np.zeros(0)
+    sorted_enhanced = np.zeros(n_active)
+    start = 0
+    for j, end in zip(range(n_steps, 0, -1), ends):
+        if end > start:
+            # the previous clusters and the new voxels are the nodes of a
+            # graph whose edges are the new voxels' active neighbors
+            n_comp = sizes.size
+            comp[start:end] = n_comp + np.arange(end - start)
+            block = sorted_neighbors[start:end]
+            valid = (block >= 0) & (block < end)
+            src = comp[np.repeat(np.arange(start, end), valid.sum(1))]
+            dst = comp[block[valid]]
+            n_nodes = n_comp + end - start
+            graph = sparse.coo_matrix(
+                (np.ones(src.size, dtype=bool), (src, dst)),
+                shape=(n_nodes, n_nodes))
+            n_comp, labels = connected_components(graph, directed=False)
+            sizes = np.bincount(
+                labels, weights=np.concatenate([sizes,
+                                                np.ones(end - start)]),
+                minlength=n_comp)
+            comp[:end] = labels[comp[:end]]
+            start = end
+        sorted_enhanced[:end] += (sizes ** E * (j * dh) ** H * dh)[comp[:end]]
+    enhanced[order] = sorted_enhanced
+    return enhanced
+
+
+# ********************************************************
+# Permutations
+# ********************************************************
+
+def get_sign_flips(n, n_perms, random_state):
+    """
+    (n_perms, n) sign flips, the first of them the identity. All 2 ** n
+    flips are returned if there are no more than n_perms
+    """
+    if 2 ** n <= n_perms:
+        return np.array(list(product((1, -1), repeat=n)), dtype=float)
+    flips = random_state.choice([-1., 1.], size=(n_perms, n))
+    flips[0] = 1
+    return flips
+
+
+def get_permutations(n, n_perms, random_state):
+    """
+    (n_perms, n) permutations of range(n), the first of them the identity.
+    All n! permutations are returned if there are no more than n_perms
+    """
+    if factorial(n) <= n_perms:
+        return np.array(list(permutations(range(n))))
+    perms = np.array([random_state.permutation(n) for _ in range(n_perms)])
+    perms[0] = np.arange(n)
+    return perms
+
+
+# ********************************************************
+# Statistics
+# ********************************************************
+
+class PermutationTest():
+    """
+    T and F contrasts of a group GLM, under permutations or sign flips
+
+    Args:
+        Y: (n_maps, n_voxels) data over the in-mask voxels
+        X: (n_maps, n_regressors) design matrix
+        contrasts: list of (name, 'T' or 'F', contrast matrix). T contrasts
+            are single rows
+        mask: 3D boolean array, the voxels of Y
+        zooms: voxel sizes (mm) of the mask, for variance smoothing
+        var_smooth: sigma (mm) of the variance smoothing, None for none
+        sign_flip: sign flip the maps (one sample tests) rather than
+            permute them
+    """
+    def __init__(self, Y, X, contrasts, mask, zooms=(1, 1, 1),
+                 var_smooth=None, sign_flip=False, dtype=np.float32):
+        X = np.asarray(X, dtype=float)
+        self.n, self.p = X.shape
+        self.contrasts = [(name, kind, np.atleast_2d(np.asarray(c, float)))
+                          for name, kind, c in contrasts]
+        self.mask = mask
+        self.sigma = None if not var_smooth else \
+            [0] + [var_smooth / z for z in zooms]
+        if self.sigma is not None:
+            self.smoothed_mask = gaussian_filter(mask.astype(float),
+                                                 self.sigma[1:])[mask]
+        self.sign_flip = sign_flip
+        self.dtype = dtype
+        self.neighbors = get_neighbors(mask)
+
+        U, s, _ = np.linalg.svd(X, full_matrices=False)
+        rank = np.sum(s > s.max() * max(X.shape) * np.finfo(float).eps)
+        Q = U[:, :rank]
+        self.df = self.n - rank
+        pinv_X = np.linalg.pinv(X)
+        XtX_inv = pinv_X.dot(pinv_X.T)
+        Y = np.asarray(Y, dtype=dtype)
+        # per contrast: the rows projecting (permuted) data to the contrast
+        # effects and onto the design, the permuted residuals and the
+        # inverse of the contrast's covariance
+        self.rows, self.residuals, self.scales = [], [], []
+        residuals = {}
+        for name, kind, C in self.contrasts:
+            nuisance = tuple(np.flatnonzero((C == 0).all(axis=0)))
+            if nuisance not in residuals:
+                residuals[nuisance] = self._residualize(Y, X[:, nuisance])
+            self.residuals.append(residuals[nuisance])
+            self.rows.append(np.vstack([C.dot(pinv_X), Q.T]))
+            self.scales.append(np.linalg.pinv(C.dot(XtX_inv).dot(C.T)))
+        self.ss_total = [np.einsum('ij,ij->j', R, R, dtype=np.float64)
+                         for R in self.residuals]
+
+    @staticmethod
+    def _residualize(Y, Z):
+        """ residuals of Y on the nuisance regressors Z (Freedman-Lane) """
+        if Z.shape[1] == 0:
+            return Y
+        Qz, _ = np.linalg.qr(Z)
+        Qz = Qz.astype(Y.dtype)
+        return Y - Qz.dot(Qz.T.dot(Y))
+
+    def get_transforms(self, n_perms, seed=None):
+        """ the sign flips or permutations of the test, identity first """
+        random_state = np.random.RandomState(seed)
+        if self.sign_flip:
+            return get_sign_flips(self.n, n_perms, random_state)
+        return get_permutations(self.n, n_perms, random_state)
+
+    def _smooth_variance(self, sigma2):
+        volumes = np.zeros((len(sigma2),) + self.mask.shape)
+        volumes[:, self.mask] = sigma2
+        return gaussian_filter(volumes, self.sigma)[:, self.mask] \
+            / self.smoothed_mask
+
+    def stats(self, index, transforms):
+        """
+        returns the (n_transforms, n_voxels) statistics of contrast index
+        under each of the sign flips or permutations
+        """
+        _, kind, C = self.contrasts[index]
+        M = self.rows[index]
+        r = C.shape[0]
+        if self.sign_flip:
+            A = M[None] * transforms[:, None, :]
+        else:
+            # (P y)_i = y_perm[i], so the rows of M move to perm's positions
+            A = np.empty((len(transforms),) + M.shape)
+            A[np.arange(len(transforms))[:, None], :, transforms] = \
+                M.T[None]
+        R = self.residuals[index]
+        prod = A.reshape(-1, self.n).astype(self.dtype).dot(R)
+        prod = prod.reshape(len(transforms), M.shape[0], -1)
+        effects = prod[:, :r].astype(np.float64)
+        ss_model = np.einsum('brv,brv->bv', prod[:, r:], prod[:, r:],
+                             dtype=np.float64)
+        sigma2 = np.maximum(self.ss_total[index] - ss_model, 0) / self.df
+        if self.sigma is not None:
+            sigma2 = self._smooth_variance(sigma2)
+        scale = self.scales[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if kind == 'T':
+                stat = effects[:, 0] / np.sqrt(sigma2 / scale[0, 0])
+            else:
+                stat = np.einsum('brv,rs,bsv->bv', effects, scale, effects)\
+                    / (r * sigma2)
+        stat[~np.isfinite(stat)] = 0
+        return stat
+
+    def get_batch_size(self, index):
+        """ transforms per batch, keeping its arrays under BATCH_BYTES """
+        n_voxels = self.residuals[index].shape[1]
+        transform_bytes = self.rows[index].shape[0] * n_voxels * 8
+        if self.sigma is not None:
+            # the volumes the variance is smoothed in
+            transform_bytes += 2 * self.mask.size * 8
+        return max(1, BATCH_BYTES // transform_bytes)
+
+    def max_tfce(self, transforms, dhs):
+        """
+        (n_transforms, n_contrasts) maximum TFCE of every contrast under
+        each transform
+        """
+        maxima = np.zeros((len(transforms), len(self.contrasts)))
+        for index, dh in enumerate(dhs):
+            if dh <= 0:
+                continue
+            batch_size = self.get_batch_size(index)
+            for start in range(0, len(transforms), batch_size):
+                batch = transforms[start:start + batch_size]
+                for i, stat in enumerate(self.stats(index, batch)):
+                    maxima[start + i, index] = \
+                        tfce(stat, self.neighbors, dh).max()
+        return maxima
+
+
+def _max_tfce_chunk(job):
+    start, transforms, dhs = job
+    return start, _TEST.max_tfce(transforms, dhs)
+
+
+def run_permutation_test(test, n_perms, n_procs=1, seed=0):
+    """
+    runs every contrast of test under n_perms sign flips or permutations
+
+    Returns:
+        dict mapping each contrast name to a dict of in-mask arrays: stat,
+        tfce and tfce_corrp (1 - family-wise corrected p value, as
+        randomise's tfce_corrp outputs), plus n_perms, the number of
+        transforms run
+    """
+    global _TEST
+    transforms = test.get_transforms(n_perms, seed)
+    identity = transforms[:1]
+    observed, enhanced, dhs = [], [], []
+    for index in range(len(test.contrasts)):
+        stat = test.stats(index, identity)[0]
+        dh = max(stat.max(), 0) / TFCE_STEPS
+        observed.append(stat)
+        enhanced.append(tfce(stat, test.neighbors, dh) if dh > 0
+                        else np.zeros(stat.size))
+        dhs.append(dh)
+
+    _TEST = test
+    jobs = [(start, transforms[start:start + CHUNK_SIZE], dhs)
+            for start in range(0, len(transforms), CHUNK_SIZE)]
+    maxima = np.zeros((len(transforms), len(test.contrasts)))
+    try:
+        for start, chunk_maxima in run_jobs(_max_tfce_chunk, jobs, n_procs):
+            maxima[start:start + len(chunk_maxima)] = chunk_maxima
+    finally:
+        _TEST = None
+
+    results = {}
+    for index, (name, _, _) in enumerate(test.contrasts):
+        null = np.sort(maxima[:, index])
+        n_exceeding = len(null) - np.searchsorted(null, enhanced[index],
+                                                  side='left')
+        results[name] = {'stat': observed[index],
+                         'tfce': enhanced[index],
+                         'tfce_corrp': 1 - n_exceeding / len(null)}
+    results['n_perms'] = len(transforms)
+    return results
+
+
+# ********************************************************
+# Reference checks
+# ********************************************************
+
+def tfce_reference(stat, mask, dh, E=TFCE_E, H=TFCE_H):
+    """
+    tfce of stat over the voxels of mask, labelling the clusters above
+    every height from scratch with scipy.ndimage.label
+    """
+    steps = np.zeros(mask.shape, dtype=np.int64)
+    steps[mask] = np.floor(stat / dh)
+    enhanced = np.zeros(stat.size)
+    for j in range(1, steps.max() + 1):
+        labels, _ = label(steps >= j, structure=np.ones((3, 3, 3)))
+        sizes = np.bincount(labels.ravel()).astype(float)
+        sizes[0] = 0
+        enhanced += sizes[labels[mask]] ** E * (j * dh) ** H * dh
+    return enhanced
+
+
+def stats_reference(Y, X, kind, C, transform, sign_flip=False, mask=None,
+                    zooms=(1, 1, 1), var_smooth=None):
+    """
+    statistic of contrast C under one sign flip or permutation of the
+    residuals of the nuisance regressors (Freedman-Lane), refitting the
+    transformed data with least squares
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    X = np.asarray(X, dtype=float)
+    C = np.atleast_2d(np.asarray(C, float))
+    Z = X[:, (C == 0).all(axis=0)]
+    fitted = np.zeros_like(Y)
+    if Z.shape[1] > 0:
+        fitted = Z.dot(np.linalg.lstsq(Z, Y, rcond=None)[0])
+    if sign_flip:
+        Y = (Y - fitted) * transform[:, None] + fitted
+    else:
+        Y = (Y - fitted)[transform] + fitted
+    beta, _, rank, _ = np.linalg.lstsq(X, Y, rcond=None)
+    sigma2 = ((Y - X.dot(beta)) ** 2).sum(axis=0) / (len(X) - rank)
+    if var_smooth:
+        sigma = [var_smooth / z for z in zooms]
+        volume = np.zeros(mask.shape)
+        volume[mask] = sigma2
+        sigma2 = gaussian_filter(volume, sigma)[mask] / \
+            gaussian_filter(mask.astype(float), sigma)[mask]
+    effects = C.dot(beta)
+    covariance = C.dot(np.linalg.pinv(X.T.dot(X))).dot(C.T)
+    if kind == 'T':
+        return effects[0] / np.sqrt(sigma2 * covariance[0, 0])
+    return np.einsum('rv,rs,sv->v', effects, np.linalg.pinv(covariance),
+                     effects) / (len(C) * sigma2)
+
+
+def compare_to_reference(Y, X, contrasts, mask, zooms=(1, 1, 1),
+                         var_smooth=None, sign_flip=False, n_perms=20,
+                         seed=0):
+    """
+    computes the statistics of a PermutationTest of Y under n_perms
+    transforms, and the tfce of its unpermuted statistics, along with
+    stats_reference and tfce_reference. Returns, per contrast, the largest
+    differences between the two relative to the largest reference value
+    """
+    test = PermutationTest(Y, X, contrasts, mask, zooms=zooms,
+                           var_smooth=var_smooth, sign_flip=sign_flip)
+    transforms = test.get_transforms(n_perms, seed)
+    differences = {}
+    for index, (name, kind, C) in enumerate(test.contrasts):
+        stats = test.stats(index, transforms)
+        reference = np.array([
+            stats_reference(Y, X, kind, C, transform, sign_flip=sign_flip,
+                            mask=mask, zooms=zooms, var_smooth=var_smooth)
+            for transform in transforms])
+        dh = max(reference[0].max(), 0) / TFCE_STEPS
+        enhanced = tfce(reference[0], test.neighbors, dh)
+        enhanced_reference = tfce_reference(reference[0], mask, dh)
+        differences[name] = {
+            'stat_max_rel_diff': np.abs(stats - reference).max()
+                                 / np.abs(reference).max(),
+            'tfce_max_rel_diff': np.abs(enhanced - enhanced_reference).max()
+                                 / max(enhanced_reference.max(), 1e-12)}
+    return differences
+
+
+if __name__ == '__main__':
+    random_state = np.random.RandomState(0)
+    n_maps, shape = 20, (16, 16, 12)
+    grid = np.indices(shape) - (np.array(shape) / 2)[:, None, None, None]
+    mask = (grid ** 2).sum(axis=0) < 36
+    blob = np.exp(-((grid - [[[[3]]], [[[0]]], [[[0]]]]) ** 2).sum(axis=0)
+                  / 8)[mask]
+    covariate = random_state.randn(n_maps)
+    X = np.column_stack([np.ones(n_maps), covariate,
+                         random_state.randn(n_maps)])
+    noise = np.array([gaussian_filter(random_state.randn(*shape), 1)[mask]
+                      for _ in range(n_maps)])
+    Y = noise + .2 * blob + .3 * covariate[:, None] * blob
+    neighbors = get_neighbors(mask)
+    for name, stat in [('map', Y[0]), ('blob', blob),
+                       ('noise', np.abs(noise[1]))]:
+        reference = tfce_reference(stat, mask, .05)
+        print('tfce of %s: max rel diff %.2e' % (
+            name, np.abs(tfce(stat, neighbors, .05) - reference).max()
+            / reference.max()))
+    for var_smooth in [None, 4]:
+        checks = [
+            ('intercept, sign flips',
+             compare_to_reference(Y, X[:, :1], [('fstat1', 'F', [1])], mask,
+                                  var_smooth=var_smooth, sign_flip=True)),
+            ('covariate, Freedman-Lane',
+             compare_to_reference(Y, X, [('tstat1', 'T', [0, 1, 0]),
+                                         ('tstat2', 'T', [0, -1, 0]),
+                                         ('fstat1', 'F', [[0, 1, 0],
+                                                          [0, 0, 1]])],
+                                  mask, var_smooth=var_smooth))]
+        for model, differences in checks:
+            for name, diffs in differences.items():
+                print('%s, %s, var_smooth=%s: %s' % (
+                    model, name, var_smooth,
+                    ', '.join('%s %.2e' % item for item in diffs.items())))
@@ -1,13 +1,19 @@
 from matplotlib.colors import ListedColormap
 import matplotlib.patheffects as PathEffects
 import matplotlib.pyplot as plt
+import nibabel as nib
 import numpy as np
 import pandas as pd
+import re
 from scipy.stats import norm
 import seaborn as sns
-from nilearn import image, plotting
+from nilearn import image, masking, plotting
+from nilearn.image import math_img
 from nistats.reporting import plot_design_matrix, plot_contrast_matrix
 
+from utils.contrast_utils import compute_contrasts, get_contrast_matrix
+from utils.firstlevel_store import get_model_stats
+
 def plot_design(subjinfo, plot_contrasts=False):
     fig, ax = plt.subplots(figsize=(15,8))
     plot_design_matrix(subjinfo.design, ax=ax, rescale=True)
@@ -16,14 +22,33 @@ def plot_design(subjinfo, plot_contrasts=False):
             ax=plot_contrast_matrix(contrast, design_matrix=subjinfo.design)
             ax.set_xlabel(name)
 
+def compute_contrast_maps(subjinfo, contrasts):
+    """
+    z maps of contrasts (a list of definitions, or of names of
+    subjinfo.contrasts) as a 4D image, from the model statistics of a
+    FirstLevel or of a FirstLevelStore (which has no fit_model)
+    """
+    definitions = dict(subjinfo.contrasts)
+    contrasts = [(c, definitions.get(c, c)) for c in contrasts]
+    names, con_vals, failed = get_contrast_matrix(contrasts,
+                                                  subjinfo.design.columns)
+    if failed:
+        raise ValueError('Contrasts %s failed for %s' % (failed, subjinfo.ID))
+    if subjinfo.fit_model is not None:
+        z_maps = compute_contrasts(get_model_stats(subjinfo.fit_model),
+                                   con_vals)
+        return subjinfo.fit_model.masker_.inverse_transform(z_maps)
+    z_maps = compute_contrasts(subjinfo.model_stats, con_vals)
+    return masking.unmask(z_maps, subjinfo.mask)
+
 def plot_contrast(subjinfo, contrast, simple_plot=True, **kwargs):
     if type(contrast) == int:
         contrast = subjinfo.contrasts[contrast]
         contrast_title = contrast[0]
-        z_map = subjinfo.fit_model.compute_contrast(contrast[1])
+        contrast = contrast[1]
     else:
         contrast_title = contrast
-        z_map = subjinfo.fit_model.compute_contrast(contrast)
+    z_map = image.index_img(compute_contrast_maps(subjinfo, [contrast]), 0)
     plot_map(z_map, title=contrast_title, **kwargs)
 
 def plot_map(contrast_map, title=None, glass_kwargs=None, stat_kwargs=None):
@@ -97,14 +122,12 @@ def plot_vif(subjinfo):
     sns.heatmap(vif_df, vmin=0, square=False, annot=True, annot_kws={'fontsize': 10}, cmap=sns.diverging_palette(240, 10, as_cmap=True))   
 
 def plot_average_maps(subjects, contrast_keys=None, **kwargs):
-    map_keys = subjects[0].maps.keys() if contrast_keys is None else contrast_keys
+    map_keys = [name for name, _ in subjects[0].contrasts] if contrast_keys is None else contrast_keys
+    # every subject's contrasts in one pass, averaged per contrast
+    subject_maps = [compute_contrast_maps(i, map_keys) for i in subjects]
     averages = {}
-    for key in map_keys:
-        try:
-            maps = [i.maps[key] for i in subjects]
-        except KeyError:
-            maps = [i.fit_model.compute_contrast(key) for i in subjects]
-        averages[key] = image.mean_img(maps)
+    for j, key in enumerate(map_keys):
+        averages[key] = image.mean_img([image.index_img(maps, j) for maps in subject_maps])
     # plot
     for name, average in averages.items():
         default_args = {'threshold': norm.isf(0.001),
@@ -117,6 +140,38 @@ def plot_average_maps(subjects, contrast_keys=None, **kwargs):
 
 # SECOND LEVELS PLOTTING FUNCTIONS
 
+def transform_p_val_map(map_path):
+    img = nib.load(map_path)
+    p_vals = img.get_fdata()
+    p_vals[p_vals==0.0] = np.nan
+    p_vals = 1 - p_vals
+    neg_log_pvals = -np.log10(p_vals)
+    return nib.Nifti1Image(neg_log_pvals, img.affine, img.header)
+
+def make_mask(img_path):
+    return math_img('img > .95',
+                    img=nib.load(img_path))
+
+def mask_img(img, mask):
+    img = nib.load(img) if type(img)==str else img
+    data = img.get_fdata()
+    data[~mask.get_fdata().astype(bool)] = np.nan
+    return nib.Nifti1Image(data, img.affine, img.header)
+
+def double_mask_img(img_path, mask1, mask2):
+    img = nib.load(img_path)
+    data = img.get_fdata()
+    data[(~mask1.get_fdata().astype(bool)) & (~mask2.get_fdata().astype(bool))] = np.nan
+    return nib.Nifti1Image(data, img.affine, img.header)
+
+def get_rand_idx(path):
+    return str(re.findall(r'[0-9$,%]+\d*', path)[-1])
+
+def f_to_t(fpath, bpath):
+    fimg = nib.load(fpath)
+    bimg = nib.load(bpath)
+    return nib.Nifti1Image(np.sqrt(fimg.get_fdata())*np.sign(bimg.get_fdata()), fimg.affine, fimg.header)
+
 def get_contrast_title(contrast_map):
     return contrast_map.split('contrast-')[1].split('_2ndlevel-')[0]
     
@@ -0,0 +1,139 @@
+"""
+cohort level design QC
+
+Reads the exported design csvs (design_<flags>.csv) of every subject of a
+task and computes, for every design at once:
+
+    condition_number  of the full design, with columns scaled to unit norm
+    max_vif           largest variance inflation factor of the task
+                      regressors (the columns before the nuisance
+                      regressors, as plotted by plot_utils.plot_vif)
+    max_abs_corr      largest absolute correlation between two task
+                      regressors
+
+Designs with the same task regressors and shape are stacked, so the
+correlations, inverses and singular values of a whole group are computed
+by batched numpy calls.
+"""
+from collections import defaultdict, OrderedDict
+import numpy as np
+import pandas as pd
+
+from utils.bids_index import get_first_level_index
+
+QC_THRESHOLDS = {'condition_number': 1000,
+                 'max_vif': 5,
+                 'max_abs_corr': .8}
+# columns of the QC tables, which have them even when there are no designs
+QC_COLUMNS = (['subject', 'task', 'flags', 'n_scans', 'n_regressors'] +
+              list(QC_THRESHOLDS) +
+              ['max_vif_regressor', 'max_corr_pair', 'flagged', 'reasons'])
+
+
+def get_nuisance_start(columns):
+    """ index of the first nuisance regressor of a design """
+    columns = list(columns)
+    return columns.index('trans_x' if 'trans_x' in columns else 'csf')
+
+
+def batch_design_metrics(designs, n_task):
+    """
+    QC metrics of a stack of designs
+
+    Args:
+        designs: (n_designs, n_scans, n_columns) array
+        n_task: number of task regressors (the first columns)
+
+    Returns:
+        dict of (n_designs,) arrays, plus 'vifs' (n_designs, n_task) and
+        'corr' (n_designs, n_task, n_task)
+    """
+    # condition number of the full designs, columns scaled to unit norm
+    norms = np.linalg.norm(designs, axis=1, keepdims=True)
+    singular_values = np.linalg.svd(designs / np.where(norms > 0, norms, 1),
+                                    compute_uv=False)
+    condition_number = singular_values[:, 0] / singular_values[:, -1]
+
+    # correlations of the task regressors
+    task = designs[:, :, :n_task]
+    centered = task - task.mean(axis=1, keepdims=True)
+    stds = np.linalg.norm(centered, axis=1, keepdims=True)
+    constant = stds[:, 0, :] == 0
+    z = centered / np.where(stds > 0, stds, 1)
+    corr = np.einsum('stk,stl->skl', z, z)
+    vifs = np.diagonal(np.linalg.pinv(corr), axis1=1, axis2=2).copy()
+    vifs[constant] = np.nan
+    off_diagonal = np.abs(corr) * (1 - np.eye(n_task))
+    return {'condition_number': condition_number,
+            'max_vif': np.nanmax(np.where(constant, -np.inf, vifs), axis=1),
+            'max_abs_corr': off_diagonal.reshape(len(designs), -1).max(1),
+            'vifs': vifs,
+            'corr': corr}
+
+
+def get_design_files(first_level_dir, task, flags):
+    """ (subject, design csv) for every subject with an exported design """
+    index = get_first_level_index(first_level_dir)
+    return [(f.split('/')[-3], f)
+            for f in index.get('*', task, 'design_%s.csv' % flags)]
+
+
+def task_design_qc(first_level_dir, task, flags, thresholds=QC_THRESHOLDS):
+    """
+    returns one row of QC metrics per design of the task. Designs exceeding
+    any of the thresholds are flagged, with the metrics that exceeded them
+    listed under reasons
+    """
+    # group designs by task regressors and shape so each group stacks
+    groups = defaultdict(list)
+    for subject_id, design_file in get_design_files(first_level_dir, task,
+                                                    flags):
+        design = pd.read_csv(design_file, index_col=0)
+        n_task = get_nuisance_start(design.columns)
+        key = (tuple(design.columns[:n_task]), design.shape)
+        groups[key].append((subject_id, design.values))
+    rows = []
+    for (task_columns, _), members in groups.items():
+        n_task = len(task_columns)
+        metrics = batch_design_metrics(np.stack([m[1] for m in members]),
+                                       n_task)
+        for i, (subject_id, design) in enumerate(members):
+            row = OrderedDict([('subject', subject_id),
+                               ('task', task),
+                               ('flags', flags),
+                               ('n_scans', design.shape[0]),
+                               ('n_regressors', design.shape[1])])
+            for key in QC_THRESHOLDS:
+                row[key] = metrics[key][i]
+            vifs = metrics['vifs'][i]
+            row['max_vif_regressor'] = (task_columns[np.nanargmax(vifs)]
+                                        if not np.isnan(vifs).all() else None)
+            corr = np.abs(metrics['corr'][i]) * (1 - np.eye(n_task))
+            k, l = np.unravel_index(corr.argmax(), corr.shape)
+            row['max_corr_pair'] = '%s:%s' % (task_columns[k],
+                                              task_columns[l])
+            reasons = [key for key, threshold in thresholds.items()
+                       if row[key] > threshold]
+            row['flagged'] = len(reasons) > 0
+            row['reasons'] = ';'.join(reasons)
+            rows.append(row)
+    qc = pd.DataFrame(rows, columns=QC_COLUMNS)
+    qc['flagged'] = qc['flagged'].astype(bool)
+    return qc
+
+
+def cohort_design_qc(first_level_dir, tasks, flags, output_file=None,
+                     thresholds=QC_THRESHOLDS):
+    """
+    runs task_design_qc for every task and returns (and optionally writes
+    to output_file) one summary table
+    """
+    summary = pd.concat([task_design_qc(first_level_dir, task, flags,
+                                        thresholds)
+                         for task in tasks] +
+                        [pd.DataFrame(columns=QC_COLUMNS)],
+                        ignore_index=True, sort=False)
+    summary['flagged'] = summary['flagged'].astype(bool)
+    if output_file is not None:
+        summary.to_csv(output_file, index=False)
+    return summary
@@ -0,0 +1,282 @@
+"""
+figure rendering scheduler for Visualizations.py
+
+Every figure Visualizations.py draws is described by a job: a dict with
+
+    id        unique name of the job, also its key in the figure manifest
+    kind      'design', 'first_level' or 'second_level' (see RENDERERS)
+    inputs    files the figures are drawn from
+    outputs   figure files the job writes
+
+plus whatever its renderer needs. Jobs are enumerated up front, and only
+those whose outputs are missing or whose inputs (path, size and mtime) or
+plotting code changed since they were last rendered are run. They are
+fanned out over a process pool whose workers draw with the headless Agg
+backend. A job that raises is recorded, with its traceback, in a report
+instead of stopping the others.
+"""
+from glob import glob
+from multiprocessing import current_process
+import os
+from os import path
+import time
+import traceback
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from utils.firstlevel_utils import get_first_level_objs, load_first_level_obj
+from utils.manifest_utils import Manifest, get_code_hash, stat_file
+from utils.plot_utils import (plot_design, plot_design_timeseries,
+                              plot_design_heatmap, plot_map, plot_task_maps,
+                              get_contrast_title, plot_vif,
+                              f_to_t, make_mask, mask_img)
+from utils.utils import run_jobs
+
+FIGURE_MANIFEST_NAME = 'figure_manifest.json'
+FIGURE_REPORT_NAME = 'figure_report.csv'
+# modules whose changes alter the figures
+FIGURE_CODE_FILES = ['plot_utils.py', 'render_utils.py']
+# panels drawn for each second level contrast, saved as
+# AAPLOTS_2ndlevel-<contrast>_<panel>.pdf
+SECOND_LEVEL_PANELS = ['Beta-raw', 'Beta-fpvalMasked', 'Fstats-raw',
+                       'Fpval-raw', 'Fpval-thresh95', 'TstatsfromFstats-raw',
+                       'TstatsfromFstats-fpvalMasked']
+# workers are replaced after this many jobs, returning the memory nilearn's
+# plotting holds on to
+RENDER_TASKS_PER_CHILD = 25
+
+
+def get_fingerprint(job, code_hash):
+    return {'inputs': [stat_file(f) for f in job['inputs']],
+            'code': code_hash}
+
+
+# ********************************************************
+# Job enumeration
+# ********************************************************
+
+def get_design_jobs(subjects, tasks, first_level_dir, fig_dir):
+    """ design figures of each (subject, task), as in the design QC table """
+    jobs = []
+    for sub, task in zip(subjects, tasks):
+        files = get_first_level_objs(sub, task, first_level_dir,
+                                     regress_rt=True, beta=False)
+        first_level_file = files[0] if files else None
+        if first_level_file is None:
+            inputs = []
+        elif first_level_file.endswith('.pkl'):
+            inputs = [first_level_file]
+        else:
+            inputs = [path.join(first_level_file, 'design.csv')]
+        prefix = path.join(fig_dir, '%s_%s' % (sub, task))
+        jobs.append({'id': 'design/%s/%s' % (sub, task),
+                     'kind': 'design',
+                     'inputs': inputs,
+                     'outputs': [prefix + suffix + '.png' for suffix in
+                                 ['_design_fig', '__design_timeseries',
+                                  '__design_timeseries_trunc', '_heatmap',
+                                  '__design_vif']],
+                     'first_level_file': first_level_file,
+                     'subject_id': sub,
+                     'task': task})
+    return jobs
+
+
+def get_first_level_jobs(first_level_dir, tasks):
+    """ one figure per first level contrast map """
+    jobs = []
+    for task in tasks:
+        contrast_maps = glob(path.join(first_level_dir, '*', task, '*maps*',
+                                       '*.nii.gz'))
+        for map_file in contrast_maps:
+            contrast_name = map_file[map_file.index('contrast')+9:]\
+                .replace('.nii.gz', '')
+            jobs.append({'id': 'first_level/%s' % map_file,
+                         'kind': 'first_level',
+                         'inputs': [map_file],
+                         'outputs': [map_file.replace('.nii.gz',
+                                                      '_plots.pdf')],
+                         'title': contrast_name})
+    return jobs
+
+
+def get_second_level_jobs(second_level_dir, tasks, group='NONE'):
+    """
+    one job per (task, contrast directory, second level contrast), drawing
+    its beta, F and p panels. Only intercept contrasts are drawn
+    """
+    jobs = []
+    for task in tasks:
+        contrast_dirs = sorted(glob(path.join(second_level_dir, task,
+                                              '*maps')))
+        for contrast_dir in contrast_dirs:
+            RT_flag = 'RT-True' in contrast_dir
+            contrast_title = task+'_RT-'+str(RT_flag)
+            out_dir = contrast_dir if group == 'NONE' \
+                else path.join(contrast_dir, group)
+            beta_maps = sorted(glob(path.join(out_dir, 'contrast-*.nii.gz')))
+            scnd_lvl_contrasts = sorted({
+                s.split('2ndlevel-')[-1].replace('.nii.gz', '')
+                for s in beta_maps})
+            for scnd_lvl in scnd_lvl_contrasts:
+                if 'RT' in scnd_lvl or 'intercept' not in scnd_lvl:
+                    continue
+                curr_beta_maps = [m for m in beta_maps if scnd_lvl in m]
+                randomise_files = {'fstat': [], 'tfce_corrp_fstat': []}
+                for beta_map in curr_beta_maps:
+                    randomise_dir = beta_map.replace('.nii.gz', '_Randomise')
+                    for key in randomise_files:
+                        randomise_files[key].append(glob(path.join(
+                            randomise_dir, 'randomise_%s*.nii.gz' % key)))
+                inputs = curr_beta_maps + sorted(
+                    f for files in randomise_files.values()
+                    for found in files for f in found)
+                prefix = path.join(out_dir, 'AAPLOTS_2ndlevel-%s_' % scnd_lvl)
+                jobs.append({'id': 'second_level/%s/%s' % (out_dir, scnd_lvl),
+                             'kind': 'second_level',
+                             'inputs': inputs,
+                             'outputs': [prefix + suffix + '.pdf' for suffix
+                                         in SECOND_LEVEL_PANELS],
+                             'title': contrast_title + '_2ndlevel-' + scnd_lvl,
+                             'beta_maps': curr_beta_maps,
+                             'randomise_files': randomise_files})
+    return jobs
+
+
+# ********************************************************
+# Renderers
+# ********************************************************
+
+def _save(fig, filename):
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def render_design(job):
+    if job['first_level_file'] is None:
+        raise FileNotFoundError('task not found')
+    subjinfo = load_first_level_obj(job['first_level_file'])
+    design_fig, timeseries, timeseries_trunc, heatmap, vif = job['outputs']
+    with plt.rc_context({'figure.autolayout': True}):
+        plot_design(subjinfo)
+        _save(plt.gcf(), design_fig)
+        plot_design_timeseries(subjinfo)
+        _save(plt.gcf(), timeseries)
+        plot_design_timeseries(subjinfo, 0,
+                               200 if job['task'] == 'WATT3' else 100)
+        _save(plt.gcf(), timeseries_trunc)
+        plot_design_heatmap(subjinfo)
+        plt.savefig(heatmap, bbox_inches="tight")
+        plt.close()
+        plot_vif(subjinfo)
+        _save(plt.gcf(), vif)
+
+
+def render_first_level(job):
+    map_file, = job['inputs']
+    _save(plot_map(map_file, title=job['title']), job['outputs'][0])
+
+
+def render_second_level(job):
+    beta_maps = job['beta_maps']
+    ordered_file_dict = {}
+    for key, files in job['randomise_files'].items():
+        for found in files:
+            assert len(found)==1, \
+                'expected one randomise_%s map, found %s' % (key, len(found))
+        ordered_file_dict[key] = [found[0] for found in files]
+    fstats = ordered_file_dict['fstat']
+    pvals = ordered_file_dict['tfce_corrp_fstat']
+    contrast_titles = [get_contrast_title(m) for m in beta_maps]
+    tstat_maps = [f_to_t(fmap, bmap) for fmap, bmap in zip(fstats, beta_maps)]
+    masks = [make_mask(pfile) for pfile in pvals]
+    panels = [
+        (beta_maps, 0),
+        ([mask_img(bfile, mask) for bfile, mask in zip(beta_maps, masks)], 0),
+        (fstats, 0),
+        (pvals, 0),
+        (pvals, .95),
+        (tstat_maps, 0),
+        ([mask_img(timg, mask) for timg, mask in zip(tstat_maps, masks)], 0)]
+    for (maps, threshold), output in zip(panels, job['outputs']):
+        _save(plot_task_maps(maps, job['title'], threshold=threshold,
+                             contrast_titles=contrast_titles), output)
+
+
+RENDERERS = {'design': render_design,
+             'first_level': render_first_level,
+             'second_level': render_second_level}
+
+
+def render_job(job):
+    """
+    renders one job, returning its status ('rendered' or 'failed'), wall
+    time and, if it failed, the traceback
+    """
+    if current_process().name != 'MainProcess':
+        plt.switch_backend('Agg')
+    start = time.time()
+    status, error = 'rendered', ''
+    try:
+        RENDERERS[job['kind']](job)
+    except Exception:
+        status, error = 'failed', traceback.format_exc()
+    finally:
+        plt.close('all')
+    return {'id': job['id'],
+            'kind': job['kind'],
+            'status': status,
+            'seconds': time.time() - start,
+            'error': error}
+
+
+def render_figures(jobs, manifest_dir, n_procs=1, overwrite=False,
+                   report_file=None):
+    """
+    renders the jobs whose figures are missing or out of date
+
+    Args:
+        jobs: list of jobs, as from the get_*_jobs functions
+        manifest_dir: directory of the figure manifest
+        n_procs: number of worker processes
+        overwrite: render every job regardless of the manifest
+        report_file: csv to write the status of every job to. Defaults to
+            figure_report.csv in manifest_dir
+
+    Returns:
+        DataFrame with one row per job: id, kind, status ('skipped',
+        'rendered' or 'failed'), seconds and error
+    """
+    manifest = Manifest(path.join(manifest_dir, FIGURE_MANIFEST_NAME))
+    code_hash = get_code_hash(FIGURE_CODE_FILES)
+    fingerprints, stale, rows = {}, [], []
+    for job in jobs:
+        fingerprints[job['id']] = get_fingerprint(job, code_hash)
+        changes = manifest.get_changes(job['id'], fingerprints[job['id']])
+        if overwrite or changes != [] or \
+                not all(path.exists(f) for f in job['outputs']):
+            stale.append(job)
+        else:
+            rows.append({'id': job['id'], 'kind': job['kind'],
+                         'status': 'skipped', 'seconds': 0, 'error': ''})
+    print('rendering %s of %s figure jobs with %s processes'
+          % (len(stale), len(jobs), n_procs))
+    try:
+        for result in run_jobs(render_job, stale, n_procs=n_procs,
+                               maxtasksperchild=RENDER_TASKS_PER_CHILD):
+            rows.append(result)
+            if result['status'] == 'rendered':
+                manifest.update(result['id'], fingerprints[result['id']])
+            else:
+                print('** failed: %s' % result['id'])
+    finally:
+        manifest.save()
+    report = pd.DataFrame(rows, columns=['id', 'kind', 'status', 'seconds',
+                                         'error'])
+    if report_file is None:
+        report_file = path.join(manifest_dir, FIGURE_REPORT_NAME)
+    os.makedirs(path.dirname(path.abspath(report_file)), exist_ok=True)
+    report.to_csv(report_file, index=False)
+    print(report.status.value_counts().to_string())
+    return report
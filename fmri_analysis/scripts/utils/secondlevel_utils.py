@@ -3,46 +3,44 @@ import json
 import nibabel as nb
 import numpy as np
 from glob import glob
-from os import path, remove, makedirs
-from nilearn import image
+from os import path, rename, makedirs
+import time
+from nilearn import image, masking
 from nipype.caching import Memory
 from nipype.interfaces import fsl
 
-from utils.utils import get_flags
+from utils.group_mask import MaskCounts, get_brainmasks
+from utils.permutation_utils import PermutationTest, run_permutation_test
+from utils.subject_stack import SubjectStack
+from utils.utils import get_flags, run_jobs, split_n_procs
 
 
-def mean_masks(masks):
-    mask = nb.load(masks[0])
-    hdr, aff = mask.header, mask.affine
-    data = np.zeros(mask.shape)
-    for mask in masks:
-        data += nb.load(mask).get_data()
-    data /= len(masks)
-    return nb.Nifti1Image(data, aff, hdr)
+def mean_masks(masks, n_threads=8):
+    mask_counts = MaskCounts()
+    mask_counts.add(masks, n_threads)
+    return nb.Nifti1Image(mask_counts.counts / mask_counts.n_masks,
+                          mask_counts.affine)
 
 
-def create_group_mask(fmriprep_dir, threshold=.8, verbose=True):
+def create_group_mask(fmriprep_dir, threshold=.8, verbose=True, n_threads=8):
+    """
+    group mask of the voxels in at least a threshold fraction of fmriprep's
+    brain masks. See utils.group_mask.update_group_masks to keep the counts
+    between runs
+    """
     if verbose:
         print('Creating Group mask...')
-    # check if there's a session folder
-    if len(glob(path.join(fmriprep_dir, 'sub-*', 'func',
-                          '*MNI152NLin2009cAsym*brain_mask.nii.gz'))):
-        brainmasks = glob(path.join(fmriprep_dir,
-                                    'sub-*',
-                                    'func',
-                                    '*MNI152NLin2009cAsym*brain_mask.nii.gz'))
-    else:
-        brainmasks = glob(path.join(fmriprep_dir, 'sub-*', '*', 'func',
-                                    '*MNI152NLin2009cAsym*brain_mask.nii.gz'))
+    brainmasks = get_brainmasks(fmriprep_dir)
     if verbose:
         print("%s maps found at %s" % (len(brainmasks), fmriprep_dir))
         print('threshold info:')
         print(threshold)
         print(type(threshold))
-    mean_mask = mean_masks(brainmasks)
+    mask_counts = MaskCounts()
+    mask_counts.add(brainmasks, n_threads)
     if verbose:
         print('Thresholding, finishing creating group mask')
-    return image.math_img("a>=%s" % str(threshold), a=mean_mask)
+    return mask_counts.get_mask(threshold)
 
 
 def load_contrast_maps(second_level_dir, task, regress_rt=False, beta=False):
@@ -64,18 +62,95 @@ def load_contrast_maps(second_level_dir, task, regress_rt=False, beta=False):
     return maps
 
 
+def get_randomise_dir(maps_dir, contrast_name, scnd_lvl):
+    return path.join(maps_dir, 'contrast-%s_2ndlevel-%s_Randomise'
+                     % (contrast_name, scnd_lvl))
+
+
 def randomise(maps, maps_dir, mask_loc, des_mat, scnd_lvl,
-              n_perms=100, fwhm=6, c_thresh=None):
+              n_perms=100, fwhm=6, c_thresh=None, n_procs=1, seed=0,
+              data=None):
+    """
+    permutation inference of a second level contrast, in process (see
+    utils.permutation_utils), writing the outputs randomise_fsl would:
+
+        intercept   sign flipping F test of the group mean:
+                    randomise_fstat1, randomise_tfce_corrp_fstat1
+        otherwise   Freedman-Lane permutation of the positive and negative
+                    T contrasts of the scnd_lvl regressor:
+                    randomise_tstat1/2, randomise_tfce_corrp_tstat1/2
+
+    The maps are smoothed with fwhm, which is also the sigma (mm) of the
+    variance smoothing, as in randomise_fsl. Cluster extent inference
+    (c_thresh) is left to randomise_fsl.
+
+    data, if given, holds the maps already masked with mask_loc and
+    smoothed with fwhm (n_maps, n_voxels), e.g. from a SubjectStack
+    """
+    if c_thresh is not None:
+        return randomise_fsl(maps, maps_dir, mask_loc, des_mat, scnd_lvl,
+                             n_perms=n_perms, fwhm=fwhm, c_thresh=c_thresh)
+    contrast_name = maps[0][maps[0].index('contrast')+9:].replace('.nii.gz', '')
+    assert scnd_lvl == 'intercept' or scnd_lvl in des_mat.filter(regex='RT').columns
+    mask_img = nb.load(mask_loc)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    fwhm = float(fwhm)
+    if data is None:
+        data = masking.apply_mask(image.concat_imgs(maps), mask_img,
+                                  smoothing_fwhm=fwhm)
+    Y = np.asarray(data, dtype=np.float32)
+    if scnd_lvl == 'intercept':
+        X = np.ones((len(maps), 1))
+        contrasts = [('fstat1', 'F', [1])]
+        sign_flip = True
+    else:
+        X = des_mat.values
+        c = (des_mat.columns == scnd_lvl).astype(float)
+        contrasts = [('tstat1', 'T', c), ('tstat2', 'T', -c)]
+        sign_flip = False
+    test = PermutationTest(Y, X, contrasts, mask,
+                           zooms=mask_img.header.get_zooms()[:3],
+                           var_smooth=fwhm, sign_flip=sign_flip)
+    results = run_permutation_test(test, n_perms, n_procs=n_procs, seed=seed)
+
+    # write to a temporary directory, so an interrupted run leaves no
+    # output directory behind
+    output_dir = get_randomise_dir(maps_dir, contrast_name, scnd_lvl)
+    tmp_dir = output_dir + '.tmp'
+    if path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    makedirs(tmp_dir)
+    for name, _, _ in contrasts:
+        masking.unmask(results[name]['stat'], mask_img).to_filename(
+            path.join(tmp_dir, 'randomise_%s.nii.gz' % name))
+        masking.unmask(results[name]['tfce_corrp'], mask_img).to_filename(
+            path.join(tmp_dir, 'randomise_tfce_corrp_%s.nii.gz' % name))
+    des_mat.to_csv(path.join(tmp_dir, 'design.csv'))
+    with open(path.join(tmp_dir, 'f_name_map.json'), 'w') as f:
+        json.dump({1: scnd_lvl}, f)
+    with open(path.join(tmp_dir, 't_name_map.json'), 'w') as f:
+        json.dump({1: '%sPos' % scnd_lvl, 2: '%sNeg' % scnd_lvl}, f)
+    if path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    rename(tmp_dir, output_dir)
+    return results['n_perms']
+
+
+def randomise_fsl(maps, maps_dir, mask_loc, des_mat, scnd_lvl,
+                  n_perms=100, fwhm=6, c_thresh=None):
     contrast_name = maps[0][maps[0].index('contrast')+9:].replace('.nii.gz', '')
     # create 4d image
     concat_images = image.concat_imgs(maps)
     # smooth_concat_images
     concat_images = image.smooth_img(concat_images, fwhm)
-    # save concat images temporarily
-    concat_loc = path.join(maps_dir, 'tmp_concat.nii.gz')
+    # save concat images temporarily, in a working directory of this
+    # contrast, so randomise jobs of the same maps_dir can run at once
+    work_dir = path.join(maps_dir, 'tmp_%s_%s' % (contrast_name, scnd_lvl))
+    makedirs(work_dir, exist_ok=True)
+    concat_loc = path.join(work_dir, 'tmp_concat.nii.gz')
     concat_images.to_filename(concat_loc)
 
-    mem = Memory(base_dir=maps_dir)
+    mem = Memory(base_dir=work_dir)
     #build up randomise design files
     assert scnd_lvl == 'intercept' or scnd_lvl in des_mat.filter(regex='RT').columns
     if scnd_lvl == 'intercept':
@@ -130,7 +205,7 @@ def randomise(maps, maps_dir, mask_loc, des_mat, scnd_lvl,
         )
 
     # save results
-    output_dir = path.join(maps_dir, 'contrast-%s_2ndlevel-%s_Randomise' % (contrast_name, scnd_lvl))
+    output_dir = get_randomise_dir(maps_dir, contrast_name, scnd_lvl)
     makedirs(output_dir, exist_ok=True)
     mrd_out_dir = path.dirname(mult_res_model_results.outputs.design_con)
     mrd_files = glob(path.join(mrd_out_dir, 'design*')) + glob(path.join(mrd_out_dir, '*.json')) + glob(path.join(mrd_out_dir, '*.txt'))
@@ -147,5 +222,145 @@ def randomise(maps, maps_dir, mask_loc, des_mat, scnd_lvl,
         json.dump(t_name_map, f)
 
     # remove temporary files
-    remove(concat_loc)
-    shutil.rmtree(mrd_out_dir)
+    shutil.rmtree(work_dir)
+
+
+def compare_to_randomise_fsl(maps, mask_loc, des_mat, scnd_lvl, work_dir,
+                             n_perms=500, fwhm=6):
+    """
+    runs randomise and randomise_fsl on the same maps, into work_dir/python
+    and work_dir/fsl, and returns for each statistic they both write the
+    largest difference of the statistics relative to randomise_fsl's, the
+    largest difference of the tfce_corrp maps and the fraction of voxels
+    significant (tfce_corrp > .95) in one of them only. The permutations
+    of the two differ, so the tfce_corrp maps agree up to permutation noise
+    """
+    outputs = {}
+    for name, run in [('python', randomise), ('fsl', randomise_fsl)]:
+        maps_dir = path.join(work_dir, name)
+        makedirs(maps_dir, exist_ok=True)
+        run(maps, maps_dir, mask_loc, des_mat, scnd_lvl, n_perms=n_perms,
+            fwhm=fwhm)
+        contrast_name = maps[0][maps[0].index('contrast')+9:]\
+            .replace('.nii.gz', '')
+        outputs[name] = get_randomise_dir(maps_dir, contrast_name, scnd_lvl)
+    mask_img = nb.load(mask_loc)
+    differences = {}
+    for stat_file in sorted(glob(path.join(outputs['fsl'],
+                                           'randomise_*stat*.nii.gz'))):
+        stat_name = path.basename(stat_file)[10:].replace('.nii.gz', '')
+        if stat_name.startswith('tfce') or not path.exists(
+                path.join(outputs['python'], path.basename(stat_file))):
+            continue
+        loaded = {}
+        for name in outputs:
+            for prefix in ['randomise_', 'randomise_tfce_corrp_']:
+                loaded[name, prefix] = masking.apply_mask(path.join(
+                    outputs[name], '%s%s.nii.gz' % (prefix, stat_name)),
+                    mask_img)
+        stat, stat_fsl = loaded['python', 'randomise_'], \
+            loaded['fsl', 'randomise_']
+        corrp, corrp_fsl = loaded['python', 'randomise_tfce_corrp_'], \
+            loaded['fsl', 'randomise_tfce_corrp_']
+        differences[stat_name] = {
+            'stat_max_rel_diff': np.abs(stat - stat_fsl).max()
+                                 / np.abs(stat_fsl).max(),
+            'corrp_max_abs_diff': np.abs(corrp - corrp_fsl).max(),
+            'significance_mismatch': np.mean((corrp > .95) !=
+                                             (corrp_fsl > .95))}
+    return differences
+
+
+# ********************************************************
+# Second level grid
+# ********************************************************
+
+def get_randomise_cost(job):
+    """ relative cost of a randomise job: maps x permutations x contrasts """
+    n_contrasts = 1 if job['scnd_lvl'] == 'intercept' else 2
+    return len(job['maps']) * job['n_perms'] * n_contrasts
+
+
+def run_randomise_job(job):
+    """
+    runs randomise (or randomise_fsl) for one (task, contrast, scnd_lvl) of
+    the second level grid, reading its maps from the task's SubjectStack.
+    Returns (job id, number of permutations run, seconds)
+    """
+    start = time.time()
+    if job['fsl']:
+        randomise_fsl(job['maps'], job['maps_dir'], job['mask_loc'],
+                      job['des_mat'], job['scnd_lvl'], n_perms=job['n_perms'],
+                      fwhm=job['fwhm'])
+        n_run = job['n_perms']
+    else:
+        data = SubjectStack(job['stack_dir']).get(job['contrast'],
+                                                  list(job['des_mat'].index))
+        n_run = randomise(job['maps'], job['maps_dir'], job['mask_loc'],
+                          job['des_mat'], job['scnd_lvl'],
+                          n_perms=job['n_perms'], fwhm=job['fwhm'],
+                          n_procs=job['n_procs'], data=data)
+    return job['id'], n_run, time.time() - start
+
+
+def run_randomise_jobs(jobs, n_procs=1):
+    """
+    runs randomise jobs over n_procs processes, heaviest first (see
+    get_randomise_cost), yielding the results of run_randomise_job as they
+    complete.
+
+    Pool workers can not start pools of their own, so with at least
+    n_procs jobs each job gets a worker and runs its permutations in it;
+    with fewer, the jobs run one at a time, each spreading its permutations
+    over every process.
+    """
+    jobs = sorted(jobs, key=get_randomise_cost, reverse=True)
+    n_workers, n_procs_per_job = split_n_procs(n_procs, len(jobs))
+    for job in jobs:
+        job['n_procs'] = n_procs_per_job
+    return run_jobs(run_randomise_job, jobs, n_workers, maxtasksperchild=1)
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(
+        description='Compare randomise to randomise_fsl on synthetic maps. '
+                    'Run as "python -m utils.secondlevel_utils" from '
+                    'scripts/, with FSL installed')
+    parser.add_argument('work_dir')
+    parser.add_argument('--n_maps', default=20, type=int)
+    parser.add_argument('--n_perms', default=500, type=int)
+    parser.add_argument('--fwhm', default=6, type=float)
+    args = parser.parse_args()
+    if shutil.which('randomise') is None:
+        parser.error("FSL's randomise is not on the PATH")
+
+    random_state = np.random.RandomState(0)
+    shape = (20, 24, 20)
+    affine = np.diag([3., 3., 3., 1.])
+    grid = np.indices(shape) - (np.array(shape) / 2)[:, None, None, None]
+    mask = ((grid / [[[[8]]], [[[10]]], [[[8]]]]) ** 2).sum(axis=0) < 1
+    blob = np.exp(-((grid - [[[[4]]], [[[0]]], [[[0]]]]) ** 2).sum(axis=0)
+                  / 10)
+    covariate = random_state.randn(args.n_maps)
+    maps_dir = path.join(args.work_dir, 'maps')
+    makedirs(maps_dir, exist_ok=True)
+    maps = []
+    for i, x in enumerate(covariate):
+        data = random_state.randn(*shape) + (.5 + .5 * x) * blob
+        maps.append(path.join(maps_dir, 'sub-%02d_contrast-synthetic.nii.gz'
+                              % i))
+        nb.Nifti1Image((data * mask).astype(np.float32),
+                       affine).to_filename(maps[-1])
+    mask_loc = path.join(args.work_dir, 'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.uint8), affine).to_filename(mask_loc)
+    des_mat = pd.DataFrame({'intercept': 1., 'synthetic_RT': covariate},
+                           index=['sub-%02d' % i for i in range(args.n_maps)])
+    for scnd_lvl in ['intercept', 'synthetic_RT']:
+        differences = compare_to_randomise_fsl(
+            maps, mask_loc, des_mat, scnd_lvl, args.work_dir,
+            n_perms=args.n_perms, fwhm=args.fwhm)
+        for stat_name, diffs in differences.items():
+            print('%s, %s: %s' % (scnd_lvl, stat_name, ', '.join(
+                '%s %.3g' % item for item in diffs.items())))
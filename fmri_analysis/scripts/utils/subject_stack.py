@@ -0,0 +1,217 @@
+"""
+per task stack of first level maps
+
+The second level used to load (and smooth) every subject's map once per
+contrast for SecondLevelModel, again for randomise, and a third time to
+export the 4D images. A stack holds them all once, for one task and one
+set of first level flags:
+
+    stack.npy    (n_subjects, n_contrasts, n_voxels) float32 maps, masked
+                 with the group mask and smoothed with fwhm. Subjects
+                 missing a contrast have nan rows
+    stack.json   subjects, contrasts, mask, fwhm and the fingerprint (path,
+                 size and mtime) of every map and of the mask
+
+The array is memory-mapped when loaded, so reading one contrast only
+reads that contrast's rows. A stack is rebuilt when any of its maps or
+its mask change, or when maps are added or removed.
+
+Jobs of the same task (e.g. its intercept and RT second levels) may build
+its stack at the same time. Each builds in its own temporary directory
+and moves it in place, unless another job has already put an up to date
+stack there.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import nibabel as nib
+from nilearn import masking
+import numpy as np
+from os import makedirs, path, rename
+import shutil
+import uuid
+
+from utils.firstlevel_utils import get_first_level_maps
+from utils.manifest_utils import stat_file
+from utils.utils import get_flags
+
+STACK_DATA = 'stack.npy'
+STACK_META = 'stack.json'
+
+
+def get_stack_dir(second_level_dir, task, regress_rt=False, beta=False,
+                  fwhm=None):
+    rt_flag, beta_flag = get_flags(regress_rt, beta)
+    return path.join(second_level_dir, task, 'stack_%s_%s_fwhm-%g'
+                     % (rt_flag, beta_flag, float(fwhm or 0)))
+
+
+def get_subject(map_file, first_level_dir):
+    """ subject of a first level map, the first folder below 1stlevel """
+    return path.relpath(map_file, first_level_dir).split(path.sep)[0]
+
+
+def get_stack_maps(first_level_dir, task, contrasts, regress_rt=False,
+                   beta=False):
+    """ {contrast: {subject: map file}} of the first level maps of a task """
+    return {contrast: {get_subject(f, first_level_dir): f
+                       for f in get_first_level_maps('*', task,
+                                                     first_level_dir,
+                                                     contrast, regress_rt,
+                                                     beta)}
+            for contrast in contrasts}
+
+
+def get_stack_fingerprint(stack_maps, mask_file, fwhm):
+    return {'mask': stat_file(mask_file),
+            'fwhm': float(fwhm or 0),
+            'maps': {contrast: {subject: stat_file(f)
+                                for subject, f in sorted(maps.items())}
+                     for contrast, maps in stack_maps.items()}}
+
+
+class SubjectStack():
+    """ a stack written by build_subject_stack """
+    def __init__(self, stack_dir):
+        self.stack_dir = stack_dir
+        with open(path.join(stack_dir, STACK_META), 'r') as f:
+            self.meta = json.load(f)
+        self.subjects = self.meta['subjects']
+        self.contrasts = self.meta['contrasts']
+        self.mask_file = self.meta['mask_file']
+        self.fwhm = self.meta['fwhm']
+        self.data = np.load(path.join(stack_dir, STACK_DATA), mmap_mode='r')
+
+    def get_subjects(self, contrast):
+        """ subjects with a map of contrast """
+        return [s for s in self.subjects
+                if self.meta['fingerprint']['maps'][contrast].get(s)]
+
+    def get(self, contrast, subjects=None):
+        """
+        (n_subjects, n_voxels) masked maps of contrast, for subjects (in
+        that order) or every subject with a map of contrast
+        """
+        if subjects is None:
+            subjects = self.get_subjects(contrast)
+        rows = [self.subjects.index(s) for s in subjects]
+        return np.asarray(self.data[rows, self.contrasts.index(contrast)])
+
+    def get_img(self, contrast, subjects=None):
+        """ as get, as a 4D image """
+        return masking.unmask(self.get(contrast, subjects), self.mask_file)
+
+
+def write_stack_img(job):
+    """
+    writes the 4D image of a (stack_dir, contrast, subjects, filename) job,
+    listing the subjects in its header. The image holds the stack's float32
+    maps, masked with its mask. Returns filename
+    """
+    stack_dir, contrast, subjects, filename = job
+    img = SubjectStack(stack_dir).get_img(contrast, subjects)
+    img.header['descrip'] = 'subjects (in order):' + ', '.join(subjects)
+    img.to_filename(filename)
+    return filename
+
+
+def _load_map(job):
+    map_file, mask_file, fwhm = job
+    return masking.apply_mask(map_file, mask_file, smoothing_fwhm=fwhm)
+
+
+def build_subject_stack(first_level_dir, task, contrasts, mask_file,
+                        stack_dir, fwhm=None, regress_rt=False, beta=False,
+                        n_threads=8, rebuild=False):
+    """
+    writes (or reuses, if its inputs are unchanged) the stack of a task's
+    first level maps of contrasts, masked with mask_file and smoothed with
+    fwhm. Maps are read and smoothed by n_threads threads
+
+    Returns:
+        the SubjectStack
+    """
+    fwhm = float(fwhm or 0) or None
+    stack_maps = get_stack_maps(first_level_dir, task, contrasts,
+                                regress_rt, beta)
+    fingerprint = get_stack_fingerprint(stack_maps, mask_file, fwhm)
+    if not rebuild:
+        stack = _get_current_stack(stack_dir, fingerprint)
+        if stack is not None:
+            return stack
+
+    subjects = sorted({s for maps in stack_maps.values() for s in maps})
+    n_voxels = int((np.asanyarray(nib.load(mask_file).dataobj) > 0).sum())
+    # write to a temporary directory of this build, so an interrupted build
+    # leaves no stack behind and concurrent builds do not share files
+    tmp_dir = _get_unique_dir(stack_dir, 'tmp')
+    makedirs(tmp_dir)
+    data = np.lib.format.open_memmap(
+        path.join(tmp_dir, STACK_DATA), mode='w+', dtype=np.float32,
+        shape=(len(subjects), len(contrasts), n_voxels))
+    data[:] = np.nan
+    jobs, cells = [], []
+    for c, contrast in enumerate(contrasts):
+        for subject, map_file in sorted(stack_maps[contrast].items()):
+            jobs.append((map_file, mask_file, fwhm))
+            cells.append((subjects.index(subject), c))
+    chunk_size = 2 * n_threads
+    with ThreadPoolExecutor(n_threads) as executor:
+        for start in range(0, len(jobs), chunk_size):
+            chunk = jobs[start:start + chunk_size]
+            for (s, c), masked in zip(cells[start:start + chunk_size],
+                                      executor.map(_load_map, chunk)):
+                data[s, c] = masked
+    data.flush()
+    del data
+    with open(path.join(tmp_dir, STACK_META), 'w') as f:
+        json.dump({'subjects': subjects,
+                   'contrasts': list(contrasts),
+                   'mask_file': mask_file,
+                   'fwhm': fwhm,
+                   'fingerprint': fingerprint}, f, indent=1)
+    return _move_stack(tmp_dir, stack_dir, fingerprint)
+
+
+def _get_unique_dir(stack_dir, label):
+    """ a path next to stack_dir that no other build uses """
+    return '%s.%s-%s' % (stack_dir, label, uuid.uuid4().hex)
+
+
+def _get_current_stack(stack_dir, fingerprint):
+    """ the stack in stack_dir if it was built from fingerprint, else None """
+    if not path.exists(path.join(stack_dir, STACK_META)):
+        return None
+    try:
+        stack = SubjectStack(stack_dir)
+    except (IOError, ValueError):  # replaced while being read
+        return None
+    return stack if stack.meta['fingerprint'] == fingerprint else None
+
+
+def _move_stack(tmp_dir, stack_dir, fingerprint):
+    """
+    moves the stack built in tmp_dir to stack_dir, replacing an out of date
+    stack. If another build has put an up to date stack there first, that
+    one is kept and tmp_dir removed
+    """
+    while True:
+        stack = _get_current_stack(stack_dir, fingerprint)
+        if stack is not None:
+            shutil.rmtree(tmp_dir)
+            return stack
+        if path.exists(stack_dir):
+            # move the old stack aside first: rename fails onto a non empty
+            # directory. Another build may have moved it already
+            old_dir = _get_unique_dir(stack_dir, 'old')
+            try:
+                rename(stack_dir, old_dir)
+            except OSError:
+                pass
+            shutil.rmtree(old_dir, ignore_errors=True)
+        try:
+            rename(tmp_dir, stack_dir)
+        except OSError:
+            if not path.exists(stack_dir):
+                raise
+            continue  # another build moved its stack in first
+        return SubjectStack(stack_dir)
@@ -2,6 +2,8 @@
 some util functions
 """
 from collections import defaultdict
+import hashlib
+from multiprocessing import Pool
 import numpy as np
 from os.path import join, sep
 import pandas as pd
@@ -15,6 +17,64 @@ def get_flags(regress_rt=False, beta=False):
     beta_flag = "beta-True" if beta else "beta-False"
     return rt_flag, beta_flag
 
+def hash_file(filename, chunk_size=2**20):
+    """ returns the sha1 hex digest of a file's contents """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def hash_strings(*strings):
+    """ returns the sha1 hex digest of a sequence of strings """
+    sha = hashlib.sha1()
+    for string in strings:
+        sha.update(string.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+def mean_scale(Y):
+    """
+    expresses each column of Y (n_scans, n_voxels) in percent change from
+    its mean, as FirstLevelModel's signal_scaling does
+    """
+    mean = np.maximum(Y.mean(axis=0), 1)
+    return 100 * (Y / mean - 1)
+
+def split_n_procs(n_procs, n_jobs):
+    """
+    Splits a cpu budget between an outer process pool and the joblib
+    parallelism nested inside each job
+
+    Pool workers are daemonic, and joblib runs every Parallel call in a
+    daemonic process with n_jobs=1, so the procs can not be shared: with at
+    least n_procs jobs each job gets a worker of its own and runs serially
+    in it; with fewer, the jobs run one at a time in this process, each
+    with every proc.
+
+    Returns (n_workers, n_jobs_per_worker)
+    """
+    if n_jobs >= n_procs:
+        return max(1, n_procs), 1
+    return 1, max(1, n_procs)
+
+def run_jobs(func, jobs, n_procs=1, maxtasksperchild=None):
+    """
+    Applies func to each job, yielding results as they complete
+
+    With n_procs <= 1 the jobs are run in this process, in order. Otherwise
+    they are fanned out over a pool of n_procs worker processes. Workers are
+    replaced after maxtasksperchild jobs, which returns the memory of large
+    fits to the system instead of letting each worker grow.
+    """
+    if n_procs <= 1:
+        for job in jobs:
+            yield func(job)
+    else:
+        with Pool(n_procs, maxtasksperchild=maxtasksperchild) as pool:
+            for result in pool.imap_unordered(func, jobs):
+                yield result
+
 def get_contrasts(task, regress_rt=True):
     """ 
     Gets a list of contrasts given a task
@@ -5,8 +5,12 @@ import os
 import numpy as np
 import nibabel as nib
 import argparse
+import sys
 
 from nimsphysio.nimsphysio import NIMSPhysio
+# the BOLD cache lives with the analysis utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fmri_analysis', 'scripts'))
+from utils.bold_cache import resolve_bold
 
 # # Download Rest data if it hasn't been downloaded already
 # import flywheel
@@ -32,6 +36,7 @@ def get_args():
     parser.add_argument('-firstlevel_dir', default='/oak/stanford/groups/russpold/data/uh2/aim1/BIDS_scans/derivatives/1stlevel')
     parser.add_argument('--slice_window', default=.085, help='time in seconds for acquiring a single slice')
     parser.add_argument('--corrected_slice_onset', default=.2975, help='for stc data, the reference onset time')
+    parser.add_argument('--bold_cache_dir', default=None, help='read runs from the float32 BOLD cache (fmri_analysis/scripts/build_bold_cache.py) when cached')
     return parser.parse_args()
 
 if __name__=='__main__':
@@ -65,7 +70,10 @@ if __name__=='__main__':
             os.makedirs(outdir, exist_ok=True)
             outnii_name = rest_nii.split('/')[-1].replace('bold', 'desc-preprocPhsyio_bold')
 
-            niimg = nib.load(rest_nii)
+            # cached runs are uncompressed float32, so they are memory-mapped
+            # rather than decompressed and upcast to float64
+            bold_file = resolve_bold(rest_nii, args.bold_cache_dir)
+            niimg = nib.load(bold_file)
             phys = NIMSPhysio(
                 physio_files[-1], # I confirmed that for subjects with 2, the last was used
                 tr=niimg.header.get_zooms()[3],
@@ -80,7 +88,7 @@ if __name__=='__main__':
             phys.write_regressors(os.path.join(outdir, 'regs.txt'))
 
             # regress out physio, save result
-            d_corrected, PCT_VAR_REDUCED = phys.denoise_image(niimg.get_fdata(), phys.regressors)
+            d_corrected, PCT_VAR_REDUCED = phys.denoise_image(np.asanyarray(niimg.dataobj), phys.regressors)
             np.save(os.path.join(outdir, 'pct_var_reduced.npy'), PCT_VAR_REDUCED)
             nib.save(
                 nib.Nifti1Image(d_corrected, niimg.affine, niimg.header),
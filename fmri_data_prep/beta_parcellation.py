@@ -1,21 +1,23 @@
 from nilearn import image
 from glob import glob
 import pandas as pd
-from nilearn.input_data import NiftiLabelsMasker
-from templateflow import api as tflow
 import argparse
 import sys 
 import os
 
+from parcellation_utils import ParcelExtractor, extract_table, get_atlas_path
+
 
 parser = argparse.ArgumentParser(description='First Level Entrypoint script')
 parser.add_argument('-bids_dir', default='/data')
-parser.add_argument('-atlas', default=None)
+parser.add_argument('-atlas', nargs='+', default=None, help='combo, SUIT, esfMRI or a number of Schaefer parcels')
 parser.add_argument('-output_dir', default='/data/derivatives/parcellations/1stlevel_beta')
 parser.add_argument('-atlas_dir', default='./')
 parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, \
             DPX, motorSelectiveStop, stopSignal, stroop, surveyMedley, twoByTwo, WATT3")
 parser.add_argument('--RT_flag', nargs='+', default=['RT-True', 'RT-False'], help='Choose from RT-True, RT-False')
+parser.add_argument('--batched', action='store_true', help='write every contrast to one table, beta_parcels_atlas-<atlas>.csv, instead of a csv per contrast')
+parser.add_argument('--n_threads', default=8, type=int, help='threads reading contrast maps in --batched mode')
 
 if '-bids_dir' in sys.argv:
     args = parser.parse_args()
@@ -23,7 +25,7 @@ else:
     args = parser.parse_args([])
     oak_mount = '/Users/henrymj/Documents/mounts/OAK'
     args.bids_dir = os.path.join(oak_mount, 'data/uh2/aim1/BIDS_scans')
-    args.atlas = 400
+    args.atlas = ['400']
     args.output_dir = os.path.join(args.bids_dir, 'derivatives/parcellations/1stlevel_beta')
 
 
@@ -34,43 +36,48 @@ output_dir = args.output_dir
 
 first_level_dir  = os.path.join(bids_dir,'derivatives', '1stlevel')   
 
-if args.atlas=='combo':
-    atlas_path = os.path.join(args.atlas_dir, 'Parcels_Combo.nii.gz')
-elif args.atlas=='SUIT':
-    atlas_path = os.path.join(args.atlas_dir, 'SUIT.nii.gz')
-else:  # assuming shaefer atlas for now
-    spec_dict = {'atlas': 'Schaefer2018',
-                 'desc': f'{args.atlas}Parcels17Networks',
-                 'nparcels': args.atlas,
-                 'nnetworks': 17,
-                 'atlas': 'Schaefer2018',
-                 'atlas_resolution': 2,
-                 'space': 'MNI152NLin2009cAsym',
-                 'atlas_desc': f'{args.atlas}Parcels17Networks'}
+# every atlas is extracted from one read of each image
+atlases = {atlas: get_atlas_path(atlas, args.atlas_dir) for atlas in args.atlas}
+extractor = ParcelExtractor(atlases, standardize=True)
+atlas_label = '+'.join(args.atlas)
+
+def get_contrast_files(RT_flag, task='*'):
+    return sorted(glob(os.path.join(first_level_dir,
+                                    '*',  # sub
+                                    task,
+                                    f'maps_{RT_flag}_beta-False',
+                                    'contrast-*.nii.gz')))
 
-    atlas_path =  tflow.get(spec_dict['space'],
-                  desc=spec_dict['atlas_desc'],
-                  resolution=spec_dict['atlas_resolution'],
-                  atlas=spec_dict['atlas'])
-    atlas_path = str(atlas_path)
+def get_contrast_keys(contrast_file, RT_flag):
+    subid = contrast_file.split('1stlevel/')[1].split('/')[0]
+    task = contrast_file.split(subid+'/')[1].split('/')[0]
+    contrast = contrast_file.split('contrast-')[-1].replace('.nii.gz', '')
+    return {'subject': subid, 'task': task, 'RT_flag': RT_flag,
+            'contrast': contrast}
 
-masker = NiftiLabelsMasker(labels_img=os.path.abspath(atlas_path), 
-                           standardize=True,
-                           memory='nilearn_cache',
-                           verbose=5)
+if args.batched:
+    # one table of every (task, RT_flag)'s contrasts, one row per map
+    tables = []
+    for RT_flag in args.RT_flag:
+        for task in (args.tasks or tasks):
+            contrast_files = get_contrast_files(RT_flag, task)
+            print(f'{len(contrast_files)} maps for {task}, {RT_flag}')
+            tables.append(extract_table(
+                extractor, contrast_files,
+                [get_contrast_keys(f, RT_flag) for f in contrast_files],
+                n_threads=args.n_threads))
+    os.makedirs(output_dir, exist_ok=True)
+    pd.concat(tables, sort=False).to_csv(
+        os.path.join(output_dir, f'beta_parcels_atlas-{atlas_label}.csv'),
+        index=False)
+    sys.exit()
 
 for RT_flag in args.RT_flag:
     curr_output_dir = os.path.join(output_dir, RT_flag)
     os.makedirs(curr_output_dir, exist_ok=True)
-    for contrast_file in glob(os.path.join(first_level_dir,
-                                           '*',  # sub
-                                           '*',  # task
-                                           f'maps_{RT_flag}_beta-False',
-                                           'contrast-*.nii.gz')
-                                           ):
-        subid = contrast_file.split('1stlevel/')[1].split('/')[0]
-        task = contrast_file.split(subid+'/')[1].split('/')[0]
-        beta_array = masker.fit_transform([contrast_file])
-        contrast = contrast_file.split('contrast-')[-1].replace('.nii.gz', '')
-        pd.DataFrame(beta_array).to_csv(os.path.join(curr_output_dir,
-                f'{subid}_task-{task}_contrast-{contrast}_atlas-{args.atlas}.csv'))
+    for contrast_file in get_contrast_files(RT_flag):
+        keys = get_contrast_keys(contrast_file, RT_flag)
+        subid, task, contrast = keys['subject'], keys['task'], keys['contrast']
+        beta_df = extractor.transform_frame(contrast_file)
+        beta_df.to_csv(os.path.join(curr_output_dir,
+                f'{subid}_task-{task}_contrast-{contrast}_atlas-{atlas_label}.csv'))
@@ -276,6 +276,12 @@ class NIMSPhysio(nimsdata.NIMSReader):
         start_ind = np.argmax(self.resp_time>0)
         return self.resp_wave[start_ind:]
 
+    def get_slice_times(self):
+        """ times (in seconds) of the midpoint of each slice's acquisition in each frame, [#slices x #frames] """
+        # significant change --------------
+        return np.array([np.arange(onset+(self.slice_window/2), self.scan_duration, self.tr)[:self.nframes]
+                         for onset in self.slice_onsets])
+
     def compute_regressors(self, legacy_rvhr=False, hr_min=30, hr_max=180):
         """
          * catie chang,   catie.chang@nih.gov
@@ -356,130 +362,118 @@ class NIMSPhysio(nimsdata.NIMSReader):
         # --------------------------------------------------------------
         # find cardiac and respiratory phase vectors
         # --------------------------------------------------------------
-        self.phases = np.zeros((nslc, self.nframes, 2))
-        for sl in range(nslc):
-            # times (for each frame) at which this slice was acquired (midpoint):
-            # significant shange --------------
-            slice_times = np.arange(self.slice_onsets[sl]+(self.slice_window/2), self.scan_duration, self.tr)
-            # significant shange --------------
-            for fr in range(self.nframes):
-                # cardiac
-                prev_trigs = np.nonzero(card_trig < slice_times[fr])[0]
-                t1 = 0. if prev_trigs.size == 0 else card_trig[prev_trigs[-1]]
-                next_trigs = np.nonzero(card_trig > slice_times[fr])[0]
-                if next_trigs.size == 0:
-                    t2 = self.nframes*self.tr
-                else:
-                    t2 = card_trig[next_trigs[0]]
-                phi_cardiac = (slice_times[fr] - t1) * 2. * np.pi / (t2 - t1)
-
-                # respiration: (based on amplitude histogram)
-                # find the closest index in resp waveform
-                iphys = int(np.min((np.max((0, np.round(slice_times[fr] / self.resp_dt))), drdt.size-1)))  # HJ
-                amp = resp_wave[iphys]
-                dbins = np.abs(amp-bins)
-                thisBin = dbins.argmin()  #closest resp_wave histo bin
-                numer = Hb[0:thisBin].sum().astype(float)
-                phi_resp = np.pi * np.sign(drdt[iphys]) * (numer / respfilt.size)
-
-                # store
-                self.phases[sl,fr,:] = [phi_cardiac, phi_resp]
+        # times (for each slice and frame) at which each slice was acquired (midpoint):
+        slice_times = self.get_slice_times()
+        # cardiac: the last trigger before and the first trigger after each time
+        # (card_trig is in acquisition order, so it is sorted), 0 and the end of the
+        # scan where there is none
+        bounded_trig = np.concatenate(([0.], card_trig, [self.nframes*self.tr]))
+        t1 = bounded_trig[np.searchsorted(card_trig, slice_times, side='left')]
+        t2 = bounded_trig[np.searchsorted(card_trig, slice_times, side='right') + 1]
+        phi_cardiac = (slice_times - t1) * 2. * np.pi / (t2 - t1)
+
+        # respiration: (based on amplitude histogram)
+        # find the closest index in resp waveform
+        iphys = np.minimum(np.maximum(0, np.round(slice_times / self.resp_dt)), drdt.size-1).astype(int)  # HJ
+        # closest resp_wave histo bin of each sample used, and the number of samples
+        # in the bins below it
+        used, inverse = np.unique(iphys, return_inverse=True)
+        thisBin = np.abs(resp_wave[used][:,np.newaxis] - bins).argmin(axis=1)
+        numer = np.concatenate(([0], np.cumsum(Hb)))[thisBin[inverse]].reshape(iphys.shape).astype(float)
+        phi_resp = np.pi * np.sign(drdt[iphys]) * (numer / respfilt.size)
+
+        # store
+        self.phases = np.stack((phi_cardiac, phi_resp), axis=2)
 
         # --------------------------------------------------------------
         # generate slice-specific retroicor regressors
         # --------------------------------------------------------------
-        REGRESSORS_RET = np.zeros((self.nframes, 8, nslc))
-        for sl in range(nslc):
-            phi_c = self.phases[sl,:,0]
-            phi_r = self.phases[sl,:,1]
-
-            # Fourier expansion of cardiac phase
-            c1_c = np.cos(phi_c)
-            s1_c = np.sin(phi_c)
-            c2_c = np.cos(2*phi_c)
-            s2_c = np.sin(2*phi_c)
-
-            # Fourier expansion of respiratory phase
-            c1_r = np.cos(phi_r)
-            s1_r = np.sin(phi_r)
-            c2_r = np.cos(2*phi_r)
-            s2_r = np.sin(2*phi_r)
-            covs = np.array((c1_c, s1_c, c2_c, s2_c,c1_r, s1_r, c2_r, s2_r))
-
-            REGRESSORS_RET[:,:,sl] = covs.transpose()
+        # [#timepoints x #regressors x #slices]
+        phi_c = self.phases[:,:,0].T
+        phi_r = self.phases[:,:,1].T
+        # Fourier expansions of cardiac and respiratory phase
+        REGRESSORS_RET = np.stack((np.cos(phi_c), np.sin(phi_c), np.cos(2*phi_c), np.sin(2*phi_c),
+                                   np.cos(phi_r), np.sin(phi_r), np.cos(2*phi_r), np.sin(2*phi_r)), axis=1)
 
         # --------------------------------------------------------------
         # generate slice-specific rvhrcor regressors
         # --------------------------------------------------------------
-        REGRESSORS_RVHR = np.zeros((self.nframes, 4, nslc))
-        self.heart_rate = np.zeros((self.nframes, nslc))
+        # slices acquired at the same times (e.g. multiband) share their regressors,
+        # which are computed once for each distinct row of slice times
+        acq_times, slice_inds = np.unique(slice_times, axis=0, return_inverse=True)
+        slice_inds = slice_inds.ravel()
         t = np.arange(0, 40-self.tr, self.tr) # 40-sec impulse response
-        for sl in range(nslc):
-            # times (for each frame) at which this slice was acquired (midpoint):
-            # significant change --------
-            slice_times = np.arange(self.slice_onsets[sl]+(self.slice_window/2), self.scan_duration, self.tr)
-            # significant change --------
-            # make slice RV*RRF regressor
-            rv = np.zeros(self.nframes)
-            for tp in range(self.nframes):
-                i1 = int(max(0, np.floor((slice_times[tp] - t_win) / self.resp_dt)))  # HJ
-                i2 = int(min(resp_wave.size, np.floor((slice_times[tp] + t_win) / self.resp_dt))) # HJ
-                if i2 < i1:
-                    raise NIMSPhysioError('Respiration data is shorter than the scan duration.')
-                rv[tp] = np.std(resp_wave[i1:i2])
-
-            # conv(rv, rrf)
-            rv -= rv.mean()
-            R = 0.6 * (t**2.1) * np.exp(-t/1.6) - 0.0023 * (t**3.54) * np.exp(-t/4.25)
-            R = R / R.max()
-            rv_rrf = np.convolve(rv, R)[0:rv.size]
-            # time derivative
-            rv_rrf_d = np.diff(rv_rrf)
-            rv_rrf_d = np.concatenate(([rv_rrf_d[0]], rv_rrf_d))
-
-            # make slice HR*CRF regressor
-            # Catie's original code:
-            if legacy_rvhr:
-                hr = np.zeros(self.nframes)
-                for tp in range(self.nframes):
-                    inds = np.nonzero(np.logical_and(card_trig >= (slice_times[tp]-t_win), card_trig <= (slice_times[tp]+t_win)))[0]
-                    if inds.size < 2:
-                        hr[tp] = 60 if tp==0 else hr[tp-1]
-                    else:
-                        hr[tp] = (inds[-1] - inds[0]) * 60. / (card_trig[inds[-1]] - card_trig[inds[0]])  # bpm
+
+        # make slice RV*RRF regressor
+        # std of the respiration in a window around each time, from cumulative sums
+        # of the (centered) waveform and its square
+        i1 = np.maximum(0, np.floor((acq_times - t_win) / self.resp_dt)).astype(int)  # HJ
+        i2 = np.minimum(resp_wave.size, np.floor((acq_times + t_win) / self.resp_dt)).astype(int)  # HJ
+        if np.any(i2 < i1):
+            raise NIMSPhysioError('Respiration data is shorter than the scan duration.')
+        centered = resp_wave - resp_wave.mean()
+        sum1 = np.concatenate(([0.], np.cumsum(centered)))
+        sum2 = np.concatenate(([0.], np.cumsum(centered**2)))
+        n = i2 - i1
+        mean = (sum1[i2] - sum1[i1]) / n
+        rv = np.sqrt(np.maximum(0., (sum2[i2] - sum2[i1]) / n - mean**2))
+
+        # conv(rv, rrf), for all slices at once
+        rv -= rv.mean(axis=1, keepdims=True)
+        R = 0.6 * (t**2.1) * np.exp(-t/1.6) - 0.0023 * (t**3.54) * np.exp(-t/4.25)
+        R = R / R.max()
+        rv_rrf = scipy.signal.lfilter(R, [1], rv, axis=1)  # == np.convolve(rv, R)[0:rv.size]
+        # time derivative
+        rv_rrf_d = np.diff(rv_rrf, axis=1)
+        rv_rrf_d = np.concatenate((rv_rrf_d[:,:1], rv_rrf_d), axis=1)
+
+        # make slice HR*CRF regressor
+        # Catie's original code:
+        if legacy_rvhr:
+            # first and last trigger in the window around each time; where there are
+            # fewer than 2, the previous frame's heart rate is kept (60 for the first)
+            first = np.searchsorted(card_trig, acq_times - t_win, side='left')
+            last = np.searchsorted(card_trig, acq_times + t_win, side='right') - 1
+            found = last - first >= 1
+            hr = np.full(acq_times.shape, 60.)
+            hr[found] = (last - first)[found] * 60. / (card_trig[last[found]] - card_trig[first[found]])  # bpm
+            prev_found = np.maximum.accumulate(np.where(found, np.arange(self.nframes), 0), axis=1)
+            hr = hr[np.arange(hr.shape[0])[:,np.newaxis], prev_found]
+        else:
+            # Bob's new version:
+            trig_time_delta = np.diff(card_trig)
+            hr_instant = 60. / trig_time_delta
+            hr_time = card_trig[:-1] + trig_time_delta / 2.
+            # Clean a bit. We interpolate below, so it's safe to just discard bad values.
+            keep_inds = np.logical_and(hr_instant>=hr_min, hr_instant<=hr_max)
+            hr_time = hr_time[keep_inds]
+            hr_instant = hr_instant[keep_inds]
+            if len(hr_instant) > 2:
+                hr = np.interp(acq_times, hr_time, hr_instant)
             else:
-                # Bob's new version:
-                trig_time_delta = np.diff(card_trig)
-                hr_instant = 60. / trig_time_delta
-                hr_time = card_trig[:-1] + trig_time_delta / 2.
-                # Clean a bit. We interpolate below, so it's safe to just discard bad values.
-                keep_inds = np.logical_and(hr_instant>=hr_min, hr_instant<=hr_max)
-                hr_time = hr_time[keep_inds]
-                hr_instant = hr_instant[keep_inds]
-                if len(hr_instant) > 2:
-                    hr = np.interp(slice_times, hr_time, hr_instant)
-                else:
-                    hr = np.zeros(slice_times.shape)
-
-            # conv(hr, crf)
-            self.heart_rate[:,sl] = hr
-            hr -= hr.mean()
-            H = 0.6 * (t**2.7) * np.exp(-t/1.6) - 16 * scipy.stats.norm.pdf(t, 12, 3)
-            H /= H.max()
-            hr_crf = np.convolve(hr,H)[0:hr.size]
-            # time derivative
-            hr_crf_d = np.diff(hr_crf)
-            hr_crf_d = np.concatenate(([hr_crf_d[0]], hr_crf_d))
-            REGRESSORS_RVHR[:,:,sl] = np.array((rv_rrf, rv_rrf_d, hr_crf, hr_crf_d)).transpose()
+                hr = np.zeros(acq_times.shape)
+
+        # conv(hr, crf)
+        self.heart_rate = hr.T[:,slice_inds]
+        hr = hr - hr.mean(axis=1, keepdims=True)
+        H = 0.6 * (t**2.7) * np.exp(-t/1.6) - 16 * scipy.stats.norm.pdf(t, 12, 3)
+        H /= H.max()
+        hr_crf = scipy.signal.lfilter(H, [1], hr, axis=1)
+        # time derivative
+        hr_crf_d = np.diff(hr_crf, axis=1)
+        hr_crf_d = np.concatenate((hr_crf_d[:,:1], hr_crf_d), axis=1)
+        # [#timepoints x #regressors x #slices]
+        REGRESSORS_RVHR = np.stack((rv_rrf, rv_rrf_d, hr_crf, hr_crf_d), axis=1).T[:,:,slice_inds]
 
         # --------------------------------------------------------------
         # final set of physio regressors
         # --------------------------------------------------------------
         self.regressors = np.concatenate((REGRESSORS_RET, REGRESSORS_RVHR, self.heart_rate[:,np.newaxis,:]), axis=1)
-        for sl in range(nslc):
-            x = np.arange(self.regressors.shape[0]).transpose()
-            for reg in range(self.regressors.shape[1] - 1):
-                self.regressors[:,reg,sl] -= np.polyval(np.polyfit(x, self.regressors[:,reg,sl], 2), x)
+        # remove a quadratic trend from every regressor but the heart rate, all slices at once
+        x = np.arange(self.regressors.shape[0])
+        detrended = self.regressors[:,:-1,:].reshape(self.nframes, -1)
+        detrended -= np.vander(x, 3).dot(np.polyfit(x, detrended, 2))
+        self.regressors[:,:-1,:] = detrended.reshape(self.nframes, -1, nslc)
 
 
     def denoise_image(self, d, regressors):
@@ -492,7 +486,7 @@ class NIMSPhysio(nimsdata.NIMSReader):
         npix_x = d.shape[0]
         npix_y = d.shape[1]
         PCT_VAR_REDUCED = np.zeros((npix_x,npix_y,nslc))
-        d_corrected = np.zeros(d.shape)
+        d_corrected = np.zeros(d.shape, dtype=np.result_type(d.dtype, np.float32))
         for jj in range(nslc):
             slice_data = np.squeeze(d[:,:,jj,:])
             Y_slice = slice_data.reshape((npix_x*npix_y, self.nframes)).transpose() #ntime x nvox
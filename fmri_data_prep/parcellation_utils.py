@@ -0,0 +1,215 @@
+"""
+multi-atlas parcellation
+
+NiftiLabelsMasker reads (and resamples) an image for every atlas it is
+run with. ParcelExtractor reads each image once and averages it within
+the parcels of any number of atlases. For every voxel grid it meets, it
+resamples the atlases to it (nearest neighbour, as the masker does) and
+keeps the in-parcel voxels of all atlases sorted by parcel, so that one
+np.add.reduceat over the image's voxels gives the sums of every parcel
+of every atlas. The parcel means are then cleaned with nilearn's
+signal.clean, with the masker's defaults (no detrending, standardizing,
+optional confounds).
+
+extract_table parcellates many 3D maps (e.g. first level contrasts) into
+one table, reading them with a pool of threads.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+import nibabel as nib
+from nilearn import image, signal
+import numpy as np
+import pandas as pd
+
+ATLAS_FILES = {'combo': 'Parcels_Combo.nii.gz',
+               'SUIT': 'SUIT.nii.gz',
+               'esfMRI': 'tpl-MNI152NLin2009cAsym_res-02_atlas-smorgasbord_dseg.nii.gz'}
+
+
+def get_atlas_path(atlas, atlas_dir='./'):
+    """
+    path of an atlas: one of ATLAS_FILES in atlas_dir, or else the number
+    of parcels of a 17 network Schaefer atlas, fetched from templateflow
+    """
+    if atlas in ATLAS_FILES:
+        return os.path.join(atlas_dir, ATLAS_FILES[atlas])
+    from templateflow import api as tflow
+    spec_dict = {'atlas': 'Schaefer2018',
+                 'atlas_resolution': 2,
+                 'space': 'MNI152NLin2009cAsym',
+                 'atlas_desc': f'{atlas}Parcels17Networks'}
+    atlas_path = tflow.get(spec_dict['space'],
+                           desc=spec_dict['atlas_desc'],
+                           resolution=spec_dict['atlas_resolution'],
+                           atlas=spec_dict['atlas'])
+    return str(atlas_path)
+
+
+class ParcelIndex():
+    """
+    the parcels of every atlas in one voxel grid
+
+    Attributes:
+        labels: OrderedDict of atlas -> its parcel labels (background 0
+            excluded), in output order
+        voxels: flat indices of the in-parcel voxels of every atlas, sorted
+            by parcel (a voxel appears once per atlas it is in)
+        starts: position in voxels of the first voxel of each parcel
+        counts: number of voxels of each parcel
+    """
+    def __init__(self, atlas_imgs, target_img=None):
+        self.labels = OrderedDict()
+        voxels, starts, counts = [], [], []
+        n_indexed = 0
+        for atlas, atlas_img in atlas_imgs.items():
+            if target_img is not None and not _same_grid(atlas_img,
+                                                         target_img):
+                atlas_img = image.resample_to_img(atlas_img, target_img,
+                                                  interpolation='nearest')
+            label_data = np.asanyarray(atlas_img.dataobj).ravel()
+            in_parcel = np.flatnonzero(label_data)
+            order = np.argsort(label_data[in_parcel], kind='stable')
+            in_parcel = in_parcel[order]
+            labels, first, n = np.unique(label_data[in_parcel],
+                                         return_index=True,
+                                         return_counts=True)
+            self.labels[atlas] = labels
+            voxels.append(in_parcel)
+            starts.append(first + n_indexed)
+            counts.append(n)
+            n_indexed += len(in_parcel)
+        self.voxels = np.concatenate(voxels)
+        self.starts = np.concatenate(starts)
+        self.counts = np.concatenate(counts)
+
+    def get_means(self, data):
+        """
+        (n_samples, n_parcels) parcel means of data, a 3D or 4D array in
+        the index's voxel grid
+        """
+        samples = data.reshape(-1, data.shape[3] if data.ndim == 4 else 1)
+        values = np.asarray(samples[self.voxels], dtype=np.float64)
+        sums = np.add.reduceat(values, self.starts, axis=0)
+        return (sums / self.counts[:, None]).T
+
+    def get_columns(self, named=False):
+        """
+        output column names: <atlas>_<label>, or, with one atlas and not
+        named, the numbers NiftiLabelsMasker's outputs were written with
+        """
+        if len(self.labels) == 1 and not named:
+            labels, = self.labels.values()
+            return list(range(len(labels)))
+        return [f'{atlas}_{label:g}' for atlas, labels in self.labels.items()
+                for label in labels]
+
+
+def _same_grid(img, target_img):
+    return img.shape[:3] == target_img.shape[:3] and \
+        np.allclose(img.affine, target_img.affine)
+
+
+class ParcelExtractor():
+    """
+    parcel means of images for several atlases at once
+
+    Args:
+        atlases: dict of atlas name -> atlas image or path, in output order
+        standardize: as NiftiLabelsMasker's standardize
+    """
+    def __init__(self, atlases, standardize=True):
+        self.atlas_imgs = OrderedDict((atlas, image.load_img(atlas_img))
+                                      for atlas, atlas_img in atlases.items())
+        self.standardize = standardize
+        self._indices = {}
+        self._index_lock = threading.Lock()
+
+    def get_index(self, img):
+        """
+        the ParcelIndex of img's voxel grid, built on first use. Threads
+        (see extract_table) wait for the first one to build it rather than
+        each resampling the atlases
+        """
+        key = (img.shape[:3], img.affine.tobytes())
+        if key not in self._indices:
+            with self._index_lock:
+                if key not in self._indices:
+                    self._indices[key] = ParcelIndex(self.atlas_imgs, img)
+        return self._indices[key]
+
+    def transform(self, img, confounds=None):
+        """
+        reads img (a path or image, 3D or 4D) once and returns the
+        (n_samples, n_parcels) parcel means of every atlas, in atlas order,
+        cleaned as NiftiLabelsMasker.fit_transform would
+        """
+        if isinstance(img, str):
+            img = nib.load(img)
+        index = self.get_index(img)
+        region_signals = index.get_means(np.asanyarray(img.dataobj))
+        return signal.clean(region_signals, detrend=False,
+                            standardize=self.standardize,
+                            confounds=confounds)
+
+    def transform_frame(self, img, confounds=None):
+        """
+        as transform, as a DataFrame. With one atlas its columns are
+        numbered as the masker's outputs were, otherwise they are named
+        <atlas>_<label>
+        """
+        if isinstance(img, str):
+            img = nib.load(img)
+        return pd.DataFrame(self.transform(img, confounds),
+                            columns=self.get_index(img).get_columns())
+
+    def transform_atlases(self, img, confounds=None):
+        """
+        as transform, split by atlas: OrderedDict of atlas -> DataFrame
+        whose columns are the atlas's parcel labels, as strings
+        """
+        if isinstance(img, str):
+            img = nib.load(img)
+        values = self.transform(img, confounds)
+        frames, start = OrderedDict(), 0
+        for atlas, labels in self.get_index(img).labels.items():
+            frames[atlas] = pd.DataFrame(values[:, start:start + len(labels)],
+                                         columns=[f'{label:g}'
+                                                  for label in labels])
+            start += len(labels)
+        return frames
+
+
+def _transform_named(job):
+    extractor, filename = job
+    img = nib.load(filename)
+    values, = extractor.transform(img)
+    return pd.Series(values,
+                     index=extractor.get_index(img).get_columns(named=True))
+
+
+def extract_table(extractor, files, keys, n_threads=8):
+    """
+    parcel means of every atlas for each of files (3D maps), read by
+    n_threads threads, a bounded number at a time
+
+    Args:
+        extractor: ParcelExtractor
+        files: list of 3D images
+        keys: list of dicts identifying each file (e.g. subject, task,
+            contrast), which become the table's first columns
+
+    Returns:
+        DataFrame with one row per file: its keys, then one <atlas>_<label>
+        column per parcel
+    """
+    rows = []
+    chunk_size = 2 * n_threads
+    with ThreadPoolExecutor(n_threads) as executor:
+        for start in range(0, len(files), chunk_size):
+            chunk = [(extractor, f) for f in files[start:start + chunk_size]]
+            rows += executor.map(_transform_named, chunk)
+    values = pd.DataFrame(rows).reset_index(drop=True)
+    return pd.concat([pd.DataFrame(keys), values], axis=1)
@@ -4,12 +4,19 @@ from nilearn import image
 from glob import glob
 import pandas as pd
 import os
-from nilearn.input_data import NiftiLabelsMasker
+
+# the BOLD cache lives with the analysis utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fmri_analysis', 'scripts'))
+from utils.bold_cache import resolve_bold
+from parcellation_utils import ParcelExtractor
+from timeseries_store import TimeseriesStore
 
 parser = argparse.ArgumentParser(description='First Level Entrypoint script')
 parser.add_argument('-bids_dir', default='/data')
-parser.add_argument('-parcellation_loc', default='./Parcels_Combo.nii.gz')
+parser.add_argument('-parcellation_loc', nargs='+', default=['./Parcels_Combo.nii.gz'], help='one or more atlases, all extracted from one read of each run')
 parser.add_argument('-output_dir', default='/data/derivatives/1stlevel/timeseries')
+parser.add_argument('-bold_cache_dir', default=None, help='read runs from the float32 BOLD cache (fmri_analysis/scripts/build_bold_cache.py) when cached')
+parser.add_argument('--csv', action='store_true', help='write a csv per subject and task instead of the timeseries store')
 parser.add_argument('--tasks', nargs="+", help="Choose from ANT, CCTHot, discountFix, DPX, motorSelectiveStop, stopSignal, stroop, surveyMedley, twoByTwo, WATT3")
 
 if '-bids_dir' in sys.argv or '-h' in sys.argv:
@@ -17,7 +24,7 @@ if '-bids_dir' in sys.argv or '-h' in sys.argv:
 else:
     args = parser.parse_args([])
     args.bids_dir = 'tmp/OAK/data/uh2/aim1/BIDS_scans'
-    args.parcellation_loc='./Parcels_Combo.nii.gz'
+    args.parcellation_loc=['./Parcels_Combo.nii.gz']
     args.output_dir = 'tmp/OAK/data/uh2/aim1/BIDS_scans/derivatives/1stlevel/timeseries'
     args.tasks = ['ANT', 'CCTHot', 'DPX', 'discountFix', 'motorSelectiveStop', 'stopSignal', 'stroop', 'twoByTwo', 'WATT3']
 
@@ -35,8 +42,10 @@ fmriprep_dir = os.path.join(derivs_dir, fmriprep_label)
 subject_dirs = glob(os.path.join(fmriprep_dir, '*[!.html]')) # get subject dirs
 
 
-parcellation_filename = args.parcellation_loc
-masker = NiftiLabelsMasker(labels_img=parcellation_filename, standardize=True, memory='nilearn_cache', verbose=5)
+atlases = {os.path.basename(f).split('.')[0]: f for f in args.parcellation_loc}
+extractor = ParcelExtractor(atlases, standardize=True)
+# float32 runs partitioned by task and atlas (see timeseries_store.py)
+store = TimeseriesStore(output)
 
 def preprocess_confounds(confound_df):
     # global signal
@@ -44,22 +53,32 @@ def preprocess_confounds(confound_df):
 
     return confound_df.fillna(method='bfill') #remove nan
 
-def get_timeseries(masker, img_path, confound_df):
-    time_series = masker.fit_transform(img_path, confounds=confound_df.values)
+def get_timeseries(extractor, img_path, confound_df):
+    time_series = extractor.transform_frame(img_path, confounds=confound_df.values)
     return time_series
 
+def get_atlas_timeseries(extractor, img_path, confound_df):
+    return extractor.transform_atlases(img_path, confounds=confound_df.values)
+
 
 for task in tasks:
     for subj in subject_dirs:
         try:
             bold_file = glob(os.path.join(subj, '*/func', f'*{task}*MNI*bold.nii.gz'))[0]
+            bold_file = resolve_bold(bold_file, args.bold_cache_dir)
             confound_file = glob(os.path.join(subj, '*/func', f'*{task}*confounds_regressors.tsv'))[0]
 
             confound_df = preprocess_confounds(pd.read_csv(confound_file, delimiter='\t').copy())
 
-            timeseries = get_timeseries(masker, bold_file, confound_df)
-
             subid = subj.split('/')[-1].split('-')[-1]
-            pd.DataFrame(timeseries).to_csv(os.path.join(output, f'{subid}_{task}.csv'))
+            if args.csv:
+                timeseries = get_timeseries(extractor, bold_file, confound_df)
+                timeseries.to_csv(os.path.join(output, f'{subid}_{task}.csv'))
+                continue
+            # session from the fmriprep folders (cached runs are not in them)
+            ses = confound_file.split('/ses-')[1].split('/')[0] if '/ses-' in confound_file else None
+            for atlas, timeseries in get_atlas_timeseries(extractor, bold_file, confound_df).items():
+                store.write(timeseries, task, atlas, subid, session=ses,
+                            bold_file=bold_file, confound_file=confound_file)
         except:
             print(f'file not found for task: {task} in {subj}')
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+parcel timeseries store
+
+Parcel timeseries are stored as float32 arrays, one compressed .npz per
+run, partitioned by task and atlas:
+
+    <root>/task-<task>/atlas-<atlas>/sub-<subject>[_ses-<session>][_run-<run>]_timeseries.npz
+    <root>/task-<task>/atlas-<atlas>/sub-<subject>[_ses-<session>][_run-<run>]_timeseries.json
+
+The .npz holds the (n_volumes, n_parcels) timeseries and the parcel
+labels. Its json sidecar holds the BIDS entities, the shape, the parcel
+labels and any other metadata given when the run was written (e.g. the
+source BOLD file). A run is read from the path its entities name, without
+listing or reading any other run. query lists runs from the sidecars
+alone.
+"""
+from glob import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+ENTITIES = ['subject', 'session', 'run']
+ENTITY_PREFIXES = {'subject': 'sub', 'session': 'ses', 'run': 'run'}
+
+
+def get_run_name(subject, session=None, run=None):
+    entities = {'subject': subject, 'session': session, 'run': run}
+    return '_'.join(f'{ENTITY_PREFIXES[e]}-{entities[e]}' for e in ENTITIES
+                    if entities[e] is not None) + '_timeseries'
+
+
+class TimeseriesStore():
+    def __init__(self, root):
+        self.root = root
+
+    def get_prefix(self, task, atlas, subject, session=None, run=None):
+        """ path of a run's files, without their extension """
+        return os.path.join(self.root, f'task-{task}', f'atlas-{atlas}',
+                            get_run_name(subject, session, run))
+
+    def exists(self, task, atlas, subject, session=None, run=None):
+        prefix = self.get_prefix(task, atlas, subject, session, run)
+        return os.path.exists(prefix + '.json')
+
+    def write(self, timeseries, task, atlas, subject, session=None, run=None,
+              labels=None, **metadata):
+        """
+        writes a run's (n_volumes, n_parcels) timeseries, an array or a
+        DataFrame whose columns are the parcel labels. The sidecar is
+        written last, so a run without one is incomplete
+        """
+        if isinstance(timeseries, pd.DataFrame):
+            labels = list(timeseries.columns) if labels is None else labels
+            timeseries = timeseries.values
+        timeseries = np.asarray(timeseries, dtype=np.float32)
+        if labels is None:
+            labels = list(range(timeseries.shape[1]))
+        labels = [str(label) for label in labels]
+        prefix = self.get_prefix(task, atlas, subject, session, run)
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        with open(prefix + '.npz.tmp', 'wb') as f:
+            np.savez_compressed(f, timeseries=timeseries,
+                                labels=np.array(labels))
+        os.replace(prefix + '.npz.tmp', prefix + '.npz')
+        sidecar = {'task': task, 'atlas': str(atlas), 'subject': subject,
+                   'session': session, 'run': run,
+                   'shape': list(timeseries.shape), 'labels': labels,
+                   **metadata}
+        with open(prefix + '.json.tmp', 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(prefix + '.json.tmp', prefix + '.json')
+
+    def read(self, task, atlas, subject, session=None, run=None):
+        """ a run's timeseries, as a float32 DataFrame of parcels """
+        prefix = self.get_prefix(task, atlas, subject, session, run)
+        with np.load(prefix + '.npz') as saved:
+            return pd.DataFrame(saved['timeseries'],
+                                columns=saved['labels'].tolist())
+
+    def read_metadata(self, task, atlas, subject, session=None, run=None):
+        prefix = self.get_prefix(task, atlas, subject, session, run)
+        with open(prefix + '.json', 'r') as f:
+            return json.load(f)
+
+    def query(self, task='*', atlas='*', subject='*'):
+        """
+        DataFrame of the sidecars of the runs matching task, atlas and
+        subject (glob patterns), one row per run
+        """
+        sidecars = glob(os.path.join(self.root, f'task-{task}',
+                                     f'atlas-{atlas}',
+                                     f'sub-{subject}_*timeseries.json'))
+        rows = []
+        for sidecar in sorted(sidecars):
+            with open(sidecar, 'r') as f:
+                rows.append(json.load(f))
+        return pd.DataFrame(rows)